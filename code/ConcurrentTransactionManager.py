@@ -0,0 +1,708 @@
+"""ConcurrentTransactionManager.py implements a transaction manager that client threads can call at the same time.
+Instead of one global lock, shared state is latched at a fine grain:
+    every variable has a latch (a condition variable) guarding its lock table entries and
+    versions on all sites, and the queue of operations waiting for it
+    the waits-for graph has its own latch
+    every transaction has a TxState with its own latch, guarding its ops and the sites it accessed
+    the maps of transactions, the logical clock and the stats share one latch
+An operation which can't get its lock blocks its client thread on the variable's condition
+until the lock is released, instead of waiting in a waitlist. Latches are always taken in the
+order variable -> graph -> transaction, and variables in ascending index when several are needed.
+
+It runs RW transactions under strict 2PL with deadlock detection and RO transactions on snapshots,
+with fixed placement and available-copies replication.
+
+Sessions drives it from a command file: every transaction runs on its own client thread.
+
+The details of classes and methods are specified below every definition of them.
+"""
+import threading
+from contextlib import ExitStack
+from queue import Queue
+from TransactionManager import TransactionManager
+from components import Operation, Transaction, conflicts, debugMode
+from keyindex import keyOrder
+import victims
+import snapshot
+
+
+class TxState:
+    """State of a transaction shared between its client thread and the others.
+    args:
+        latch: guards the transaction's ops and accessed sites
+        victim: why the transaction must abort (None - it may go on), set by other threads
+        waitingOn: variable whose condition its client thread waits on (None - not waiting),
+                   guarded by the graph latch
+    """
+    __slots__ = ('latch', 'victim', 'waitingOn')
+
+    def __init__(self):
+        self.latch = threading.Lock()
+        self.victim = None
+        self.waitingOn = None
+
+
+class ConcurrentTransactionManager(TransactionManager):
+    """Thread-safe transaction manager.
+    args:
+        latches: condition variable of each variable (variable index: threading.Condition)
+        queues: operations blocked on each variable in arrival order (variable index: list of (op, tx))
+        keyLatch: guards creating keys and reading the key indexes of the sites,
+                  taken before any variable's latch
+        graphLatch: guards self.graph and the waitingOn of every TxState
+        txLatch: guards self.transactions, self.txSite, self.states, self.clock and self.stats
+        states: TxState of each running transaction (txId: TxState)
+        onBlocked: called with (txId, True) when a client thread starts waiting for a lock
+                   and (txId, False) when it is woken up, None - no one listens
+    """
+    def __init__(self, victimPolicy='youngest', onBlocked=None):
+        super().__init__(victimPolicy=victimPolicy)
+        self.latches = {varId: threading.Condition() for varId in self.varSite}
+        self.queues = {varId: list() for varId in self.varSite}
+        self.keyLatch = threading.Lock()
+        self.graphLatch = threading.Lock()
+        self.txLatch = threading.Lock()
+        self.states = dict()
+        self.onBlocked = onBlocked
+
+    def advanceClock(self):
+        """Advance the logical clock by one tick and move the history horizon of the sites.
+        """
+        with self.txLatch:
+            self.clock += 1
+            self.trimHistory()
+
+    def lookup(self, txId):
+        """Find a running transaction and its state.
+
+        OUTPUT:
+            (transaction, TxState), (None, None) if it has ended
+        """
+        with self.txLatch:
+            if txId not in self.transactions:
+                return None, None
+            return self.transactions[txId], self.states[txId]
+
+    def startTx(self, txType, txId, priority=0, mode=None, declared=None, timeout=None):
+        """Start a transaction
+        INPUT:
+            txType (transaction type: RW/RO), txId (transaction id)
+            priority (used by the priority victim policy, lower aborts first)
+            mode (only 2PL is supported), declared, timeout (not supported)
+        """
+        if mode not in (None, '2PL') or declared:
+            raise ValueError("Concurrent mode only runs 2PL transactions which lock incrementally")
+        if timeout is not None:
+            raise ValueError("Concurrent mode has no lock-wait timeouts")
+        self.advanceClock()
+        print('Start T{}'.format(txId))
+        with self.txLatch:
+            tx = Transaction(txId, txType)
+            tx.priority = priority
+            self.transactions[txId] = tx
+            self.txSite[txId] = set()
+            self.states[txId] = TxState()
+        with self.graphLatch:
+            self.graph.insertVertex(txId)
+
+    def readOp(self, txId, varId, update=False):
+        """Read the value of a variable, blocking until the read (or update) lock is granted
+        (RW) or a replica can serve the snapshot (RO).
+
+        INPUT:
+            txId(transaction id), varId(index of the variable), update(True - take an update lock)
+        """
+        self.advanceClock()
+        tx, state = self.lookup(txId)
+        if tx is None:
+            return
+        self.ensureKey(varId)
+        op = Operation(txId, 'read', varId)
+        if update and tx.txType == 'RW':
+            op.lockType = 'update'
+        with state.latch:
+            tx.addOp(op)
+        self.run(op, tx, state)
+
+    def writeOp(self, txId, varId, value):
+        """Write a value to a variable, blocking until the write lock is granted.
+
+        INPUT:
+            txId(transaction id), varId(index of the variable), value(value to write)
+        """
+        self.advanceClock()
+        tx, state = self.lookup(txId)
+        if tx is None:
+            return
+        self.ensureKey(varId)
+        op = Operation(txId, 'write', varId, value)
+        with state.latch:
+            tx.addOp(op)
+        self.run(op, tx, state)
+
+    def batchOp(self, txId, statements):
+        """Run several operations of a transaction in statement order.
+        Each one blocks the client thread until it can run, like readOp and writeOp.
+
+        INPUT:
+            txId(transaction id), statements(list of ('R', varId) or ('W', varId, value))
+        """
+        for statement in statements:
+            if statement[0] == 'R':
+                self.readOp(txId, statement[1])
+            else:
+                self.writeOp(txId, statement[1], statement[2])
+
+    def rangeOp(self, txId, low, high):
+        """Read every key between low and high (both included) in key order.
+        A RW transaction first locks the range on every available site, so no other
+        transaction can write or insert a key inside it, then reads the keys one by one.
+
+        INPUT:
+            txId(transaction id), low(first key of the range), high(last key of the range)
+        """
+        tx, state = self.lookup(txId)
+        if tx is None:
+            return
+        if tx.txType == 'RW':
+            with state.latch:
+                tx.ranges.append((low, high))
+                for siteId, site in self.sites.items():
+                    if site.ApplyRangeLock(txId, low, high) == -1:
+                        self.txSite[txId].add(siteId)
+        keys = self.keysInRange(low, high)
+        if not keys:
+            print("T{} read no variable between {} and {}.".format(txId, low, high))
+        for varId in keys:
+            self.readOp(txId, varId)
+
+    def ensureKey(self, varId):
+        """Create a key accessed for the first time, with its latch and queue.
+        """
+        with self.keyLatch:
+            if varId in self.varSite:
+                return
+            super().ensureKey(varId)
+            self.latches[varId] = threading.Condition()
+            self.queues[varId] = list()
+
+    def keysInRange(self, low, high):
+        with self.keyLatch:
+            return super().keysInRange(low, high)
+
+    def run(self, op, tx, state):
+        """Execute an operation, waiting on its variable's condition while it can't.
+        Before waiting, the waits-for edges of the transaction are put in the graph;
+        if they close a cycle the victim is aborted: by this thread if it is the victim,
+        otherwise the victim's thread is woken up to abort itself.
+
+        INPUT:
+            op(the operation), tx(its transaction), state(TxState of the transaction)
+        OUTPUT:
+            True - executed, False - the transaction aborted
+        """
+        latch = self.latches[op.varId]
+        queue = self.queues[op.varId]
+        while True:
+            victim = None
+            with latch:
+                if state.victim is None and self.tryExecute(op, tx, queue):
+                    self.dequeue(op, queue)
+                    self.stopWaiting(tx.txId, state)
+                    return True
+                if state.victim is None:
+                    if not any(waiting is op for waiting, _ in queue):
+                        queue.append((op, tx))
+                    victim = self.waitsFor(op, tx, state, queue)
+                    if victim is None:
+                        if self.onBlocked:
+                            self.onBlocked(tx.txId, True)
+                        latch.wait()
+                        continue
+                if victim is None or victim is tx:
+                    self.dequeue(op, queue)
+                    break
+            # woken up outside our latch, latches are never held two at a time
+            self.wake(victim)
+        self.stopWaiting(tx.txId, state)
+        self.abortTx(tx, state.victim or 'deadlock')
+        return False
+
+    def tryExecute(self, op, tx, queue):
+        """Get the locks of an operation on all available replicas at once and execute it.
+        Called holding the variable's latch. A waiting RW op may only go when it is the first
+        RW op in the queue; a new one goes as soon as no other transaction holds a conflicting lock.
+        Unlike the waitlist, it doesn't wait behind others for a lock its transaction already
+        holds: they wait for that transaction, so it would be a deadlock.
+
+        OUTPUT:
+            True - executed, False - it must wait
+        """
+        if tx.txType == 'RO':
+            for siteId in self.snapshotSites(op.varId, tx.startTime):
+                if self.sites[siteId].execute(op, tx):
+                    op.exec = True
+                    return True
+            return False
+        position = next((i for i, (waiting, _) in enumerate(queue) if waiting is op), None)
+        queued = position is not None
+        if queued and any(waitingTx.txType == 'RW' for _, waitingTx in queue[:position]):
+            return False
+        sites = list()
+        for siteId in self.varSite[op.varId]:
+            site = self.sites[siteId]
+            if site.status == "fail":
+                continue
+            var = site.variable_list[op.varId]
+            if var.is_recovered and op.opType == 'read' and var.replicated:
+                continue
+            for holder in site.lock_table[op.varId]:
+                if holder.transaction_id != tx.txId and conflicts(op.lock.lock_type, holder.lock_type):
+                    if op.opType == 'write':
+                        # an update lock holder waits for the readers ahead of new ones
+                        site.queue_upgrade(op.varId, tx.txId)
+                    return False
+            if site.blockers(op.varId, tx.txId, op.lock.lock_type):
+                return False
+            if op.opType == 'read' and site.upgrade_waiting(op.varId, tx.txId):
+                return False
+            sites.append(siteId)
+        if not sites:
+            return False
+        for siteId in sites:
+            self.sites[siteId].ApplyLock(op.lock, True)
+        op.locks = sites
+        if op.opType == 'read':
+            for siteId in sites:
+                if self.sites[siteId].execute(op, tx):
+                    op.exec = True
+                    break
+        else:
+            op.exec = all([self.sites[siteId].execute(op, tx) for siteId in sites])
+        with self.states[tx.txId].latch:
+            self.txSite[tx.txId].update(sites)
+        return op.exec
+
+    def dequeue(self, op, queue):
+        """Take an operation off its variable's queue.
+        Called holding the variable's latch; the next ones may be able to go now.
+        """
+        for i, (waiting, _) in enumerate(queue):
+            if waiting is op:
+                queue.pop(i)
+                self.notifyWaiters(op.varId)
+                return
+
+    def notifyWaiters(self, varId):
+        """Wake up every client thread waiting for a variable.
+        Called holding the variable's latch.
+        """
+        if self.onBlocked:
+            for waiting, _ in self.queues[varId]:
+                self.onBlocked(waiting.txId, False)
+        self.latches[varId].notify_all()
+
+    def waitsFor(self, op, tx, state, queue):
+        """Replace the out edges of a blocked transaction in the graph and look for a deadlock.
+        It waits for conflicting holders of the variable and for RW ops of other
+        transactions queued before it. Called holding the variable's latch.
+
+        OUTPUT:
+            the victim to abort, None - no deadlock
+        """
+        holders = set()
+        for siteId in self.varSite[op.varId]:
+            for holder in self.sites[siteId].lock_table[op.varId]:
+                if holder.transaction_id != tx.txId and conflicts(op.lock.lock_type, holder.lock_type):
+                    holders.add(holder.transaction_id)
+            holders |= self.sites[siteId].blockers(op.varId, tx.txId, op.lock.lock_type)
+        for waiting, waitingTx in queue:
+            if waiting is op:
+                break
+            if waitingTx.txType == 'RW' and waiting.txId != tx.txId:
+                holders.add(waiting.txId)
+        with self.graphLatch:
+            state.waitingOn = op.varId
+            vertex = self.graph.getVertex(tx.txId)
+            vertex.adj.clear()
+            for holder in holders:
+                if self.graph.getVertex(holder):
+                    self.graph.addEdge(tx.txId, holder)
+            for cycle in self.graph.findCycles():
+                if vertex not in cycle:
+                    continue
+                with self.txLatch:
+                    txs = [self.transactions[v.vId] for v in cycle if v.vId in self.transactions]
+                    if any(self.states[other.txId].victim for other in txs):
+                        # already being broken, wait for the victim to release its locks
+                        continue
+                    if debugMode:
+                        print("Deadlock detected: ", [v.vId for v in cycle])
+                    victim = victims.chooseVictim(txs, self.victimPolicy)
+                    self.states[victim.txId].victim = 'deadlock'
+                return victim
+        return None
+
+    def stopWaiting(self, txId, state):
+        """Remove the out edges of a transaction which isn't waiting anymore.
+        """
+        with self.graphLatch:
+            state.waitingOn = None
+            vertex = self.graph.getVertex(txId)
+            if vertex:
+                vertex.adj.clear()
+
+    def wake(self, tx):
+        """Wake up the client thread of a victim so it aborts itself.
+        """
+        with self.graphLatch:
+            state = self.states.get(tx.txId)
+            varId = state.waitingOn if state else None
+        if varId is not None:
+            with self.latches[varId]:
+                self.notifyWaiters(varId)
+
+    def cancel(self, txId, reason='end'):
+        """Abort a transaction from another thread: it aborts at its next step,
+        at once if it is waiting for a lock.
+
+        INPUT:
+            txId(transaction id), reason(why it aborts)
+        """
+        tx, state = self.lookup(txId)
+        if tx is None:
+            return
+        state.victim = reason
+        self.wake(tx)
+
+    def opsByVar(self, tx):
+        """Ops of a transaction grouped by variable.
+
+        OUTPUT:
+            dict (variable index: list of ops)
+        """
+        byVar = dict()
+        with self.states[tx.txId].latch:
+            for op in tx.ops:
+                byVar.setdefault(op.varId, list()).append(op)
+        return byVar
+
+    def finish(self, tx, commit):
+        """Commit or undo the ops of a transaction, one variable at a time in ascending index.
+        Its locks are still held.
+
+        INPUT:
+            tx(the transaction), commit(True - commit, False - undo)
+        OUTPUT:
+            True - all commits succeeded
+        """
+        done = True
+        byVar = self.opsByVar(tx)
+        for varId in sorted(byVar, key=keyOrder):
+            with self.latches[varId]:
+                for op in byVar[varId]:
+                    for siteId in op.locks:
+                        if commit:
+                            done = self.sites[siteId].commit(op, tx) and done
+                        elif op.opType == 'write' and op.exec:
+                            self.sites[siteId].undo(op)
+        return done
+
+    def unlock(self, tx):
+        """Release the locks of an ended transaction and wake up the threads waiting for them.
+        """
+        byVar = self.opsByVar(tx)
+        for varId in sorted(byVar, key=keyOrder):
+            with self.latches[varId]:
+                for op in byVar[varId]:
+                    for siteId in self.varSite[varId]:
+                        self.sites[siteId].ReleaseLock(op.lock)
+                self.notifyWaiters(varId)
+        if tx.ranges:
+            for site in self.sites.values():
+                site.ReleaseRangeLocks(tx.txId)
+            # wake up the writes waiting inside the ranges
+            for low, high in tx.ranges:
+                for varId in self.keysInRange(low, high):
+                    with self.latches[varId]:
+                        if self.queues[varId]:
+                            self.notifyWaiters(varId)
+
+    def forget(self, tx, reason=None):
+        """Count an ended transaction, delete it from the graph and the transaction maps
+        and release its locks.
+
+        INPUT:
+            tx(the transaction), reason(why it aborted, None - it committed)
+        """
+        with self.txLatch:
+            if reason is None:
+                self.countCommit()
+            else:
+                self.countAbort(reason)
+        with self.graphLatch:
+            self.graph.deleteVertex(tx.txId)
+        self.unlock(tx)
+        with self.txLatch:
+            self.transactions.pop(tx.txId)
+            self.txSite.pop(tx.txId)
+            self.states.pop(tx.txId)
+
+    def abortTx(self, tx, reason):
+        """Abort a transaction from its own client thread.
+
+        INPUT:
+            tx(the transaction), reason(why it aborts)
+        """
+        with self.txLatch:
+            self.countWasted(tx)
+        self.finish(tx, False)
+        if reason == 'end':
+            print("T{} aborted because it failed to get all required locks to work.".format(tx.txId))
+        else:
+            print("T{} aborted due to {}".format(tx.txId, reason))
+        self.forget(tx, reason)
+
+    def endTx(self, txId):
+        """End a transaction: commit it unless it must abort.
+        Everything is printed before its locks are released, so the output of the
+        threads waiting for them comes after.
+
+        INPUT:
+            txId(transaction id)
+        OUTPUT:
+            True - commit, False - abort
+        """
+        self.advanceClock()
+        tx, state = self.lookup(txId)
+        if tx is None:
+            return False
+        if state.victim:
+            self.abortTx(tx, state.victim)
+            return False
+        with state.latch:
+            failed = tx.abort
+        if failed:
+            print("T{} Aborted because it accessed site {} and it failed later.".format(txId, tx.accessedFailedSite))
+            with self.txLatch:
+                self.countWasted(tx)
+            self.finish(tx, False)
+            self.forget(tx, 'end')
+            return False
+        commit = self.finish(tx, True)
+        if commit:
+            for op in tx.ops:
+                if op.opType == 'write':
+                    print("T{} wrote {} to variable {} to sites {}.".format(op.txId, op.val, op.varId, op.locks))
+            print("T{} Committed".format(txId))
+        self.forget(tx, None if commit else 'end')
+        return commit
+
+    def allLatches(self):
+        """Take the latches of all variables in ascending index.
+
+        OUTPUT:
+            an ExitStack releasing them on exit
+        """
+        stack = ExitStack()
+        stack.enter_context(self.keyLatch)
+        for varId in sorted(self.latches, key=keyOrder):
+            stack.enter_context(self.latches[varId])
+        return stack
+
+    def failOp(self, siteId):
+        """Fail a site: transactions which accessed it will abort at the end.
+        INPUT: site id.
+        """
+        self.advanceClock()
+        if siteId not in self.sites:
+            print("Site {} does not exist.".format(siteId))
+            return
+        with self.allLatches():
+            with self.txLatch:
+                running = [(self.transactions[txId], self.states[txId]) for txId in self.transactions]
+            for tx, state in running:
+                with state.latch:
+                    if siteId in self.txSite[tx.txId]:
+                        tx.abort = True
+                        tx.accessedFailedSite.append(siteId)
+                        for op in tx.ops:
+                            if siteId in op.locks:
+                                op.locks.remove(siteId)
+            self.sites[siteId].fail()
+            # its locks are gone, waiters may go on
+            for varId in self.sites[siteId].variable_list:
+                self.notifyWaiters(varId)
+        print("Site {} failed.".format(siteId))
+
+    def recoverOp(self, siteId):
+        """Recover a site and wake up the operations waiting for its variables.
+        INPUT: site id.
+        """
+        self.advanceClock()
+        if siteId not in self.sites:
+            print("Site {} does not exist.".format(siteId))
+            return
+        with self.allLatches():
+            site = self.sites[siteId]
+            if site.status != "fail":
+                print("Site does not fail.")
+                return
+            site.recover()
+            for varId in site.variable_list:
+                self.notifyWaiters(varId)
+        print("Site {} recovered.".format(siteId))
+
+    def dumpOp(self, dumpsites=None):
+        """Print all the variables on the given (default all) sites.
+        """
+        self.advanceClock()
+        with self.allLatches():
+            for siteId in sorted(dumpsites or self.sites):
+                self.sites[siteId].dump_all()
+
+    def snapshot(self, time=None):
+        """Committed state of all sites at a logical tick, taken holding every latch.
+        """
+        with self.allLatches():
+            with self.txLatch:
+                commitTimes = list(self.commitTimes)
+            return snapshot.collect(self.sites, None if time is None else snapshot.cutoffTime(commitTimes, time))
+
+    def summary(self):
+        with self.txLatch:
+            return super().summary()
+
+
+class Sessions:
+    """Sessions runs every transaction of a command file on its own client thread.
+    After handing a command to a thread, it waits until the command is done or the thread
+    is blocked on a lock, so the output follows the order of the commands.
+    args:
+        manager: the ConcurrentTransactionManager
+        workers: command queue of each transaction's thread (txId: Queue)
+        pending: commands handed to each thread and not done yet (txId: number)
+        blocked: transactions whose thread waits for a lock
+        progress: condition notified when a command is done or a thread blocks
+        transactions: running transactions of the manager
+        errors: exceptions raised by commands in client threads, re-raised by settle
+    """
+    def __init__(self, manager):
+        self.manager = manager
+        self.manager.onBlocked = self.setBlocked
+        self.workers = dict()
+        self.pending = dict()
+        self.blocked = set()
+        self.progress = threading.Condition()
+        self.transactions = manager.transactions
+        self.errors = list()
+
+    def setBlocked(self, txId, blocked):
+        with self.progress:
+            if blocked:
+                self.blocked.add(txId)
+            else:
+                self.blocked.discard(txId)
+            self.progress.notify_all()
+
+    def work(self, txId, commands):
+        """Client thread of a transaction: run its commands until it ends.
+        """
+        while True:
+            command = commands.get()
+            if command is None:
+                return
+            method, args = command
+            try:
+                method(*args)
+            except Exception as e:
+                # the thread keeps serving its transaction, the caller gets the error from settle
+                with self.progress:
+                    self.errors.append(e)
+            finally:
+                with self.progress:
+                    self.pending[txId] -= 1
+                    self.blocked.discard(txId)
+                    self.progress.notify_all()
+
+    def settle(self):
+        """Wait until every thread is idle or blocked on a lock,
+        then raise the first exception a command raised in its thread since the last settle.
+        """
+        with self.progress:
+            self.progress.wait_for(lambda: all(
+                count == 0 or txId in self.blocked for txId, count in self.pending.items()))
+            errors = self.errors
+            self.errors = list()
+        if errors:
+            raise errors[0]
+
+    def submit(self, txId, method, *args):
+        """Hand a command to a transaction's thread and wait for it to settle.
+        """
+        if txId not in self.workers:
+            return
+        with self.progress:
+            self.pending[txId] += 1
+        self.workers[txId].put((method, args))
+        self.settle()
+
+    def startTx(self, txType, txId, priority=0, mode=None, declared=None, timeout=None):
+        if mode not in (None, '2PL') or declared:
+            # checked before a client thread is started for the transaction
+            raise ValueError("Concurrent mode only runs 2PL transactions which lock incrementally")
+        if timeout is not None:
+            raise ValueError("Concurrent mode has no lock-wait timeouts")
+        commands = Queue()
+        self.workers[txId] = commands
+        self.pending[txId] = 0
+        threading.Thread(target=self.work, args=(txId, commands), daemon=True).start()
+        self.submit(txId, self.manager.startTx, txType, txId, priority)
+
+    def readOp(self, txId, varId, update=False):
+        self.submit(txId, self.manager.readOp, txId, varId, update)
+
+    def writeOp(self, txId, varId, value):
+        self.submit(txId, self.manager.writeOp, txId, varId, value)
+
+    def batchOp(self, txId, statements):
+        self.submit(txId, self.manager.batchOp, txId, statements)
+
+    def rangeOp(self, txId, low, high):
+        self.submit(txId, self.manager.rangeOp, txId, low, high)
+
+    def endTx(self, txId):
+        if txId in self.blocked:
+            # like the waitlist, a transaction still waiting for a lock at its end aborts
+            self.manager.cancel(txId)
+        self.submit(txId, self.manager.endTx, txId)
+        if txId in self.workers:
+            self.workers.pop(txId).put(None)
+            self.pending.pop(txId)
+
+    def failOp(self, siteId):
+        self.manager.failOp(siteId)
+        self.settle()
+
+    def recoverOp(self, siteId):
+        self.manager.recoverOp(siteId)
+        self.settle()
+
+    def addSite(self, siteId):
+        self.manager.addSite(siteId)
+
+    def removeSite(self, siteId):
+        self.manager.removeSite(siteId)
+
+    def dumpOp(self, dumpsites=None):
+        self.manager.dumpOp(dumpsites)
+
+    def exportOp(self, path, time=None):
+        self.manager.exportOp(path, time)
+
+    def checkpointOp(self, path):
+        # client threads and latches can't be saved
+        print("Checkpoints are not supported in concurrent mode.")
+
+    def summary(self):
+        return self.manager.summary()
@@ -16,8 +16,38 @@ Contribution of authors:
 The details of methods are specified below every definition of them.
 """
 from graph import Graph
-from components import Site, Variable, Lock, Operation, Transaction, debugMode
+from placement import HashRing, ringHash
+from keyindex import keyOrder
+from granularity import rangeOf, SITE
+import victims
+import snapshot
+import checkpoint
+from timerwheel import TimerWheel
+from components import Site, Operation, Transaction, Lock, conflicts, debugMode
+import time
 from datetime import datetime
+from bisect import bisect_right
+from collections import deque, Counter
+
+def waitPercentiles(waits):
+    """Summarize lock waits (nearest rank percentiles).
+
+    INPUT:
+        waits(Counter of wait time: number of waits)
+    OUTPUT:
+        dict of count, p50, p99, p999 and max
+    """
+    ranked = sorted(waits.items())
+    count = sum(waits.values())
+    def percentile(p):
+        rank = min(count - 1, int(p * count))
+        for wait, n in ranked:
+            if rank < n:
+                return wait
+            rank -= n
+    return {'count': count, 'p50': percentile(0.5), 'p99': percentile(0.99),
+            'p999': percentile(0.999), 'max': ranked[-1][0]}
+
 
 class TransactionManager:
     """Transaction manager takes care of operation execution.
@@ -30,8 +60,133 @@ class TransactionManager:
                 when a site fails, abort all txs which accessed it
         graph: graph for deadlock check
         waitlist: list of operations which haven't got required lock yet
+        scheduling: order in which a released lock is granted to waiting ops, 'fifo', 'priority'
+                    (transaction priority class) or 'age' (priority rising with wait time, see queueOf)
+        agingTicks: under age scheduling, ticks of waiting worth one priority level
+        lockWaits: how many ops granted their locks waited each number of ticks, by priority class
+                   (an op granted at once counts as a wait of 0)
+        lockTimeout: how long an op of a 2PL transaction may wait for a lock (None - no limit),
+                     a transaction begun with its own timeout overrides it
+        timeoutClock: unit of the timeouts, 'ticks' (logical clock) or 'wall' (milliseconds)
+        timeoutAction: what a timed out op does, 'abort' its transaction or 'retry': step out of the
+                       lock queue for a backoff doubling at each timeout, abort after TIMEOUT_RETRIES retries
+        timers: timer wheel of the pending timeouts and retries (see timerwheel.py)
+        policy: how deadlocks are handled when an op can't get its lock
+                'detection' (waits-for graph, abort the youngest in a cycle),
+                'wait-die', 'wound-wait' or 'no-wait' (decided by start order, no graph)
+        defaultMode: concurrency control of RW transactions started without one:
+                     '2PL', 'OCC' or 'SI' (snapshot isolation)
+        deferredUpdates: 2PL transactions keep their writes in a private buffer until commit
+                         (locks are still taken when they write), instead of writing the replicas at once
+        victimPolicy: how the transaction to abort in a deadlock is chosen (see victims.py)
+        detectEvery: under detection, look for deadlocks every detectEvery blocked ops (None - on every
+                     one, unless detectTicks is set, then blocked ops aren't counted)
+        detectTicks: under detection, also look for deadlocks every detectTicks logical ticks (None - never)
+        clock: logical clock, advanced by one on every operation submitted to the manager
+        catchupBatch: replicated variables of recovered sites brought up to date per tick (0 - never,
+                      they stay unreadable until a transaction commits a write to them)
+        catchupQueue: (siteId, varId) of recovered replicas waiting to be caught up
+        replication: 'available-copies' (read one, write all available replicas)
+                     or 'quorum' (read R and write W replicas, the newest version wins)
+        quorums: (R, W) of each variable class under quorum replication
+                 ('replicated': even indexed variables, 'single': odd indexed ones), majorities by default
+        placement: 'fixed' (odd indexed variables at site index % 10 + 1, even ones at every site)
+                   or 'ring' (consistent hashing, sites can be added and removed at runtime)
+        replicationFactor: under ring placement, number of sites storing each even indexed variable
+        ring: the consistent hash ring under ring placement
+        migrations: deque of variables waiting to move to the sites the ring assigns them
+        migrationBatch: variables moved per tick
+        peers: other transaction managers sharing the same sites (see coordinator.py)
+        escalateAfter: multi-granularity locking, a transaction's locks in one key range of a site
+                       (or key ranges locked in a site) above which they are escalated to one lock
+                       on the range (or the site), None - variable locks only
+        pendingStarts: transactions waiting to start, in arrival order: RW transactions above the
+                       admission cap and ones with declared read and write sets waiting to get all their locks
+        maxActive: admission control, most RW transactions running at once (None - no cap);
+                   RO transactions are never held back
+        adaptiveAdmission: lower the cap below maxActive while many transactions abort or ops wait,
+                           and raise it back as they commit (see adjustAdmission)
+        activeCap: the current cap
+        running: ids of the RW transactions admitted under the cap
+        recentEnds: whether each of the last RW transactions to end committed, for adaptive admission
+        commitTimes: (tick, time) of the last commit made at each logical tick, to export snapshots at a tick,
+                     since the lastest one at least historyTicks ago
+        historyTicks: ticks of commit history kept for exports of past ticks, None - all of it;
+                      older commits are dropped once no running transaction can read them
+        stats: number of commits and aborts (by reason) used to measure throughput and abort rate,
+               and the work discarded by aborts (executed ops, locks held, undo work)
     """
-    def __init__(self):
+    POLICIES = ('detection', 'wait-die', 'wound-wait', 'no-wait')
+    MODES = ('2PL', 'OCC', 'SI')
+    REPLICATIONS = ('available-copies', 'quorum')
+    PLACEMENTS = ('fixed', 'ring')
+    SCHEDULINGS = ('fifo', 'age', 'priority')
+    TIMEOUT_CLOCKS = ('ticks', 'wall')
+    TIMEOUT_ACTIONS = ('abort', 'retry')
+    # lock-wait timeouts an op retries after before its transaction aborts
+    TIMEOUT_RETRIES = 3
+    # adaptive admission: RW transactions ended remembered, share of them aborted above which the cap shrinks
+    ADMISSION_WINDOW = 20
+    ABORT_TARGET = 0.2
+
+    def __init__(self, policy='detection', detectEvery=None, detectTicks=None, victimPolicy='youngest',
+                 defaultMode='2PL', catchupBatch=0, replication='available-copies', quorums=None,
+                 placement='fixed', replicationFactor=3, vnodes=64, migrationBatch=1, deferredUpdates=False,
+                 scheduling='fifo', agingTicks=10, escalateAfter=None, maxActive=None, adaptiveAdmission=False,
+                 historyTicks=1000, lockTimeout=None, timeoutClock='ticks', timeoutAction='abort'):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown concurrency policy: {}".format(policy))
+        if defaultMode not in self.MODES:
+            raise ValueError("Unknown concurrency control mode: {}".format(defaultMode))
+        self.defaultMode = defaultMode
+        self.deferredUpdates = deferredUpdates
+        if scheduling not in self.SCHEDULINGS:
+            raise ValueError("Unknown lock scheduling: {}".format(scheduling))
+        if agingTicks < 1:
+            raise ValueError("Aging interval must be positive")
+        self.scheduling = scheduling
+        self.agingTicks = agingTicks
+        if escalateAfter is not None and escalateAfter < 1:
+            raise ValueError("Lock escalation threshold must be positive")
+        self.escalateAfter = escalateAfter
+        if maxActive is not None and maxActive < 1:
+            raise ValueError("Admission cap must be positive")
+        if adaptiveAdmission and maxActive is None:
+            raise ValueError("Adaptive admission needs a cap to start from")
+        self.maxActive = maxActive
+        self.adaptiveAdmission = adaptiveAdmission
+        self.activeCap = maxActive
+        self.running = set()
+        self.recentEnds = deque(maxlen=self.ADMISSION_WINDOW)
+        # lock waits of granted ops in ticks (priority class: Counter of waits)
+        self.lockWaits = dict()
+        if historyTicks is not None and historyTicks < 0:
+            raise ValueError("Commit history kept can't be negative")
+        self.historyTicks = historyTicks
+        if lockTimeout is not None and lockTimeout < 1:
+            raise ValueError("Lock timeout must be positive")
+        if timeoutClock not in self.TIMEOUT_CLOCKS:
+            raise ValueError("Unknown timeout clock: {}".format(timeoutClock))
+        if timeoutAction not in self.TIMEOUT_ACTIONS:
+            raise ValueError("Unknown timeout action: {}".format(timeoutAction))
+        self.lockTimeout = lockTimeout
+        self.timeoutClock = timeoutClock
+        self.timeoutAction = timeoutAction
+        if victimPolicy not in victims.NAMES:
+            raise ValueError("Unknown victim policy: {}".format(victimPolicy))
+        self.victimPolicy = victimPolicy
+        if (detectEvery is not None and detectEvery < 1) or (detectTicks is not None and detectTicks < 1):
+            raise ValueError("Deadlock detection interval must be positive")
+        self.policy = policy
+        self.detectEvery = detectEvery
+        self.detectTicks = detectTicks
+        # blocked ops since the last deadlock check, tick of the last check
+        self.blockedSinceCheck = 0
+        self.lastCheck = 0
+        self.clock = 0
+        self.timers = TimerWheel(self.timerNow())
+        self.catchupBatch = catchupBatch
+        self.catchupQueue = deque()
         # 10 sites (site index: )
         self.sites = dict() 
         # varSite (variable index: list of site indexes where it's stored)
@@ -46,27 +201,93 @@ class TransactionManager:
         self.graph = Graph()
         # list of operations which haven't got required lock yet
         self.waitlist = list()
-        # odd indexed variables are at one site each
-        # even indexed variables are at all sites
+        self.peers = list()
+        self.pendingStarts = list()
+        self.admitting = False
+        # commits and aborts (reason: count) since the manager was created
+        self.stats = {'commit': 0, 'abort': dict(), 'wasted': {'ops': 0, 'locks': 0, 'undo': 0}}
+        self.created = datetime.now()
+        if placement not in self.PLACEMENTS:
+            raise ValueError("Unknown placement: {}".format(placement))
+        self.placement = placement
+        self.replicationFactor = 10 if placement == 'fixed' else replicationFactor
+        self.ring = None
+        self.migrations = deque()
+        self.migrationBatch = migrationBatch
+        if placement == 'ring':
+            self.ring = HashRing(range(1, 11), vnodes)
         for varIndex in range(1, 21):
-            self.varSite[varIndex] = list()
-            if varIndex % 2 == 0:
-                for j in range(1, 11):
-                    self.varSite[varIndex].append(j)
-            else:
-                self.varSite[varIndex].append(varIndex % 10 + 1)
-        for siteIndex in range(1, 11):
-            self.sites[siteIndex] = Site(siteIndex) # initialize the sites
+            self.varSite[varIndex] = self.placeKey(varIndex)
+        if placement == 'ring':
+            for siteIndex in range(1, 11):
+                stored = [varIndex for varIndex in range(1, 21) if siteIndex in self.varSite[varIndex]]
+                self.sites[siteIndex] = Site(siteIndex, stored, escalateAfter)
+        else:
+            for siteIndex in range(1, 11):
+                self.sites[siteIndex] = Site(siteIndex, escalate_after=escalateAfter) # initialize the sites
+        # the initial values count as committed at tick 0
+        self.commitTimes = [(0, datetime.now())]
+        if replication not in self.REPLICATIONS:
+            raise ValueError("Unknown replication: {}".format(replication))
+        self.replication = replication
+        majority = self.replicationFactor // 2 + 1
+        self.quorums = {'replicated': (majority, majority), 'single': (1, 1)}
+        self.quorums.update(quorums or {})
+        for varClass, (r, w) in self.quorums.items():
+            n = self.replicationFactor if varClass == 'replicated' else 1
+            if not (0 < r <= n and 0 < w <= n and r + w > n and 2 * w > n):
+                raise ValueError("Quorums of {} variables need R + W > {} and 2W > {}".format(varClass, n, n))
 
-    def startTx(self, txType, txId):
+    def startTx(self, txType, txId, priority=0, mode=None, declared=None, timeout=None):
         """Start a transaction
         INPUT: 
             txType (transaction type: RW/RO), txId (transaction id)
+            priority (used by the priority victim policy, lower aborts first)
+            mode (concurrency control of a RW transaction: 2PL/OCC/SI, default self.defaultMode)
+            declared (variable: 'read' or 'write', every variable a 2PL transaction will access;
+                      it then runs under conservative 2PL, see lockDeclared)
+            timeout (how long each of its ops may wait for a lock, default self.lockTimeout;
+                     only 2PL RW transactions wait for locks, OCC and SI ones validate instead)
         """
+        if timeout is not None and timeout < 1:
+            raise ValueError("Lock timeout must be positive")
+        if timeout is not None and (txType != 'RW' or (mode or self.defaultMode) != '2PL'):
+            raise ValueError("Only 2PL RW transactions wait for locks, a lock timeout doesn't apply to T{}".format(txId))
+        self.advanceClock()
         print('Start T{}'.format(txId))
         self.transactions[txId] = Transaction(txId, txType)
-        self.graph.insertVertex(txId)
+        self.transactions[txId].priority = priority
+        self.transactions[txId].timeout = timeout
+        if txType == 'RW':
+            self.transactions[txId].mode = mode or self.defaultMode
+            self.transactions[txId].buffered = self.deferredUpdates and self.transactions[txId].mode == '2PL'
         self.txSite[txId] = set()
+        tx = self.transactions[txId]
+        if declared:
+            if txType != 'RW' or tx.mode != '2PL':
+                raise ValueError("Only 2PL RW transactions can declare their read and write sets")
+            for varId in declared:
+                self.ensureKey(varId)
+            tx.declared = dict(declared)
+        if txType == 'RW' and self.maxActive is not None:
+            if len(self.running) >= self.activeCap or any(t.txId not in self.running for t in self.pendingStarts):
+                # above the cap, or behind others which are
+                if debugMode:
+                    print("T{} waits for admission".format(txId))
+                tx.deferred = list()
+                self.pendingStarts.append(tx)
+                return
+            self.running.add(txId)
+        if declared:
+            # a declared transaction never waits once it runs, so it never enters the graph
+            if not self.lockDeclared(tx):
+                if debugMode:
+                    print("T{} waits for its declared locks".format(txId))
+                tx.deferred = list()
+                self.pendingStarts.append(tx)
+            return
+        if self.policy == 'detection':
+            self.graph.insertVertex(txId)
 
     def endTx(self, txId):
         """End a transaction: commit or abort
@@ -82,13 +303,28 @@ class TransactionManager:
         OUTPUT: 
             True - commit, False - abort
         """
+        self.advanceClock()
+        if txId not in self.transactions:
+            # aborted by the periodic deadlock check
+            return False
         if debugMode:
             print("Try to end transaction ", txId)
         tx = self.transactions[txId]
+        if not self.admitted(tx, ('end',)):
+            return False
+        if tx.mode == 'OCC':
+            return self.endOCC(tx)
         # check if the transaction aborted previously (due to site failure or deadlock)
+        reason = 'end'
         if tx.abort:
             print("T{} Aborted because it accessed site {} and it failed later.".format(txId, tx.accessedFailedSite))
             commit = False
+            reason = 'site failure'
+        elif tx.mode == 'SI' and any(self.committedSince(varId, tx.startTime) for varId in tx.writeSet):
+            # first committer wins
+            print("T{} aborted because a variable it wrote was committed after it began.".format(txId))
+            commit = False
+            reason = 'validation'
         else:
             commit = True
             for op in tx.ops:
@@ -99,20 +335,28 @@ class TransactionManager:
                     break
                   
         # all ops executed, commit them all
+        written = [op for op in tx.ops if op.opType == 'write']
         if commit:
             for op in tx.ops:
+                if tx.buffered and op.opType == 'write':
+                    continue
+                version = self.commitVersion(op)
                 for siteId in op.locks:
-                    if not self.sites[siteId].commit(op, tx):
+                    if not self.sites[siteId].commit(op, tx, version):
                         if debugMode:
                             print("Site {} commit failed".format(siteId))
                         commit = False
                         break
                 if not commit:
                     break
+            if commit and tx.buffered:
+                written = self.installWrites(tx)
+                commit = written is not None
         else:
-            # if tx aborts, undo all the write operations
+            self.countWasted(tx)
+            # if tx aborts, undo all the write operations (buffered ones never reached the sites)
             for op in tx.ops:
-                if op.opType == 'write' and op.exec:
+                if op.opType == 'write' and op.exec and not tx.buffered:
                     for siteId in op.locks:
                         self.sites[siteId].undo(op)
             # if tx aborts, remove all the ops in the waitlist            
@@ -122,38 +366,46 @@ class TransactionManager:
                     waitingOps.append(op)
             for op in waitingOps:
                 self.waitlist.remove(op)
+                self.stopTimer(op)
         if commit:
-            for op in tx.ops:
-                if op.opType == 'write':
-                    print("T{} wrote {} to variable {} to sites {}.".format(op.txId, op.val, op.varId, op.locks))
+            for op in written:
+                print("T{} wrote {} to variable {} to sites {}.".format(op.txId, op.val, op.varId, op.locks))
         # release all the locks
         accessedVar = set()
         for op in tx.ops:
-            lock = Lock(txId, op.varId, op.opType)
+            lock = op.lock
             if debugMode:
                 print("Operation is holding lock on ", op.locks)
             for siteId in op.locks:
                 self.sites[siteId].ReleaseLock(lock)
             accessedVar.add(op.varId)
+        accessedVar |= self.releaseDeclared(tx)
+        accessedVar |= self.releaseRanges(tx)
+        accessedVar |= self.releaseCoarse(tx)
         for var in accessedVar:
             if debugMode:
                 print("Finding ops waiting for variable ", var)
                 print("Start executing waitlist.")
             self.execWaitlist(var)              
-        op.locks = list()           
         # delete the tx from self.transactions
         self.transactions.pop(txId)
+        self.leave(tx, commit)
         # delete the tx from self.txSite
         self.txSite.pop(txId)
         # delete the tx from self.graph
-        self.graph.deleteVertex(txId)
+        self.dropVertex(txId)
         if commit:
             print("T{} Committed".format(txId))
+            self.countCommit()
+        else:
+            self.countAbort(reason)
+        for tm in [self] + self.peers:
+            tm.admitDeclared()
         # else:
         #     print("T{} Aborted".format(txId))
         return commit
     
-    def execWaitlist(self, varId):
+    def execWaitlist(self, varId, notify=True):
         """Execute operations in the waitlist if possible
         Apply a recently-released lock to the first operation needed it in the waitlist
         then execute the operation, if there's any
@@ -164,13 +416,27 @@ class TransactionManager:
         
         INPUT:
             varId(index of the variable whose lock could be assigned to an op in the waitlist)
+            notify(True - let peer managers execute their waitlists for the variable too)
         """
+        if notify and self.peers:
+            # the manager whose op waited longest goes first, so locks are granted in global order
+            first = lambda tm: min((op.opId for op in tm.waitlist if op.varId == varId), default=float('inf'))
+            for tm in sorted([self] + self.peers, key=first):
+                tm.execWaitlist(varId, False)
+            return
         execAgain = False
-        for op in self.waitlist:
+        for op in self.queueOf(varId):
             if op.varId == varId:
                 # the first op in the waitlist waiting for the lock
                 getLock = True # if failed to acquire a lock (site not fail and has the variable, i.e. lock is hold by other op)
                 tx = self.transactions[op.txId]
+                if tx.mode != '2PL' and op.opType == 'read':
+                    # optimistic and snapshot reads don't lock, they wait for a replica to read from
+                    if self.readView(op, tx):
+                        self.waitlist.remove(op)
+                        execAgain = True
+                        break
+                    continue
                 if tx.txType == 'RW':
                     # try to get locks from all sites except for failed ones
                     getLock = self.acquireLock(op, True)
@@ -179,24 +445,15 @@ class TransactionManager:
                         if debugMode:
                             print("All locks acquired, try to execute operation {} variable {} value {}".format(op.opType, op.varId, op.val))
                         if op.opType == 'read':
-                            for siteId in op.locks:
-                                if self.sites[siteId].execute(op, tx):
-                                    op.exec = True
-                                    break
+                            self.executeRead(op, tx)
                         else:
-                            executed = True
-                            for siteId in op.locks:
-                                if not self.sites[siteId].execute(op, tx):
-                                    executed = False
-                                    break
-                            if executed:
-                                op.exec = True
+                            self.executeWrite(op, tx)
                 else:
                     # the first operation in the waitlist is from RO tx
                     # just execute it
                     if debugMode:
                         print("Operation belongs to tx {}, which is read-only, no need to acquire lock.".format(tx.txId))
-                    for siteId in self.varSite[op.varId]:
+                    for siteId in self.snapshotSites(op.varId, tx.startTime):
                         if self.sites[siteId].execute(op, tx):
                             op.exec = True
                             break
@@ -209,11 +466,12 @@ class TransactionManager:
                 if op.exec:
                     # op executed, remove it from the waitlist
                     self.waitlist.remove(op)
+                    self.stopTimer(op)
                     # no need to update the graph                        
                     # add the site which this op accessed into its site map
                     for siteId in op.locks:
                         self.txSite[op.txId].add(siteId)
-                    for waitOp in self.waitlist:
+                    for waitOp in self.queueOf(varId):
                         if waitOp.varId == varId:
                             if op.opType == 'read':
                                 if waitOp.opType == 'read' or waitOp.txId == op.txId:
@@ -230,71 +488,53 @@ class TransactionManager:
                         break
                     break
         if execAgain:
-            self.execWaitlist(varId)
+            self.execWaitlist(varId, False)
 
-    def readOp(self, txId, varId):
+    def readOp(self, txId, varId, update=False):
         """Read the value of a variable
         If the op can require its lock immediately, execute it
         Else add the op into waitlist
 
         INPUT: 
             txId(transaction id), varId(index of the variable which the operation wants to access)
+            update(True - a 2PL transaction reads under an update lock, its later write
+                   of the variable upgrades it in place)
         """
-        op = Operation(txId, 'read', varId)
+        self.advanceClock()
+        if txId not in self.transactions:
+            # aborted by the periodic deadlock check
+            return
         tx = self.transactions[txId]
+        if not self.admitted(tx, ('R', varId, update)):
+            return
+        self.ensureKey(varId)
+        op = Operation(txId, 'read', varId)
+        if update and tx.declared is None:
+            op.lockType = 'update'
         tx.addOp(op)
         getLock = True
         # try to acquire lock
+        if tx.mode != '2PL':
+            # read from the transaction's private view or snapshot
+            if not self.readView(op, tx):
+                self.enqueue(op)
+            return
         if self.transactions[txId].txType == 'RW':
             getLock = self.acquireLock(op)
             if getLock and len(op.locks) > 0:
                 # lock acquired, try to execute it
-                for siteId in op.locks:
-                    if self.sites[siteId].execute(op, tx):
-                        op.exec = True
-                        self.txSite[op.txId].add(siteId)
-                        break
+                siteId = self.executeRead(op, tx)
+                if siteId is not None:
+                    self.txSite[op.txId].add(siteId)
         else:
             # execute RO operations immediately
-            for siteId in self.varSite[op.varId]:
+            for siteId in self.snapshotSites(op.varId, tx.startTime):
                 if self.sites[siteId].execute(op, tx):
                     op.exec = True
                     break
         # if the operation is not executed, add it to the waitlist
         if not op.exec:
-            self.waitlist.append(op) 
-            # update the graph-------------------------------------------------------------
-            updated = False
-            for waitOp in reversed(self.waitlist):
-                # op.tx is waiting for waitOp.tx
-                if waitOp.varId == op.varId and waitOp.txId != op.txId:
-                    self.graph.addEdge(op.txId, waitOp.txId)
-                    updated = True
-                    break
-            if not updated:
-                # there's no operation from different tx waiting for the same lock
-                # the op is waiting for the lock's current holder(s)
-                for siteId in self.varSite[op.varId]:
-                    for lockHolder in self.sites[siteId].lock_table[op.varId]:
-                        self.graph.addEdge(op.txId, lockHolder.transaction_id)
-            # check deadlock
-            txCycle = self.graph.detectCycle()
-            while txCycle:
-                if len(txCycle) > 1:
-                    # find the youngest transaction
-                    youngest = txCycle[0].vId
-                    if debugMode:
-                        print("Deadlock detected: ", txCycle)
-                    for t in txCycle:
-                        if self.transactions[t.vId].startTime > self.transactions[youngest].startTime:
-                            youngest = t.vId
-                    # abort the youngest
-                    self.abort(self.transactions[youngest]) 
-                    txCycle = self.graph.detectCycle()
-                else:
-                    if debugMode:
-                        print("No deadlock detected!")
-                    break           
+            self.blockOp(op)
 
     def writeOp(self, txId, varId, value):
         """Write the value to a variable
@@ -304,58 +544,1103 @@ class TransactionManager:
         INPUT: 
             txId(transaction id), varId(index of variable which operation wants to access)
         """
-        op = Operation(txId, 'write', varId, value)
+        self.advanceClock()
+        if txId not in self.transactions:
+            # aborted by the periodic deadlock check
+            return
         tx = self.transactions[txId]
+        if not self.admitted(tx, ('W', varId, value)):
+            return
+        self.ensureKey(varId)
+        op = Operation(txId, 'write', varId, value)
         tx.addOp(op)
+        if tx.mode == 'OCC':
+            # buffer the write until commit
+            tx.writeSet[varId] = value
+            op.exec = True
+            return
         # try to acquire lock
         getLock = self.acquireLock(op)
         if getLock and len(op.locks) > 0:
             # lock acquired, try to execute it
-            executed = True
-            for siteId in op.locks:
-                if not self.sites[siteId].execute(op, tx):
-                    executed = False
-                    break
-            if executed:
-                op.exec = True
+            if self.executeWrite(op, tx):
                 for siteId in op.locks:
                     self.txSite[op.txId].add(siteId)
         # if the operation is not executed, add it to the waitlist
         if not op.exec:
-            self.waitlist.append(op) 
-            # update the graph
-            updated = False
-            for waitOp in reversed(self.waitlist):
-                # op.tx is waiting for waitOp.tx
-                if waitOp.varId == op.varId and waitOp.txId != op.txId:
-                    self.graph.addEdge(op.txId, waitOp.txId)
-                    updated = True
-                    break
-            if not updated:
-                # there's no operation from different tx waiting for the same lock
-                # the op is waiting for the lock's current holder(s)
-                for siteId in self.varSite[op.varId]:
-                    for lockHolder in self.sites[siteId].lock_table[op.varId]:
-                        self.graph.addEdge(op.txId, lockHolder.transaction_id)
-            # check deadlock
-            txCycle = self.graph.detectCycle()
-            while txCycle:
-                if len(txCycle) > 1:
-                    # find the youngest transaction
-                    youngest = txCycle[0].vId
+            self.blockOp(op)
+
+    def executeRead(self, op, tx):
+        """Execute a RW read holding its locks.
+        A transaction with buffered writes reads its own write of the variable from the buffer.
+
+        INPUT:
+            op(read operation), tx(transaction it belongs to)
+        OUTPUT:
+            index of the site read, None - no locked replica can serve it
+        """
+        if tx.buffered and op.varId in tx.writeSet:
+            siteId = self.readSites(op)[0]
+            print("T{} read variable {} on site{} returns {}.".format(tx.txId, op.varId, siteId, tx.writeSet[op.varId]))
+            op.exec = True
+            self.recordWait(op, tx)
+            return siteId
+        for siteId in self.readSites(op):
+            if self.sites[siteId].execute(op, tx):
+                op.exec = True
+                self.recordWait(op, tx)
+                return siteId
+        return None
+
+    def executeWrite(self, op, tx):
+        """Execute a RW write holding its locks: on every locked replica,
+        or into the transaction's write buffer if it defers its updates,
+        where a later write of the variable replaces the earlier one.
+
+        INPUT:
+            op(write operation), tx(transaction it belongs to)
+        OUTPUT:
+            True - executed
+        """
+        if tx.buffered:
+            tx.writeSet[op.varId] = op.val
+            op.exec = True
+            self.recordWait(op, tx)
+            return True
+        for siteId in op.locks:
+            if not self.sites[siteId].execute(op, tx):
+                return False
+        op.exec = True
+        self.recordWait(op, tx)
+        if tx.mode == 'SI':
+            # remembered for first-committer-wins and for reading its own writes, once it is written
+            tx.writeSet[op.varId] = op.val
+        return True
+
+    def installWrites(self, tx):
+        """Write and commit the buffered writes of a committing transaction,
+        once per variable, in the order of their last writes, on the replicas
+        the last write of the variable locked.
+
+        INPUT:
+            tx(the committing transaction)
+        OUTPUT:
+            list of the write operations installed, None - a replica failed to commit
+        """
+        lastWrite = dict()
+        for op in tx.ops:
+            if op.opType == 'write':
+                lastWrite[op.varId] = op
+        installs = list()
+        for last in tx.ops:
+            if last.opType != 'write' or lastWrite[last.varId] is not last:
+                continue
+            op = Operation(tx.txId, 'write', last.varId, tx.writeSet[last.varId])
+            op.locks = last.locks
+            version = self.commitVersion(op)
+            for siteId in op.locks:
+                site = self.sites[siteId]
+                if not (site.execute(op, tx) and site.commit(op, tx, version)):
                     if debugMode:
-                        print("Deadlock detected: ", txCycle)
-                    for t in txCycle:
-                        if self.transactions[t.vId].startTime > self.transactions[youngest].startTime:
-                            youngest = t.vId
-                    # abort the youngest
-                    self.abort(self.transactions[youngest]) 
-                    txCycle = self.graph.detectCycle()
+                        print("Site {} commit failed".format(siteId))
+                    return None
+            installs.append(op)
+        return installs
+
+    def readView(self, op, tx):
+        """Execute a read of an OCC or SI transaction without locks.
+        It reads its own buffered write if any, otherwise the value committed
+        before the transaction began on an available replica.
+
+        INPUT:
+            op(read operation), tx(transaction it belongs to)
+        OUTPUT:
+            True - read executed, False - no replica can serve it now
+        """
+        if op.varId in tx.writeSet:
+            print("T{} read variable {} returns {}.".format(tx.txId, op.varId, tx.writeSet[op.varId]))
+            op.exec = True
+            return True
+        for siteId in self.snapshotSites(op.varId, tx.startTime):
+            read, value = self.sites[siteId].read(op.varId, True, tx.startTime)
+            if read:
+                print("T{} read variable {} on site{} returns {}.".format(tx.txId, op.varId, siteId, value))
+                tx.readSet.add(op.varId)
+                op.exec = True
+                return True
+        return False
+
+    def endOCC(self, tx):
+        """End an OCC transaction
+        1. validate: no variable it read got a commit after the transaction began
+        2. lock every available replica of the variables it wrote, without waiting
+        3. install and commit the buffered writes on all of them at once
+        4. release the locks and execute the waitlist
+        The transaction aborts if validation fails, a read is still waiting,
+        or a 2PL transaction holds a conflicting lock.
+
+        INPUT:
+            tx(the OCC transaction)
+        OUTPUT:
+            True - commit, False - abort
+        """
+        txId = tx.txId
+        commit = not any(op in self.waitlist for op in tx.ops)
+        if commit:
+            commit = not any(self.committedSince(varId, tx.startTime) for varId in tx.readSet)
+        installs = list()
+        if commit:
+            for varId in sorted(tx.writeSet, key=keyOrder):
+                op = Operation(txId, 'write', varId, tx.writeSet[varId])
+                installs.append(op)
+                if not self.acquireLock(op, True) or len(op.locks) == 0:
+                    commit = False
+                    break
+        if commit:
+            for op in installs:
+                version = self.commitVersion(op)
+                for siteId in op.locks:
+                    self.sites[siteId].execute(op, tx)
+                    self.sites[siteId].commit(op, tx, version)
+                print("T{} wrote {} to variable {} to sites {}.".format(txId, op.val, op.varId, op.locks))
+        else:
+            self.countWasted(tx)
+        self.waitlist = [op for op in self.waitlist if op.txId != txId]
+        for op in installs:
+            for siteId in op.locks:
+                self.sites[siteId].ReleaseLock(op.lock)
+        for op in installs:
+            self.execWaitlist(op.varId)
+        self.transactions.pop(txId)
+        self.txSite.pop(txId)
+        self.dropVertex(txId)
+        self.leave(tx, commit)
+        if commit:
+            print("T{} Committed".format(txId))
+            self.countCommit()
+        else:
+            print("T{} aborted due to validation".format(txId))
+            self.countAbort('validation')
+        for tm in [self] + self.peers:
+            tm.admitDeclared()
+        return commit
+
+    def committedSince(self, varId, time):
+        """Check if a variable was committed on any available replica after the given time.
+
+        INPUT:
+            varId(index of the variable), time(start time of a transaction)
+        OUTPUT:
+            True - there's a newer committed version
+        """
+        for siteId in self.varSite[varId]:
+            site = self.sites[siteId]
+            if site.status != "fail" and site.variable_list[varId].last_commit_time() > time:
+                return True
+        return False
+
+    def lockDeclared(self, tx):
+        """Conservative 2PL: take all locks of a transaction with declared read and write sets at once.
+        Variables are locked in ascending index on all their available replicas;
+        nothing is locked unless every variable can be.
+
+        INPUT:
+            tx(the transaction)
+        OUTPUT:
+            True - all locks taken, False - a conflicting lock is held or a conflicting op
+            waiting for its lock goes first (see outranked), nothing taken
+        """
+        plan = list()
+        for varId in sorted(tx.declared, key=keyOrder):
+            lockType = tx.declared[varId]
+            if self.outranked(tx, varId, lockType):
+                return False
+            sites = list()
+            for siteId in self.varSite[varId]:
+                site = self.sites[siteId]
+                if site.status == "fail":
+                    continue
+                if lockType == 'read' and site.variable_list[varId].is_recovered and len(self.varSite[varId]) > 1:
+                    # a recovered replica can't be read yet
+                    continue
+                for holder in site.lock_table[varId]:
+                    if holder.transaction_id != tx.txId and conflicts(lockType, holder.lock_type):
+                        return False
+                if lockType == 'read' and site.upgrade_waiting(varId, tx.txId):
+                    return False
+                if site.blockers(varId, tx.txId, lockType):
+                    return False
+                sites.append(siteId)
+            if not sites:
+                return False
+            plan.append((Lock(tx.txId, varId, lockType), sites))
+        for lock, sites in plan:
+            for siteId in sites:
+                self.sites[siteId].ApplyLock(lock, True)
+        return True
+
+    def releaseDeclared(self, tx):
+        """Release the locks a transaction took for its declared read and write sets.
+
+        OUTPUT:
+            set of variables whose locks were released
+        """
+        released = set()
+        if not tx.declared or tx.deferred is not None:
+            return released
+        for varId, lockType in tx.declared.items():
+            lock = Lock(tx.txId, varId, lockType)
+            for siteId in self.varSite[varId]:
+                if self.sites[siteId].ReleaseLock(lock) == 0:
+                    released.add(varId)
+        return released
+
+    def admitted(self, tx, statement):
+        """Check whether a statement of a transaction can run now.
+        A transaction waiting for admission or for its declared locks keeps the statement for later,
+        and a declared one accessing a variable it didn't declare (or writing one declared for read) aborts.
+
+        INPUT:
+            tx(the transaction)
+            statement(('R', varId, update), ('W', varId, value), ('RR', low, high),
+                      ('batch', statements) or ('end',))
+        OUTPUT:
+            True - run it now
+        """
+        if tx.deferred is not None:
+            tx.deferred.append(statement)
+            return False
+        if tx.declared is None:
+            return True
+        accesses = statement[1] if statement[0] == 'batch' else [statement]
+        for access in accesses:
+            if access[0] not in ('R', 'W'):
+                continue
+            declared = tx.declared.get(access[1])
+            if declared is None or (access[0] == 'W' and declared == 'read'):
+                if debugMode:
+                    print("T{} accessed variable {} it did not declare".format(tx.txId, access[1]))
+                self.abort(tx, 'undeclared')
+                return False
+        return True
+
+    def admitDeclared(self):
+        """Start the waiting transactions which can now run, in arrival order: ones admitted
+        under the cap, once declared ones get all their locks too. A transaction's start time
+        is when it runs, not when it began waiting. Then run the statements submitted while they waited.
+        """
+        if self.admitting:
+            return
+        self.admitting = True
+        try:
+            i = 0
+            while i < len(self.pendingStarts):
+                tx = self.pendingStarts[i]
+                if tx.txId in self.transactions and not self.canStart(tx):
+                    i += 1
+                    continue
+                self.pendingStarts.pop(i)
+                deferred, tx.deferred = tx.deferred, None
+                if tx.txId in self.transactions:
+                    # it starts now: its age, snapshot and place in the start order count from here
+                    tx.startTime = datetime.now()
+                    self.transactions[tx.txId] = self.transactions.pop(tx.txId)
+                if debugMode:
+                    print("T{} runs".format(tx.txId))
+                for statement in deferred:
+                    if tx.txId not in self.transactions:
+                        break
+                    if statement[0] == 'R':
+                        self.readOp(tx.txId, *statement[1:])
+                    elif statement[0] == 'W':
+                        self.writeOp(tx.txId, statement[1], statement[2])
+                    elif statement[0] == 'RR':
+                        self.rangeOp(tx.txId, statement[1], statement[2])
+                    elif statement[0] == 'batch':
+                        self.batchOp(tx.txId, statement[1])
+                    else:
+                        self.endTx(tx.txId)
+        finally:
+            self.admitting = False
+
+    def canStart(self, tx):
+        """Check whether a waiting transaction can start: it is admitted if there is room
+        under the cap, and a declared one takes all its locks.
+        """
+        if self.maxActive is not None and tx.txId not in self.running:
+            if len(self.running) >= self.activeCap:
+                return False
+            self.running.add(tx.txId)
+            if tx.declared is None and self.policy == 'detection':
+                self.graph.insertVertex(tx.txId)
+        return tx.declared is None or self.lockDeclared(tx)
+
+    def leave(self, tx, committed):
+        """Take an ended transaction off the admission cap and adapt the cap.
+
+        INPUT:
+            tx(the transaction), committed(whether it committed)
+        """
+        if tx.txId not in self.running:
+            return
+        self.running.discard(tx.txId)
+        if self.adaptiveAdmission:
+            self.recentEnds.append(committed)
+            self.adjustAdmission()
+
+    def adjustAdmission(self):
+        """Adapt the admission cap after a RW transaction ended: shrink it by a quarter when more
+        than ABORT_TARGET of the recent ones aborted or more ops wait for locks than transactions
+        may run, otherwise grow it by one up to maxActive.
+        """
+        aborts = self.recentEnds.count(False)
+        if aborts > self.ABORT_TARGET * len(self.recentEnds) or len(self.waitlist) > self.activeCap:
+            self.activeCap = max(1, self.activeCap - max(1, self.activeCap // 4))
+            # judge the smaller cap by the transactions ending under it
+            self.recentEnds.clear()
+            if debugMode:
+                print("Admission cap lowered to {}".format(self.activeCap))
+        elif self.activeCap < self.maxActive:
+            self.activeCap += 1
+
+    def enqueue(self, op):
+        """Add an operation to the waitlist, remembering when it started waiting.
+        """
+        op.waitStart = self.clock
+        self.waitlist.append(op)
+        self.startTimer(op)
+
+    def queueOf(self, varId):
+        """Operations waiting for a variable, in the order the scheduling policy grants its lock:
+            fifo: arrival order
+            priority: higher transaction priority first, arrival order among equals
+            age: priority raised by one every agingTicks ticks of waiting, so no op starves
+
+        INPUT:
+            varId(index of the variable)
+        OUTPUT:
+            list of operations
+        """
+        queue = [op for op in self.waitlist if op.varId == varId and not op.parked]
+        if self.scheduling == 'fifo' or len(queue) < 2:
+            return queue
+        # sorted is stable, equal ranks keep arrival order
+        return sorted(queue, key=lambda op: self.rank(self.transactions[op.txId], self.clock - op.waitStart))
+
+    def rank(self, tx, waited=0):
+        """Rank of an op in the queue of its variable under the scheduling policy, lower goes first.
+
+        INPUT:
+            tx(transaction of the op), waited(ticks the op has waited, 0 for a new request)
+        """
+        if self.scheduling == 'fifo':
+            return 0
+        if self.scheduling == 'age':
+            return -(tx.priority + waited / self.agingTicks)
+        return -tx.priority
+
+    def outranked(self, tx, varId, lockType):
+        """Check if a new lock request would pass a waiting op in the queue of its variable:
+        an op of another 2PL RW transaction, in this manager or a peer, is kept from the variable by
+        a lock, asks for a lock conflicting with the request and ranks at least as high (an earlier
+        arrival wins a tie). An op waiting for a replica to read from, not for a lock, is passed.
+        A transaction already holding a lock on the variable isn't held back either, it would wait
+        for a waiter waiting for it.
+
+        INPUT:
+            tx(transaction asking), varId(index of the variable), lockType(type of the lock asked for)
+        OUTPUT:
+            True - the request has to queue behind the waiter
+        """
+        sites = [self.sites[siteId] for siteId in self.varSite[varId]]
+        if any(holder.transaction_id == tx.txId for site in sites for holder in site.lock_table.get(varId, ())):
+            return False
+        def lockedOut(waitOp):
+            waitType = waitOp.lock.lock_type
+            return any(holder.transaction_id != waitOp.txId and conflicts(waitType, holder.lock_type)
+                       for site in sites for holder in site.lock_table.get(varId, ())) \
+                or any(site.blockers(varId, waitOp.txId, waitType) for site in sites)
+        for tm in [self] + self.peers:
+            for waitOp in tm.queueOf(varId):
+                waitTx = tm.transactions[waitOp.txId]
+                if waitOp.txId == tx.txId or waitTx.txType != 'RW' or waitTx.mode != '2PL':
+                    continue
+                if conflicts(lockType, waitOp.lock.lock_type) and lockedOut(waitOp) \
+                        and tm.rank(waitTx, tm.clock - waitOp.waitStart) <= self.rank(tx):
+                    return True
+        return False
+
+    def recordWait(self, op, tx):
+        """Record how long an operation waited for its locks once they are granted, by priority class.
+
+        INPUT:
+            op(operation granted its locks), tx(transaction it belongs to)
+        """
+        waited = 0 if op.waitStart is None else self.clock - op.waitStart
+        self.lockWaits.setdefault(tx.priority, Counter())[waited] += 1
+
+    def timerNow(self):
+        """Current time of the lock-wait timers, the logical clock or milliseconds of wall time.
+        """
+        if self.timeoutClock == 'wall':
+            return int(time.monotonic() * 1000)
+        return self.clock
+
+    def timeoutOf(self, tx):
+        """How long the ops of a transaction may wait for a lock, None - no limit.
+        Only 2PL RW transactions wait for locks.
+        """
+        if tx.txType != 'RW' or tx.mode != '2PL':
+            return None
+        return self.lockTimeout if tx.timeout is None else tx.timeout
+
+    def startTimer(self, op, delay=None):
+        """Start the lock-wait timeout of a waiting op (or the end of its backoff).
+
+        INPUT:
+            op(the operation), delay(time until it fires, default the timeout of its transaction)
+        """
+        if delay is None:
+            delay = self.timeoutOf(self.transactions[op.txId])
+            if delay is None:
+                return
+        self.stopTimer(op)
+        op.timer = self.timers.schedule(self.timerNow() + delay, op)
+
+    def stopTimer(self, op):
+        """Cancel the pending timeout or retry of an op leaving the waitlist.
+        """
+        if op.timer is not None:
+            self.timers.cancel(op.timer)
+            op.timer = None
+
+    def expireTimers(self):
+        """Fire the lock-wait timeouts and retries which are due.
+        """
+        for op in self.timers.advance(self.timerNow()):
+            op.timer = None
+            if op.txId not in self.transactions or op.exec or op not in self.waitlist:
+                # its transaction was aborted by an earlier timeout
+                continue
+            if op.parked:
+                # back in the lock queue, in its old place
+                op.parked = False
+                if debugMode:
+                    print("T{} retries its {} of variable {}".format(op.txId, op.opType, op.varId))
+                self.startTimer(op)
+                self.execWaitlist(op.varId)
+            else:
+                self.timeOut(op)
+
+    def timeOut(self, op):
+        """Handle an op which waited for its lock longer than its timeout, following self.timeoutAction:
+            abort: its transaction aborts
+            retry: it steps out of the lock queue (ops behind it may get the lock) for a backoff of
+                   the timeout doubled at every timeout, then waits again; after TIMEOUT_RETRIES
+                   retries its transaction aborts
+        The time an op waits is bounded even if no deadlock is ever detected.
+
+        INPUT:
+            op(the operation)
+        """
+        tx = self.transactions[op.txId]
+        op.timeouts += 1
+        if self.timeoutAction == 'abort' or op.timeouts > self.TIMEOUT_RETRIES:
+            print("T{} timed out waiting for a lock on variable {}.".format(tx.txId, op.varId))
+            self.abort(tx, 'timeout')
+            return
+        backoff = self.timeoutOf(tx) * 2 ** (op.timeouts - 1)
+        if debugMode:
+            print("T{} backs off its {} of variable {} for {}".format(tx.txId, op.opType, op.varId, backoff))
+        op.parked = True
+        self.startTimer(op, backoff)
+        self.execWaitlist(op.varId)
+
+    def blockOp(self, op):
+        """Handle an operation which failed to get its lock or to execute.
+        Under deadlock detection, the op is added to the waitlist, the graph is
+        updated and cycles are resolved by aborting the youngest transaction.
+        Under a prevention policy (wait-die, wound-wait, no-wait), the start order
+        of the conflicting transactions decides at once whether the op waits or
+        which transaction aborts, and the graph is never touched.
+
+        INPUT:
+            op(operation which couldn't be executed)
+        """
+        if self.policy != 'detection':
+            self.preventDeadlock(op)
+            return
+        self.waitFor(op)
+        self.checkDeadlock()
+
+    def waitFor(self, op):
+        """Add an operation to the waitlist and its waits-for edge(s) to the graph.
+
+        INPUT:
+            op(operation which couldn't be executed)
+        """
+        self.enqueue(op)
+        # update the graph
+        updated = False
+        # the upgrade of an update lock goes ahead of the ops queued behind that lock
+        upgrade = op.lock.lock_type == 'write' and any(
+            lockHolder.transaction_id == op.txId and lockHolder.lock_type == 'update'
+            for siteId in self.varSite[op.varId] for lockHolder in self.sites[siteId].lock_table[op.varId])
+        for waitOp in () if upgrade else reversed(self.waitlist):
+            # op.tx is waiting for waitOp.tx
+            if waitOp.varId == op.varId and waitOp.txId != op.txId:
+                self.graph.addEdge(op.txId, waitOp.txId)
+                updated = True
+                break
+        if not updated:
+            # there's no operation from different tx waiting for the same lock
+            # the op is waiting for the lock's current holder(s)
+            for siteId in self.varSite[op.varId]:
+                for lockHolder in self.sites[siteId].lock_table[op.varId]:
+                    if lockHolder.transaction_id == op.txId:
+                        # a transaction never waits for itself, an upgrade waits for the other readers only
+                        continue
+                    self.graph.addEdge(op.txId, lockHolder.transaction_id)
+                for holder in self.sites[siteId].blockers(op.varId, op.txId, op.lock.lock_type):
+                    if holder != op.txId:
+                        self.graph.addEdge(op.txId, holder)
+
+    def checkDeadlock(self):
+        """Look for deadlocks after ops were blocked, at once or when the batch of
+        detectEvery blocked ops is full. With only detectTicks set, the check waits for the tick.
+        """
+        if self.detectTicks is None and self.detectEvery in (None, 1):
+            self.detectDeadlock()
+            return
+        if self.detectEvery is None:
+            return
+        self.blockedSinceCheck += 1
+        if self.blockedSinceCheck >= self.detectEvery:
+            self.resolveDeadlocks()
+
+    def batchOp(self, txId, statements):
+        """Submit several operations of a transaction at once
+        1. lock all of them in one pass in variable order (a write before a read of the
+           same variable, so the read is covered by it), stopping at the first lock not granted
+        2. execute the ops holding their locks in statement order (none of them is on the
+           variable of an op without its lock, so they don't depend on the ones left behind)
+        3. the ops which couldn't be executed wait in the waitlist, with one deadlock check for the batch
+        Transactions which don't lock (RO, OCC, SI reads) run the statements one by one.
+
+        INPUT:
+            txId(transaction id)
+            statements(list of ('R', varId) or ('W', varId, value))
+        """
+        tx = self.transactions.get(txId)
+        if tx is not None and not self.admitted(tx, ('batch', statements)):
+            return
+        if tx is None or tx.txType == 'RO' or tx.mode != '2PL':
+            for statement in statements:
+                if statement[0] == 'R':
+                    self.readOp(txId, statement[1])
                 else:
-                    if debugMode:
-                        print("No deadlock detected!")
+                    self.writeOp(txId, statement[1], statement[2])
+            return
+        self.advanceClock()
+        if txId not in self.transactions:
+            # aborted by the periodic deadlock check
+            return
+        ops = list()
+        for statement in statements:
+            self.ensureKey(statement[1])
+            if statement[0] == 'R':
+                op = Operation(txId, 'read', statement[1])
+            else:
+                op = Operation(txId, 'write', statement[1], statement[2])
+            tx.addOp(op)
+            ops.append(op)
+        granted = set()
+        for op in sorted(ops, key=lambda op: (keyOrder(op.varId), op.opType != 'write')):
+            if not self.acquireLock(op) or len(op.locks) == 0:
+                break
+            granted.add(op)
+        blocked = list()
+        for op in ops:
+            if op in granted:
+                if op.opType == 'read':
+                    siteId = self.executeRead(op, tx)
+                    if siteId is not None:
+                        self.txSite[txId].add(siteId)
+                elif self.executeWrite(op, tx):
+                    self.txSite[txId].update(op.locks)
+                if op.exec:
+                    continue
+            blocked.append(op)
+        if not blocked:
+            return
+        if self.policy != 'detection':
+            for op in blocked:
+                if txId in self.transactions:
+                    self.preventDeadlock(op)
+            return
+        for op in blocked:
+            self.waitFor(op)
+        self.checkDeadlock()
+
+    def rangeOp(self, txId, low, high):
+        """Read every key between low and high (both included) in key order.
+        A 2PL transaction first locks the range on every available site, so no other
+        transaction can write or insert a key inside it until it ends, then the keys
+        stored now are read as one batch (see batchOp).
+
+        INPUT:
+            txId(transaction id), low(first key of the range), high(last key of the range)
+        """
+        tx = self.transactions.get(txId)
+        if tx is None or not self.admitted(tx, ('RR', low, high)):
+            return
+        if tx.txType == 'RW' and tx.mode == '2PL':
+            tx.ranges.append((low, high))
+            for siteId, site in self.sites.items():
+                if site.ApplyRangeLock(txId, low, high) == -1:
+                    self.txSite[txId].add(siteId)
+        keys = self.keysInRange(low, high)
+        if not keys:
+            print("T{} read no variable between {} and {}.".format(txId, low, high))
+        self.batchOp(txId, [('R', varId) for varId in keys])
+
+    def releaseRanges(self, tx):
+        """Release the range locks of a transaction.
+
+        OUTPUT:
+            set of variables with ops waiting inside the ranges
+        """
+        if not tx.ranges:
+            return set()
+        for site in self.sites.values():
+            site.ReleaseRangeLocks(tx.txId)
+        waiting = set()
+        for op in self.queued():
+            order = keyOrder(op.varId)
+            if any(keyOrder(low) <= order <= keyOrder(high) for low, high in tx.ranges):
+                waiting.add(op.varId)
+        return waiting
+
+    def releaseCoarse(self, tx):
+        """Release the locks of a transaction on the sites and their key ranges
+        (multi-granularity locking).
+
+        OUTPUT:
+            set of variables with ops waiting below the ranges or sites it locked for more than reading some
+        """
+        if self.escalateAfter is None:
+            return set()
+        waiting = set()
+        for site in self.sites.values():
+            granules = site.ReleaseCoarseLocks(tx.txId)
+            if not granules:
+                continue
+            for op in self.queued():
+                if op.varId in site.variable_list and (SITE in granules or rangeOf(op.varId) in granules):
+                    waiting.add(op.varId)
+        return waiting
+
+    def advanceClock(self):
+        """Advance the logical clock by one tick, run the periodic deadlock check
+        when it's due and catch up a batch of recovered replicas.
+        """
+        self.clock += 1
+        if self.detectTicks is not None and self.clock - self.lastCheck >= self.detectTicks:
+            self.resolveDeadlocks()
+        if self.catchupQueue:
+            self.catchUp()
+        if self.migrations:
+            self.migrate()
+        if self.pendingStarts:
+            self.admitDeclared()
+        if self.timers:
+            self.expireTimers()
+        self.trimHistory()
+
+    def trimHistory(self):
+        """Move the history horizon of the sites: commits before the lastest one at or before it
+        are dropped when their variable is committed again (see Variable.prune).
+        The horizon is the last commit at least historyTicks ago, or the start of the oldest running
+        transaction if it is older, since its snapshot reads may still need the commits made before.
+        """
+        if self.historyTicks is None:
+            return
+        i = bisect_right(self.commitTimes, (self.clock - self.historyTicks, datetime.max))
+        if i > 1:
+            del self.commitTimes[:i - 1]
+        horizon = self.commitTimes[0][1]
+        for tm in [self] + self.peers:
+            if tm.transactions:
+                # transactions are kept in the order they began
+                horizon = min(horizon, next(iter(tm.transactions.values())).startTime)
+        for site in self.sites.values():
+            site.horizon = horizon
+
+    def isReplicated(self, varId):
+        """Whether a variable is replicated: even indexed ones are, and keys which
+        aren't integers are when their hash is even, so about half of them.
+        """
+        if isinstance(varId, int):
+            return varId % 2 == 0
+        return ringHash(varId) % 2 == 0
+
+    def replicaCount(self, varId):
+        """Number of sites storing a variable.
+        """
+        return self.replicationFactor if self.isReplicated(varId) else 1
+
+    def placeKey(self, varId):
+        """Sites which store a variable.
+        Fixed placement: a replicated one is at every site, the others at one site
+        (index % 10 + 1, by hash for keys which aren't integers). Ring placement: its owners on the ring.
+
+        OUTPUT:
+            list of site indexes
+        """
+        if self.ring is not None:
+            return self.ring.owners(varId, self.replicaCount(varId))
+        if self.isReplicated(varId):
+            return list(range(1, 11))
+        if isinstance(varId, int):
+            return [varId % 10 + 1]
+        return [ringHash(varId) % 10 + 1]
+
+    def ensureKey(self, varId):
+        """Create a key accessed for the first time on the sites placement assigns it.
+        It has no value until a write of it commits.
+
+        INPUT:
+            varId(the key)
+        """
+        if varId in self.varSite:
+            return
+        siteIds = self.placeKey(varId)
+        for siteId in siteIds:
+            self.sites[siteId].insert_variable(varId, self.isReplicated(varId))
+        self.varSite[varId] = siteIds
+        if debugMode:
+            print("Key {} created at sites {}".format(varId, siteIds))
+
+    def keysInRange(self, low, high):
+        """Keys between low and high (both included) stored at any site, in key order.
+        """
+        keys = set()
+        for site in self.sites.values():
+            keys.update(site.keys_in_range(low, high))
+        return sorted(keys, key=keyOrder)
+
+    def addSite(self, siteId):
+        """Add an empty site to the ring; the variables the ring now assigns to it
+        move there in the background.
+
+        INPUT:
+            siteId(index of the new site)
+        """
+        self.advanceClock()
+        if self.placement != 'ring':
+            print("Sites can only be added under ring placement.")
+            return
+        if siteId in self.sites:
+            print("Site {} already exists.".format(siteId))
+            return
+        self.sites[siteId] = Site(siteId, [], self.escalateAfter)
+        self.ring.addSite(siteId)
+        self.rebalance()
+        print("Site {} added.".format(siteId))
+
+    def removeSite(self, siteId):
+        """Take a site off the ring; its variables move to other sites in the background
+        and the site is deleted once it stores nothing.
+
+        INPUT:
+            siteId(index of the site)
+        """
+        self.advanceClock()
+        if self.placement != 'ring' or siteId not in self.ring.siteIds:
+            print("Site {} is not on the ring.".format(siteId))
+            return
+        self.ring.removeSite(siteId)
+        self.rebalance()
+        print("Site {} removed.".format(siteId))
+
+    def rebalance(self):
+        """Queue the variables whose owners changed on the ring for migration.
+        """
+        queued = set(varId for varId, _ in self.migrations)
+        for varId, siteIds in self.varSite.items():
+            if varId not in queued and self.ring.owners(varId, self.replicaCount(varId)) != siteIds:
+                self.migrations.append((varId, False))
+
+    def migrate(self):
+        """Move up to self.migrationBatch variables to the sites the ring assigns them.
+        A variable is first copied to its new sites while it may be locked, then
+        handed off (commits missed since the copy are caught up, varSite switches
+        to the new sites and old ones drop it) as soon as no site holds a lock on it.
+        Variables without a live replica to copy from wait in the queue.
+        """
+        for _ in range(min(self.migrationBatch, len(self.migrations))):
+            varId, copied = self.migrations.popleft()
+            owners = self.ring.owners(varId, self.replicaCount(varId))
+            current = self.varSite[varId]
+            source = None
+            for siteId in current:
+                site = self.sites[siteId]
+                if site.status != "fail" and not site.variable_list[varId].is_recovered:
+                    source = site.variable_list[varId]
                     break
-    
+            if source is None:
+                self.migrations.append((varId, copied))
+                continue
+            locked = any(self.sites[siteId].locked(varId) for siteId in current)
+            if not copied:
+                # background copy to the new sites
+                for siteId in owners:
+                    if varId not in self.sites[siteId].variable_list:
+                        self.sites[siteId].add_variable(varId, source)
+                copied = True
+            if locked or any(op.varId == varId for op in self.queued()):
+                self.migrations.append((varId, copied))
+                continue
+            # handoff
+            for siteId in owners:
+                if siteId not in current:
+                    self.sites[siteId].variable_list[varId].catch_up(source)
+            self.varSite[varId] = owners
+            for siteId in current:
+                if siteId not in owners:
+                    self.sites[siteId].drop_variable(varId)
+                    if siteId not in self.ring.siteIds and not self.sites[siteId].variable_list:
+                        self.sites.pop(siteId)
+            if debugMode:
+                print("Variable {} moved to sites {}".format(varId, owners))
+
+    def catchUp(self):
+        """Copy the latest committed versions of up to self.catchupBatch replicated
+        variables from live replicas into recovered sites, so they can be read again
+        without waiting for a write. Replicas which can't be caught up yet
+        (locked, or no live replica to copy from) go back to the end of the queue.
+        """
+        for _ in range(min(self.catchupBatch, len(self.catchupQueue))):
+            siteId, varId = self.catchupQueue.popleft()
+            site = self.sites[siteId]
+            if site.status == "fail":
+                # the site failed again, it's queued again when it recovers
+                continue
+            source = None
+            for otherId in self.varSite[varId]:
+                other = self.sites[otherId]
+                if otherId != siteId and other.status != "fail" and not other.variable_list[varId].is_recovered:
+                    source = other.variable_list[varId]
+                    break
+            if source and site.catch_up(varId, source):
+                # reads waiting for a readable replica may go on
+                self.execWaitlist(varId)
+            elif site.variable_list[varId].is_recovered:
+                self.catchupQueue.append((siteId, varId))
+
+    def chooseVictim(self, cycle):
+        """Choose the transaction to abort in a deadlock according to self.victimPolicy
+
+        INPUT:
+            cycle(list of vertices in the deadlock)
+        OUTPUT:
+            the transaction to abort
+        """
+        return victims.chooseVictim([self.transactions[v.vId] for v in cycle], self.victimPolicy)
+
+    def resolveDeadlocks(self):
+        """Periodic deadlock check: find all cycles, pick a victim in each strongly
+        connected component and search again without the victims until no cycle is left,
+        then abort all victims together and drain the waitlist once for every variable they released.
+        """
+        self.blockedSinceCheck = 0
+        self.lastCheck = self.clock
+        if self.policy != 'detection':
+            return
+        def choose(cycle):
+            if debugMode:
+                print("Deadlock detected: ", [v.vId for v in cycle])
+            txId = self.chooseVictim(cycle).txId
+            return next(v for v in cycle if v.vId == txId)
+        aborting = [self.transactions[v.vId] for v in self.graph.breakCycles(choose)]
+        released = set()
+        for tx in aborting:
+            released |= self.abort(tx, drain=False)
+        for varId in sorted(released, key=keyOrder):
+            self.execWaitlist(varId)
+
+    def detectDeadlock(self):
+        """Check the graph for deadlock and abort the youngest transaction
+        in the cycle until there's no cycle left.
+        """
+        txCycle = self.graph.detectCycle()
+        while txCycle:
+            if len(txCycle) > 1:
+                if debugMode:
+                    print("Deadlock detected: ", txCycle)
+                # abort the victim chosen by the victim policy
+                self.abort(self.chooseVictim(txCycle))
+                txCycle = self.graph.detectCycle()
+            else:
+                if debugMode:
+                    print("No deadlock detected!")
+                break
+
+    def preventDeadlock(self, op):
+        """Decide at conflict time whether the op waits, following self.policy
+            wait-die: an older tx waits for younger ones, a younger tx aborts
+            wound-wait: an older tx aborts (wounds) younger ones, a younger tx waits
+            no-wait: the requesting tx aborts on any conflict
+        An op which has no conflicting transaction (e.g. all replicas failed) just waits.
+
+        INPUT:
+            op(operation which couldn't be executed)
+        """
+        conflicts = self.conflictingTxs(op)
+        if conflicts and self.policy == 'wound-wait':
+            wounded = [txId for txId in conflicts if self.isOlder(op.txId, txId)]
+            for txId in wounded:
+                owner = self.ownerOf(txId)
+                if owner:
+                    if debugMode:
+                        print("T{} wounds T{}".format(op.txId, txId))
+                    owner.abort(owner.transactions[txId], 'wound-wait')
+            if wounded:
+                # retry now that the younger holders are gone
+                if self.retryOp(op):
+                    return
+                conflicts = self.conflictingTxs(op)
+        elif conflicts and self.policy == 'wait-die':
+            if not all(self.isOlder(op.txId, txId) for txId in conflicts):
+                self.abort(self.transactions[op.txId], 'wait-die')
+                return
+        elif conflicts and self.policy == 'no-wait':
+            self.abort(self.transactions[op.txId], 'no-wait')
+            return
+        self.enqueue(op)
+
+    def retryOp(self, op):
+        """Try to acquire the locks of a blocked RW op again and execute it.
+
+        INPUT:
+            op(operation to retry)
+        OUTPUT:
+            True - op executed, False - op is still blocked
+        """
+        tx = self.transactions[op.txId]
+        if self.acquireLock(op) and len(op.locks) > 0:
+            if op.opType == 'read':
+                self.executeRead(op, tx)
+            else:
+                self.executeWrite(op, tx)
+            if op.exec:
+                for siteId in op.locks:
+                    self.txSite[op.txId].add(siteId)
+        return op.exec
+
+    def conflictingTxs(self, op):
+        """Find the transactions an op would wait for:
+        other txs queued for the same variable and other txs holding a conflicting lock on it.
+
+        INPUT:
+            op(the blocked operation)
+        OUTPUT:
+            set of ids of conflicting transactions
+        """
+        txs = set()
+        for tm in [self] + self.peers:
+            for waitOp in tm.waitlist:
+                if waitOp.varId == op.varId and waitOp.txId != op.txId:
+                    txs.add(waitOp.txId)
+        for siteId in self.varSite[op.varId]:
+            for lockHolder in self.sites[siteId].lock_table[op.varId]:
+                if lockHolder.transaction_id == op.txId:
+                    continue
+                if conflicts(op.lock.lock_type, lockHolder.lock_type):
+                    txs.add(lockHolder.transaction_id)
+            txs |= self.sites[siteId].blockers(op.varId, op.txId, op.lock.lock_type)
+        return txs
+
+    def isOlder(self, txId, otherId):
+        """Compare two transactions by start order, ties broken by transaction id.
+
+        OUTPUT:
+            True - txId started before otherId
+        """
+        tx = self.ownerOf(txId).transactions[txId]
+        other = self.ownerOf(otherId).transactions[otherId]
+        return (tx.startTime, txId) < (other.startTime, otherId)
+
+    def ownerOf(self, txId):
+        """Find the manager running a transaction, this one or a peer.
+
+        OUTPUT:
+            the transaction manager, None if the transaction has ended
+        """
+        for tm in [self] + self.peers:
+            if txId in tm.transactions:
+                return tm
+        return None
+
+    def queued(self):
+        """Operations waiting in the waitlist of this manager and of its peers.
+        """
+        for tm in [self] + self.peers:
+            yield from tm.waitlist
+
+    def waitReport(self):
+        """Report the waits of this manager's waitlist to a coordinator (see coordinator.py),
+        which merges the reports of all managers into one waits-for graph.
+
+        OUTPUT:
+            (list of (waiting txId, holding txId) for the conflicting locks held at the sites and the
+             range reads or coarse locks keeping a waiting op from its variable,
+             list of (opId, txId, varId, lock type) of the waiting ops)
+        """
+        edges = list()
+        waiting = list()
+        for op in self.waitlist:
+            waiting.append((op.opId, op.txId, op.varId, op.lock.lock_type))
+            for siteId in self.varSite[op.varId]:
+                for holder in self.sites[siteId].lock_table.get(op.varId, ()):
+                    if holder.transaction_id != op.txId and conflicts(op.lock.lock_type, holder.lock_type):
+                        edges.append((op.txId, holder.transaction_id))
+                for holder in self.sites[siteId].blockers(op.varId, op.txId, op.lock.lock_type):
+                    edges.append((op.txId, holder))
+        return edges, waiting
+
+    def dropVertex(self, txId):
+        """Delete an ended transaction from the graph of this manager and of its peers,
+        where it may appear as the holder other transactions wait for.
+        """
+        self.graph.deleteVertex(txId)
+        for peer in self.peers:
+            peer.graph.deleteVertex(txId)
+
+    def summary(self):
+        """Measured throughput and abort rate since the manager was created.
+
+        OUTPUT:
+            dict of commits, aborts (total and by reason), abort rate, commits per second
+            and lock-wait percentiles in ticks by priority class
+        """
+        elapsed = (datetime.now() - self.created).total_seconds()
+        commits = self.stats['commit']
+        aborts = sum(self.stats['abort'].values())
+        finished = commits + aborts
+        return {
+            'policy': self.policy,
+            'victimPolicy': self.victimPolicy,
+            'commits': commits,
+            'aborts': aborts,
+            'abortsByReason': dict(self.stats['abort']),
+            'abortRate': aborts / finished if finished else 0.0,
+            'throughput': commits / elapsed if elapsed > 0 else 0.0,
+            'wasted': dict(self.stats['wasted']),
+            'lockWait': {cls: waitPercentiles(waits) for cls, waits in sorted(self.lockWaits.items())},
+            'admissionCap': self.activeCap,
+        }
+
     def acquireLock(self, op, waitlist=False):
         """Try to acquire all the locks
 
@@ -366,9 +1651,21 @@ class TransactionManager:
         OUTPUT: 
             True - all locks required, False - failed to acquire lock
         """
-        lock = Lock(op.txId, op.varId, op.opType)
+        lock = op.lock
+        if not op.locks:
+            op.locks = list()
+        if not waitlist and self.outranked(self.transactions[op.txId], op.varId, lock.lock_type):
+            # a new request doesn't pass the ops queued for the variable
+            if debugMode:
+                print("A conflicting op waiting for this lock goes first, add op to waitlist")
+            return False
         getLock = True
-        for siteId in self.varSite[op.varId]:
+        needed = self.quorumSize(op)
+        for siteId in self.lockSites(op):
+            if needed and len(op.locks) >= needed:
+                break
+            if siteId in op.locks:
+                continue
             err = self.sites[siteId].ApplyLock(lock) # (lock, waitlist)???
             if debugMode:
                 print(err)
@@ -378,10 +1675,11 @@ class TransactionManager:
             elif err == -2:
                 # the current lock holder belongs to the same tx
                 ddlk = False
-                if not waitlist:
+                if not waitlist and self.transactions[op.txId].declared is None:
                     # the operation doesn't come from the waitlist
                     # see if there's an op from different tx waiting for this lock
-                    for waitOp in self.waitlist:
+                    # (a declared transaction never waits for a lock it holds)
+                    for waitOp in self.queued():
                         #if waitOp.varId == op.varId and waitOp.txId != op.txId:
                         if waitOp.varId == op.varId:
                             ddlk = True
@@ -401,14 +1699,86 @@ class TransactionManager:
                 # there's other ops holding required lock
                 getLock = False
                 break
+        if needed and len(op.locks) < needed:
+            # not enough available replicas to form a quorum
+            getLock = False
         if not getLock:
             # there's other ops holding required lock, release those acquired
             for siteId in op.locks:
                 self.sites[siteId].ReleaseLock(lock)
             op.locks = list()
+            if lock.lock_type == 'write':
+                # an update lock holder keeps new readers off all replicas until it upgrades
+                for siteId in self.varSite[op.varId]:
+                    if self.sites[siteId].status != "fail":
+                        self.sites[siteId].queue_upgrade(op.varId, op.txId)
         return getLock
 
-    def abort(self, tx):
+    def isQuorum(self, varId):
+        """Check if a variable is read and written through quorums.
+        """
+        return self.replication == 'quorum' and len(self.varSite[varId]) > 1
+
+    def quorumSize(self, op):
+        """Number of replicas an op has to lock.
+
+        OUTPUT:
+            R for reads and W for writes under quorum replication, None - every available replica
+        """
+        if not self.isQuorum(op.varId):
+            return None
+        r, w = self.quorums['replicated' if len(self.varSite[op.varId]) > 1 else 'single']
+        return r if op.opType == 'read' else w
+
+    def lockSites(self, op):
+        """Sites in the order an op tries to lock them.
+        Under quorum replication the order starts at a different site for each
+        transaction, to spread the quorums over the replicas.
+        """
+        sites = self.varSite[op.varId]
+        if not self.isQuorum(op.varId):
+            return sites
+        start = op.txId % len(sites)
+        return sites[start:] + sites[:start]
+
+    def readSites(self, op):
+        """Locked sites in the order a RW read tries them.
+        Under quorum replication, a replica holding the transaction's own write
+        comes first, then the others from the newest version down.
+        """
+        if not self.isQuorum(op.varId):
+            return op.locks
+        def freshness(siteId):
+            site = self.sites[siteId]
+            # we hold a lock here, so only our own write can hold a write lock
+            return (site.holds_write(op.varId, op.txId), site.variable_list[op.varId].version)
+        return sorted(op.locks, key=freshness, reverse=True)
+
+    def snapshotSites(self, varId, time):
+        """Sites in the order a read of the values committed before a time tries them.
+        Under quorum replication, it needs R available replicas and tries them
+        from the lastest commit before that time down.
+        """
+        if not self.isQuorum(varId):
+            return self.varSite[varId]
+        available = [siteId for siteId in self.varSite[varId] if self.sites[siteId].status != "fail"]
+        if len(available) < self.quorums['replicated'][0]:
+            return []
+        return sorted(available, reverse=True,
+                      key=lambda siteId: self.sites[siteId].variable_list[varId].last_commit_time(time))
+
+    def commitVersion(self, op):
+        """Version number a write commits under quorum replication:
+        one more than the newest version in its write quorum.
+
+        OUTPUT:
+            version number, None - each replica counts its own versions
+        """
+        if op.opType != 'write' or not self.isQuorum(op.varId) or not op.locks:
+            return None
+        return 1 + max(self.sites[siteId].variable_list[op.varId].version for siteId in op.locks)
+
+    def abort(self, tx, reason='deadlock', drain=True):
         """Abort the transaction
         1. undo all executed ops
         2. remove all tx's operations from waitlist
@@ -418,56 +1788,154 @@ class TransactionManager:
 
         INPUT:
             tx(transaction which should abort)
+            reason(why it aborts: deadlock, wait-die, wound-wait, no-wait)
+            drain(False - leave executing the waitlist to the caller)
+        OUTPUT:
+            released(set of variables whose locks were released)
         """
+        self.countWasted(tx)
         # undo all tx's executed ops
         for op in tx.ops:
-            if op.opType == 'write' and op.exec:
+            if op.opType == 'write' and op.exec and not tx.buffered:
                 for siteId in op.locks:
                     self.sites[siteId].undo(op)
         # remove all tx's operations from waitlist
-        for op in self.waitlist:
-            if op.txId == tx.txId:
-                self.waitlist.remove(op)
+        self.waitlist = [op for op in self.waitlist if op.txId != tx.txId]
+        for op in tx.ops:
+            self.stopTimer(op)
         # release all acquired locks
         released = set()
         for op in tx.ops:
             if debugMode:
                 print("Operation {} variable {} value {} is holding locks {}".format(op.opType, op.varId, op.val, op.locks))
-            lock = Lock(tx.txId, op.varId, op.opType)
+            lock = op.lock
             for siteId in self.varSite[op.varId]:
                 if self.sites[siteId].ReleaseLock(lock) == 0:
                     # sucessfully released a lock
                     if debugMode:
                         print("Variable {} at site {} released lock".format(op.varId, siteId))
                     released.add(lock.variable_id)
+        released |= self.releaseDeclared(tx)
+        released |= self.releaseRanges(tx)
+        released |= self.releaseCoarse(tx)
         # delete tx from transactions, txSite, and graph
         self.transactions.pop(tx.txId)
+        self.leave(tx, False)
         self.txSite.pop(tx.txId)
-        self.graph.deleteVertex(tx.txId)
+        self.dropVertex(tx.txId)
         # execute waitlist
-        for varId in released:
-            if debugMode:
-                print("Start executing waitlist.")
-            self.execWaitlist(varId)
-        print("T{} aborted due to deadlock".format(tx.txId))
+        if drain:
+            for varId in released:
+                if debugMode:
+                    print("Start executing waitlist.")
+                self.execWaitlist(varId)
+        self.countAbort(reason)
+        print("T{} aborted due to {}".format(tx.txId, reason))
+        return released
+
+    def countWasted(self, tx):
+        """Add the work an aborting transaction throws away to self.stats
+
+        INPUT:
+            tx(the aborting transaction)
+        """
+        wasted = victims.work(tx)
+        for key, val in wasted.items():
+            self.stats['wasted'][key] += val
+        if debugMode:
+            print("T{} discards {} executed ops, {} locks, {} undo writes".format(
+                tx.txId, wasted['ops'], wasted['locks'], wasted['undo']))
+
+    def countCommit(self):
+        """Count a commit in self.stats and log its time for snapshots.
+        """
+        self.stats['commit'] += 1
+        if self.commitTimes[-1][0] == self.clock:
+            self.commitTimes[-1] = (self.clock, datetime.now())
+        else:
+            self.commitTimes.append((self.clock, datetime.now()))
+
+    def countAbort(self, reason):
+        """Count an abort in self.stats
+
+        INPUT:
+            reason(why the transaction aborted)
+        """
+        self.stats['abort'][reason] = self.stats['abort'].get(reason, 0) + 1
 
 
     def dumpOp(self, dumpsites = None):
         """query for all the variable on all the site.
         OUTPUT: print all the variables on all sites in order of ascending index.
         """
+        self.advanceClock()
         if dumpsites:
-            for sid in dumpsites.sort():
+            for sid in sorted(dumpsites):
                 self.sites[sid].dump_all()
         else:
             for site in self.sites.values():
                 site.dump_all()
 
+    def snapshot(self, time=None):
+        """Committed state of all sites at a logical tick, as columns (see snapshot.py).
+
+        INPUT:
+            time(logical tick, None - now)
+        OUTPUT:
+            dict of column name (site, variable, value, version): list
+        """
+        cutoff = None if time is None else snapshot.cutoffTime(self.commitTimes, time)
+        return snapshot.collect(self.sites, cutoff)
+
+    def exportOp(self, path, time=None):
+        """Write the committed state of all sites at a logical tick to a CSV or .npy file.
+
+        INPUT:
+            path(file name), time(logical tick, None - now)
+        """
+        self.advanceClock()
+        if time is not None and time < self.commitTimes[0][0]:
+            print("Commits before tick {} are no longer kept, see --history_ticks.".format(self.commitTimes[0][0]))
+            return
+        columns = self.snapshot(time)
+        try:
+            snapshot.write(columns, path)
+        except ValueError as e:
+            print(e)
+            return
+        print("Exported {} variables to {}.".format(len(columns['site']), path))
+
+    def checkpointOp(self, path):
+        """Save the complete state of the manager to a file (see checkpoint.py),
+        to be restored with parser.py --restore.
+
+        INPUT:
+            path(file name)
+        """
+        self.advanceClock()
+        checkpoint.save(self, path)
+        print("Checkpoint saved to {}.".format(path))
+
     def failOp(self, siteId):
         """fail a site and abort all related transactions.
         INPUT: site id.
         """
+        self.advanceClock()
+        if siteId not in self.sites:
+            print("Site {} does not exist.".format(siteId))
+            return
         # all related transactions fail.
+        for tm in [self] + self.peers:
+            tm.markFailedSite(siteId)
+        # site fails
+        site = self.sites[siteId]
+        site.fail()
+        print("Site {} failed.".format(siteId))
+
+    def markFailedSite(self, siteId):
+        """Mark the transactions which accessed a failing site to abort at the end.
+        INPUT: site id.
+        """
         for txId, tx in self.transactions.items():
             if siteId in self.txSite[txId]:
                 tx.abort = True
@@ -476,29 +1944,34 @@ class TransactionManager:
                 for op in tx.ops:
                     if siteId in op.locks:
                         op.locks.remove(siteId)
-        # site fails
-        site = self.sites[siteId]
-        site.fail()
-        print("Site {} failed.".format(siteId))
 
     def recoverOp(self, siteId):
         """recover a site.
         INPUT: site id.
         """
+        self.advanceClock()
+        if siteId not in self.sites:
+            print("Site {} does not exist.".format(siteId))
+            return
         site = self.sites[siteId]
         if site.status == "fail":
             site.recover()
+            if self.replication == 'quorum':
+                # versions tell stale replicas apart, they can be read right away
+                for varId, var in site.variable_list.items():
+                    if self.isQuorum(varId):
+                        var.is_recovered = False
+                        self.execWaitlist(varId)
+            if self.catchupBatch:
+                for varId in site.variable_list:
+                    if len(self.varSite[varId]) > 1:
+                        self.catchupQueue.append((siteId, varId))
             # if odd-index variable exists on site, they become free after recovery.
-            if siteId%2 == 0:
-                if debugMode:
-                    print("Start executing waitlist.")
-                self.execWaitlist(siteId - 1)
-                self.execWaitlist(siteId - 1 + 10)
+            for varId in list(site.variable_list):
+                if len(self.varSite[varId]) == 1:
+                    if debugMode:
+                        print("Start executing waitlist.")
+                    self.execWaitlist(varId)
             print("Site {} recovered.".format(siteId))
         else:
             print("Site does not fail.")
-
-
-
-
-
@@ -0,0 +1,66 @@
+"""checkpoint.py saves the complete state of a transaction manager to a file and restores it.
+A checkpoint holds the sites (variables with their version history, lock tables, key indexes),
+the transactions, the waitlist, the waits-for graph and the logical clock, so a run restored
+from it goes on exactly where the checkpoint was taken, e.g. to fork benchmarks from a warmed-up state.
+
+The file is a header line naming the format and its version, followed by the manager pickled
+with the highest protocol. A checkpoint of another format version is refused.
+
+The details of functions are specified below every definition of them.
+"""
+import gc
+import pickle
+from itertools import count
+import components
+
+MAGIC = b'TMCHECKPOINT'
+VERSION = 4
+
+
+class paused:
+    """Context keeping the garbage collector off while millions of objects are
+    pickled or created, it would otherwise scan them again and again.
+    """
+    def __enter__(self):
+        self.enabled = gc.isenabled()
+        gc.disable()
+
+    def __exit__(self, *exc):
+        if self.enabled:
+            gc.enable()
+
+
+def save(tx_manager, path):
+    """Write a checkpoint of a transaction manager (or a coordinator and its managers).
+
+    INPUT:
+        tx_manager(the manager), path(file name)
+    """
+    # ids of the operations created after the restore must follow the ones in the checkpoint
+    nextOp = next(components.opCounter)
+    state = {'manager': tx_manager, 'nextOp': nextOp}
+    with open(path, 'wb') as f, paused():
+        f.write(MAGIC + b' %d\n' % VERSION)
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load(path):
+    """Restore a transaction manager from a checkpoint.
+
+    INPUT:
+        path(file name)
+    OUTPUT:
+        the manager
+    """
+    with open(path, 'rb') as f:
+        header = f.readline().split()
+        if len(header) != 2 or header[0] != MAGIC:
+            raise ValueError("{} is not a checkpoint".format(path))
+        if int(header[1]) != VERSION:
+            raise ValueError("Checkpoint {} has format version {}, expected {}".format(
+                path, int(header[1]), VERSION))
+        with paused():
+            state = pickle.load(f)
+    nextOp = next(components.opCounter)
+    components.opCounter = count(max(nextOp, state['nextOp']))
+    return state['manager']
@@ -6,7 +6,7 @@ Five components are:
     Class Operation: an operation to be execute, including read and write operations.
     Class Transaction: a transaction is a list of operations. It has methods to add or
                        delete operations.
-    Class Lock: a class of the lock, including read and write lock.
+    Class Lock: a class of the lock, including read, update and write lock.
 
 Contribution of authors:
     Yubing Bai: Class Variable,  Class Site, Class Lock
@@ -16,32 +16,116 @@ The details of classes and methods are specified below every definition of them.
 """
 
 from datetime import datetime
+from itertools import count, takewhile
+from keyindex import KeyIndex, keyOrder, keyName
+from granularity import LockHierarchy, rangeOf, SITE
 debugMode = False
+# ids of operations in the order they are created
+opCounter = count()
+# pairs of (requested, held) lock types different transactions can hold on a variable together
+COMPATIBLE = {("read", "read"), ("read", "update"), ("update", "read")}
+
+
+def conflicts(requested, held):
+    """Whether a lock can't be granted while another transaction holds a lock on the variable.
+    Input:
+        requested: type of the requested lock, held: type of the lock in hand.
+    """
+    return (requested, held) not in COMPATIBLE
+
 
 class Site:
     """Site is a place saving a list of variables.
     args:
         site_id: the id of site
         status: the status of site: 'available', 'fail'
-        variable_list: a list of variables on this site
+        variable_list: a list of variables on this site (the hash index of its keys)
+        index: ordered index of the keys of its variables, for range reads
         lock_table: the locks applied on every variable.
+        range_locks: key ranges read by transactions, (transaction_id, low, high),
+                     no other transaction may write a key inside one.
+        upgrade_queue: transactions waiting to upgrade their update lock of a variable to a write lock,
+                       new readers of the variable wait behind them.
+        hierarchy: locks on the site itself and on its key ranges, for multi-granularity locking.
+        horizon: time no read goes back beyond, commits before the lastest one at or before it are dropped
+                 from the version history of a variable when it is committed (set by the transaction manager),
+                 None - the history is kept.
     """
-    def __init__(self, site_id):
+    def __init__(self, site_id, variables = None, escalate_after = None):
+        """Input:
+            variables: indexes of the variables stored on this site,
+                       default odd ones by index % 10 + 1 and all even ones.
+            escalate_after: locks of a transaction in one key range (or key ranges locked in this site)
+                            above which they are escalated, None means no multi-granularity locking.
+        """
         self.site_id = site_id
         self.status = "available"  # status: available, fail
         self.variable_list = dict()
         self.lock_table = dict()   # a dictionary of list of locks
-
-        # initializes the vairables in this site
-        for i in range(1, 21):
-            if i%2 == 0:
-                self.variable_list[i] = Variable(i, 10*i, 10*i)
-                self.lock_table[i] = list()
-            elif i%10 + 1 == self.site_id:
-                self.variable_list[i] = Variable(i, 10*i, 10*i)
-                self.lock_table[i] = list()
+        self.upgrade_queue = dict()  # variable: list of transaction ids
+        self.range_locks = list()
+        self.hierarchy = LockHierarchy(escalate_after)
+        self.horizon = None
+
+        if variables is None:
+            # initializes the vairables in this site
+            variables = [i for i in range(1, 21) if i%2 == 0 or i%10 + 1 == self.site_id]
+        for i in variables:
+            self.variable_list[i] = Variable(i, 10*i, 10*i, i%2 == 0)
+            self.lock_table[i] = list()
+        self.index = KeyIndex(variables)
+
+    def __getstate__(self):
+        """Pickle the variables column by column and only the lock lists in use,
+        so checkpoints of sites with many keys stay small and fast (see checkpoint.py).
+        """
+        state = dict(self.__dict__)
+        variables = list(self.variable_list.values())
+        state['variable_list'] = (list(self.variable_list),
+                                  [v.value for v in variables],
+                                  [v.commited_value for v in variables],
+                                  [v.lock_status for v in variables],
+                                  [v.is_recovered for v in variables],
+                                  [v.version for v in variables],
+                                  [v.replicated for v in variables])
+        state['lock_table'] = {vid: locks for vid, locks in self.lock_table.items() if locks}
+        return state
+
+    def __setstate__(self, state):
+        columns = state.pop('variable_list')
+        locks = state.pop('lock_table')
+        self.__dict__.update(state)
+        self.variable_list = dict()
+        new = Variable.__new__
+        for vid, value, commits, status, recovered, version, replicated in zip(*columns):
+            var = new(Variable)
+            var.variable_id = vid
+            var.value = value
+            var.commited_value = commits
+            var.lock_status = status
+            var.is_recovered = recovered
+            var.version = version
+            var.replicated = replicated
+            self.variable_list[vid] = var
+        self.lock_table = {vid: list() for vid in columns[0]}
+        self.lock_table.update(locks)
 
     def ApplyLock(self, lock, force=False):
+        """Apply a lock on the variable, then escalate the locks of its transaction
+        if it holds too many in the key range of the variable or in this site.
+        Input and Output: same as ApplyVariableLock.
+        """
+        res = self.ApplyVariableLock(lock, force)
+        if res == -1 and self.hierarchy.enabled:
+            vid = lock.variable_id
+            txId = lock.transaction_id
+            # not when a coarse lock granted it
+            if any(l.transaction_id == txId for l in self.lock_table[vid]):
+                for granule in self.hierarchy.granted(txId, vid, lock.lock_type):
+                    self.escalate(granule, txId)
+        return res
+
+    def ApplyVariableLock(self, lock, force=False):
         """Apply a lock on the variable.
         Input:
             force: True means if required lock already in hand, apply or upgrade directly.
@@ -66,17 +150,33 @@ class Site:
             return 2
 
         if self.variable_list[vid].is_recovered:
-            if lock.lock_type == "read" and vid % 2 == 0:
+            if lock.lock_type == "read" and self.variable_list[vid].replicated:
                 # False
                 if debugMode:
                     print("Recovered site hasn't been written yet.")
                 return 3
 
+        if self.hierarchy.enabled:
+            if self.hierarchy.covers(vid, lock.transaction_id, lock.lock_type):
+                # True
+                return -1
+            if self.hierarchy.blocking(vid, lock.transaction_id, lock.lock_type):
+                if debugMode:
+                    print("Cannot lock variable {} because its key range or site {} is locked by others! ".format(vid, self.site_id))
+                return 0
+
+        if lock.lock_type == "write" and self.range_holders(vid, lock.transaction_id):
+            if debugMode:
+                print("Cannot apply WRITE lock because variable {} on site {} is in a range read by others! ".format(vid, self.site_id))
+            return 0
+
         if self.variable_list[vid].lock_status == "free":
             self.variable_list[vid].lock_status = lock.lock_type
             self.lock_table[vid].append(lock)
             # True
             return -1
+        elif self.variable_list[vid].lock_status == "update":
+            return self.ApplyUnderUpdate(lock, force)
         elif self.variable_list[vid].lock_status == "write":
             #if lock.lock_type == "write" and (self.lock_table[vid])[0].transaction_id == lock.transaction_id:
             if (self.lock_table[vid])[0].transaction_id == lock.transaction_id:
@@ -93,6 +193,11 @@ class Site:
                 # False
                 return 0
         elif self.variable_list[vid].lock_status == "read":
+            if lock.lock_type == "update":
+                # compatible with the readers, the variable is now update locked
+                self.variable_list[vid].lock_status = lock.lock_type
+                self.lock_table[vid].append(lock)
+                return -1
             if lock.lock_type == "write":
                 if len(self.lock_table[vid]) == 1 and (self.lock_table[vid])[0].transaction_id == lock.transaction_id:
                     if force:
@@ -126,6 +231,169 @@ class Site:
                 print("Wrong lock status: ", self.variable_list[vid].lock_status)
             return False
 
+    def ApplyUnderUpdate(self, lock, force=False):
+        """Apply a lock on a variable which a transaction holds an update lock of.
+        Readers may join unless an upgrade is queued; the update lock holder upgrades
+        to a write lock in place once it is the only holder, otherwise it queues the upgrade.
+        Input:
+            lock: the lock to apply, force: same as ApplyLock.
+        Output:
+            same as ApplyLock.
+        """
+        vid = lock.variable_id
+        locks = self.lock_table[vid]
+        holder = next(l.transaction_id for l in locks if l.lock_type == "update")
+        if lock.lock_type == "read":
+            for l in locks:
+                if l.transaction_id == lock.transaction_id:
+                    if debugMode:
+                        print("Lock existed.")
+                    return -1 if force else -2
+            if self.upgrade_waiting(vid, lock.transaction_id):
+                if debugMode:
+                    print("Cannot apply READ lock because an upgrade of variable {} on site {} is queued! ".format(vid, self.site_id))
+                return 0
+            locks.append(lock)
+            return -1
+        if holder != lock.transaction_id:
+            if debugMode:
+                print("Cannot lock variable because variable {} on site {} has update lock on! ".format(vid, self.site_id))
+            return 0
+        if lock.lock_type == "update":
+            if debugMode:
+                print("Lock existed.")
+            return -1 if force else -2
+        if any(l.transaction_id != holder for l in locks):
+            # wait for the readers to leave, ahead of new ones
+            self.queue_upgrade(vid, holder)
+            if debugMode:
+                print("Upgrade of variable {} on site {} waits for readers.".format(vid, self.site_id))
+            return 0
+        # the update lock stays, so giving back the write lock restores it
+        locks[:] = [l for l in locks if l.lock_type == "update"]
+        locks.append(lock)
+        self.variable_list[vid].lock_status = "write"
+        self.dequeue_upgrade(vid, holder)
+        if debugMode:
+            print("Upgrade update lock to write lock.")
+        return -1
+
+    def upgrade_waiting(self, variable_id, transaction_id):
+        """Whether another transaction waits to upgrade its update lock of a variable.
+        """
+        return any(t != transaction_id for t in self.upgrade_queue.get(variable_id, ()))
+
+    def queue_upgrade(self, variable_id, transaction_id):
+        """Queue the upgrade of a transaction's update lock of a variable, if it holds one.
+        """
+        if not any(l.transaction_id == transaction_id and l.lock_type == "update" for l in self.lock_table[variable_id]):
+            return
+        queue = self.upgrade_queue.setdefault(variable_id, list())
+        if transaction_id not in queue:
+            queue.append(transaction_id)
+
+    def dequeue_upgrade(self, variable_id, transaction_id):
+        """Take a transaction off the upgrade queue of a variable.
+        """
+        queue = self.upgrade_queue.get(variable_id)
+        if queue and transaction_id in queue:
+            queue.remove(transaction_id)
+            if not queue:
+                del self.upgrade_queue[variable_id]
+
+    def escalate(self, granule, transaction_id):
+        """Replace the variable locks of a transaction below a granule (this site or one of
+        its key ranges) by one S lock on it, or X if any of them is a write or update lock.
+        Nothing changes while another transaction holds a conflicting mode on the granule.
+        Input:
+            granule: granularity.SITE or a key range.
+        """
+        mine = dict()
+        for vid, locks in self.lock_table.items():
+            if granule == SITE or rangeOf(vid) == granule:
+                held = [l for l in locks if l.transaction_id == transaction_id]
+                if held:
+                    mine[vid] = held
+        writes = any(l.lock_type != "read" for held in mine.values() for l in held)
+        if not self.hierarchy.escalate(granule, transaction_id, writes):
+            return
+        for vid, held in mine.items():
+            for l in held:
+                self.lock_table[vid].remove(l)
+            self.refresh_status(vid)
+            self.dequeue_upgrade(vid, transaction_id)
+        if debugMode:
+            print("T{} escalated {} locks to {} on {} of site {}.".format(
+                transaction_id, len(mine), self.hierarchy.mode(granule, transaction_id), granule, self.site_id))
+
+    def ReleaseCoarseLocks(self, transaction_id):
+        """Release the locks of an ended transaction on this site and its key ranges.
+        Output:
+            granules where it held a mode other than IS.
+        """
+        if not self.hierarchy.enabled:
+            return set()
+        return self.hierarchy.release(transaction_id)
+
+    def blockers(self, variable_id, transaction_id, lock_type):
+        """Transactions other than the given one keeping it from locking a variable
+        by a range read or a lock on the key range or the site (holders of the variable aside).
+        """
+        holders = self.range_holders(variable_id, transaction_id) if lock_type == "write" else set()
+        if self.hierarchy.enabled:
+            holders |= self.hierarchy.blocking(variable_id, transaction_id, lock_type)
+        return holders
+
+    def holds_write(self, variable_id, transaction_id):
+        """Whether a transaction holds a write lock on a variable, or X above it.
+        """
+        if self.variable_list[variable_id].lock_status == "write":
+            return any(l.transaction_id == transaction_id for l in self.lock_table[variable_id])
+        return self.hierarchy.enabled and self.hierarchy.covers(variable_id, transaction_id, "write")
+
+    def locked(self, variable_id):
+        """Whether a transaction holds a lock on a variable, or S, SIX or X above it.
+        """
+        if self.lock_table[variable_id]:
+            return True
+        return self.hierarchy.enabled and bool(self.hierarchy.coarseHolders(variable_id))
+
+    def ApplyRangeLock(self, transaction_id, low, high):
+        """Lock a key range for reading: other transactions can't write (or insert)
+        a key inside it until it is released. Keys already stored are read locked one by one.
+        Input:
+            transaction_id: the reading transaction, low, high: first and last key of the range.
+        Output:
+            -1: range locked, 1: site fail, cannot apply
+        """
+        if self.status == "fail":
+            return 1
+        self.range_locks.append((transaction_id, keyOrder(low), keyOrder(high)))
+        return -1
+
+    def ReleaseRangeLocks(self, transaction_id):
+        """Release all the range locks of a transaction.
+        Output:
+            the ranges released, as (low, high) sort keys.
+        """
+        released = [(low, high) for t, low, high in self.range_locks if t == transaction_id]
+        if released:
+            self.range_locks = [r for r in self.range_locks if r[0] != transaction_id]
+        return released
+
+    def range_holders(self, variable_id, transaction_id = None):
+        """Transactions other than the given one which locked a range containing a key.
+        """
+        if not self.range_locks:
+            return set()
+        order = keyOrder(variable_id)
+        return set(t for t, low, high in self.range_locks if low <= order <= high and t != transaction_id)
+
+    def keys_in_range(self, low, high):
+        """Keys stored on this site between low and high (both included), in order.
+        """
+        return list(self.index.range(low, high))
+
     def ReleaseLock(self, lock):
         """Release lock on variable.
         If release a write lock: set lock status of the variable to free;
@@ -164,8 +432,11 @@ class Site:
                 self.lock_table[vid].remove(lock)
                 res = 0
         
-        if  len(self.lock_table[vid]) == 0:
-            self.variable_list[vid].lock_status = "free"
+        self.refresh_status(vid)
+        if lock.lock_type == "update":
+            self.dequeue_upgrade(vid, lock.transaction_id)
+        if res == 0 and self.hierarchy.enabled:
+            self.hierarchy.released(lock.transaction_id, vid)
 
         if res == 0:
             if debugMode:
@@ -177,6 +448,18 @@ class Site:
 
         return res
 
+    def refresh_status(self, vid):
+        """Set the lock status of a variable to its strongest lock left.
+        """
+        if  len(self.lock_table[vid]) == 0:
+            self.variable_list[vid].lock_status = "free"
+        else:
+            types = {l.lock_type for l in self.lock_table[vid]}
+            for lock_type in ("write", "update", "read"):
+                if lock_type in types:
+                    self.variable_list[vid].lock_status = lock_type
+                    break
+
     def fail(self):
         """Fail a site.
         Release all the locks on the site.
@@ -184,6 +467,9 @@ class Site:
         self.status = "fail"
         for vlocklist in self.lock_table.values():
             vlocklist.clear()
+        self.upgrade_queue.clear()
+        self.range_locks = list()
+        self.hierarchy = LockHierarchy(self.hierarchy.escalateAfter)
         for vid in self.variable_list:
             self.variable_list[vid].lock_status = "free"
     
@@ -196,25 +482,82 @@ class Site:
             v.value = v.get_commited_value()
             v.is_recovered = True
 
+    def catch_up(self, variable_id, source):
+        """Bring a recovered replica up to date from a live one.
+        Skipped while a transaction holds a lock on it, since its value is not committed.
+        Input:
+            variable_id: the replicated variable to catch up.
+            source: the up-to-date Variable on another site.
+        Output:
+            Whether the variable is current and readable again.
+        """
+        if self.status == "fail":
+            return False
+        var = self.variable_list[variable_id]
+        if not var.is_recovered:
+            return True
+        if self.locked(variable_id):
+            return False
+        var.catch_up(source)
+        if debugMode:
+            print("Site {} caught up variable {}.".format(self.site_id, variable_id))
+        return True
+
+    def add_variable(self, variable_id, source):
+        """Start storing a variable moved here from another site.
+        Input:
+            variable_id: index of the variable.
+            source: the Variable on a current owner, its commits are copied.
+        """
+        var = Variable(variable_id, source.get_commited_value(), source.get_commited_value(), source.replicated)
+        var.commited_value = dict(source.commited_value)
+        var.version = source.version
+        self.variable_list[variable_id] = var
+        self.lock_table[variable_id] = list()
+        self.index.add(variable_id)
+
+    def insert_variable(self, variable_id, replicated):
+        """Start storing a key accessed for the first time. It has no value until a write commits.
+        Input:
+            variable_id: the key.
+            replicated: whether other sites store it as well.
+        """
+        self.variable_list[variable_id] = Variable(variable_id, None, None, replicated)
+        self.lock_table[variable_id] = list()
+        self.index.add(variable_id)
+
+    def drop_variable(self, variable_id):
+        """Stop storing a variable which moved to other sites.
+        Input:
+            variable_id: index of the variable.
+        """
+        self.variable_list.pop(variable_id, None)
+        self.lock_table.pop(variable_id, None)
+        self.upgrade_queue.pop(variable_id, None)
+        self.index.discard(variable_id)
+
     def dump_all(self, is_commited = True):
         """Print all the variables on this site in order of ascending index.
+        Keys which were never written are left out.
         Input:
             is_commited: whether you want the lastest commited value.
         """
         print("site {} -".format(self.site_id), end = " ")
-        for vid, var in self.variable_list.items():
-            if is_commited:
-                print("x{}: {},".format(vid, var.get_commited_value()), end=" ")
-            else:
-                print("x{}: {},".format(vid, var.value), end=" ")
+        for vid in self.index:
+            var = self.variable_list[vid]
+            value = var.get_commited_value() if is_commited else var.value
+            if value is None:
+                continue
+            print("{}: {},".format(keyName(vid), value), end=" ")
         print("")
 
 
     
-    def read(self, variable_id, is_commited = False):
+    def read(self, variable_id, is_commited = False, time = None):
         """Read the value of the requested variable.
         Input:
             is_commited: whether you want the lastest commited value.
+            time: with is_commited, read the lastest value commited before this time.
         Output:
             A tuple of [is_read_successful, the value of variable if read successfully]
         """
@@ -223,16 +566,16 @@ class Site:
         if self.status == "fail":
             return False, 0
         elif self.variable_list[variable_id].is_recovered == True:
-            if variable_id%2 == 0:
+            if self.variable_list[variable_id].replicated:
                 return False, 0
             else:
                 if is_commited:
-                    return True, self.variable_list[variable_id].get_commited_value()
+                    return True, self.variable_list[variable_id].get_commited_value(time)
                 else:
                     return True, self.variable_list[variable_id].value
         else:
             if is_commited:
-                return True, self.variable_list[variable_id].get_commited_value()
+                return True, self.variable_list[variable_id].get_commited_value(time)
             else:
                 return True, self.variable_list[variable_id].value
 
@@ -259,7 +602,7 @@ class Site:
         if t_type == "RO":
             t_time = transaction.startTime
             if o_type == "read":
-                if self.variable_list[v_id].is_recovered == True and v_id%2 == 0:
+                if self.variable_list[v_id].is_recovered == True and self.variable_list[v_id].replicated:
                 # cannot read duplicated(even-index) variables
                     if debugMode:
                         print("Failed: read duplicated variable {} on recovery site {}.".format(v_id, self.site_id))
@@ -275,7 +618,7 @@ class Site:
             if self.variable_list[v_id].is_recovered == True:
                 if o_type == "read":
                 # cannot read duplicated(even-index) variables
-                    if v_id%2 == 0:
+                    if self.variable_list[v_id].replicated:
                         if debugMode:
                             print("Failed. read duplicated variable {} on recovery site {}".format(v_id, self.site_id))
                         return False
@@ -321,12 +664,13 @@ class Site:
             return False
 
 
-    def commit(self, operation, transaction):
+    def commit(self, operation, transaction, version = None):
         """Commit an operation.
         Read operations do not need commit and always return True.
         Input:
             operation: the operation to commit.
             transaction: the transaction that the operation belongs to
+            version: version number of the commit, default the next one of this replica.
         Output:
             Whether the operation commits successfully.
         """
@@ -349,7 +693,7 @@ class Site:
             if self.variable_list[v_id].is_recovered == True:
                 if o_type == "write":
                 # set is_recovered to False
-                    self.variable_list[v_id].commit()
+                    self.variable_list[v_id].commit(version, self.horizon)
                     self.variable_list[v_id].is_recovered = False
                     if debugMode:
                         print("commit done. T{} commit value {} to RECOVERED variable {} on site{}.".format(
@@ -362,7 +706,7 @@ class Site:
 
             elif self.status == "available":
                 if o_type == "write":
-                    self.variable_list[v_id].commit()
+                    self.variable_list[v_id].commit(version, self.horizon)
                     if debugMode:
                         print("commit done. T{} commit value {} to variable {} on site{}".format(
                     transaction.txId, self.variable_list[v_id].get_commited_value(), v_id, self.site_id))
@@ -419,17 +763,23 @@ class Variable:
     args:
         variable_id: id of the variable
         value: value of the variable
-        commited_value: a dict of (commited_time, commited_value)
-        lock_status: lock status on this variable: 'free', 'read', 'write'
+        commited_value: a dict of (commited_time, (commited_value, version))
+        lock_status: lock status on this variable: 'free', 'read', 'update', 'write'
         is_recovered: whether the variable is recently recovered and yet has no write commit.
+        version: version number of the lastest commit, used to find the newest replica in a quorum.
+        replicated: whether other sites store the variable too (a recovered replica can't be read until written).
     """
-    def __init__(self, variable_id, value, c_value):
+    __slots__ = ('variable_id', 'value', 'commited_value', 'lock_status', 'is_recovered', 'version', 'replicated')
+
+    def __init__(self, variable_id, value, c_value, replicated = False):
         self.variable_id = variable_id
         self.value = value
         self.commited_value = dict()
-        self.commited_value[datetime.now()] = c_value
+        self.commited_value[datetime.now()] = (c_value, 0)
         self.lock_status = "free"
         self.is_recovered = False
+        self.version = 0
+        self.replicated = replicated
 
     def set_value(self, value):
         """write value.
@@ -438,11 +788,27 @@ class Variable:
         """
         self.value = value
 
-    def commit(self):
+    def commit(self, version = None, horizon = None):
         """commit the current value.
         set commited value as current value.
+        Input:
+            version: version number of the commit, default the next one.
+            horizon: drop the commits no read at or after this time can see, None - keep them all.
+        """
+        self.version = self.version + 1 if version is None else version
+        self.commited_value[datetime.now()] = (self.value, self.version)
+        if horizon is not None:
+            self.prune(horizon)
+
+    def prune(self, horizon):
+        """Drop the commits before the lastest one at or before a time.
+        Commits are kept in time order, so only the dropped ones and the next are looked at.
+        Input:
+            horizon: the time.
         """
-        self.commited_value[datetime.now()]  = self.value
+        old = list(takewhile(lambda t: t <= horizon, self.commited_value))
+        for t in old[:-1]:
+            del self.commited_value[t]
         
     def get_commited_value(self, time = None):
         """Get lastest commited value before given time.
@@ -456,12 +822,34 @@ class Variable:
             time = datetime.now()
         tmax = datetime.fromtimestamp(0)
         res = None
-        for t, v in self.commited_value.items():
+        for t, (v, _) in self.commited_value.items():
             if t > tmax and t<=time:
                 res = v
                 tmax = t
         return res
     
+    def last_commit_time(self, time = None):
+        """Get the time of the lastest commit.
+        Input:
+            time: the timepoint before which we want the lastest commit, default now.
+        """
+        if time is None:
+            return max(self.commited_value)
+        return max((t for t in self.commited_value if t <= time), default = datetime.fromtimestamp(0))
+
+    def catch_up(self, source):
+        """Copy the commits missed while the site was down from another replica.
+        Input:
+            source: the up-to-date replica of this variable.
+        """
+        last = self.last_commit_time()
+        for t, v in source.commited_value.items():
+            if t > last:
+                self.commited_value[t] = v
+        self.value = self.get_commited_value()
+        self.version = source.version
+        self.is_recovered = False
+
     def undo(self):
         """undo value.
         Cover the value by lastest commited value.
@@ -469,12 +857,14 @@ class Variable:
         self.value = self.get_commited_value()
         
 class Lock:
+    __slots__ = ('transaction_id', 'variable_id', 'lock_type')
+
     def __init__(self, transaction_id, variable_id, lock_type):
         """a class of the lock
         args:
             transaction_id: the transaction which wants to apply this lock.
             variable_id: the varaible on which the lock is applied
-            lock_type: the type of the lock: 'read', 'write'
+            lock_type: the type of the lock: 'read', 'update' (a read which may be upgraded to write), 'write'
         """
         self.transaction_id = transaction_id
         self.variable_id = variable_id
@@ -492,19 +882,42 @@ class Operation:
         opType: read, write
         varId: variable_id
         val: value to write if any
-        opId: the id of operation
+        opId: the id of operation, increasing in the order operations are created
         txId: the transaction that operation belongs to
         exec: whether this operation has been executed
-        locks: a list of locks acquired by this operation
+        locks: a list of locks acquired by this operation (empty tuple until it gets one)
+        lock: the lock this operation applies on every site, created once when first needed
+        lockType: type of that lock if it isn't opType ('update' for a read before a write)
+        waitStart: tick it entered the waitlist
+        timer: its pending lock-wait timeout (or retry) in the timer wheel of the manager, None - none
+        timeouts: how many times its lock wait timed out
+        parked: whether it backs off after a timeout, it isn't granted a lock until it retries
     """
+    __slots__ = ('opType', 'varId', 'val', 'opId', 'txId', 'exec', 'locks', '_lock', 'lockType', 'waitStart',
+                 'timer', 'timeouts', 'parked')
+
     def __init__(self, txId, opType, varId, val=None):
         self.opType = opType # 'read' or 'write'
         self.varId = varId
         self.val = val
-        self.opId = datetime.now()
+        self.opId = next(opCounter)
         self.txId = txId
         self.exec = False
-        self.locks = list() # locks acquired (represented by site index)
+        self.locks = () # locks acquired (represented by site index)
+        self._lock = None
+        self.lockType = None
+        self.waitStart = None
+        self.timer = None
+        self.timeouts = 0
+        self.parked = False
+
+    @property
+    def lock(self):
+        """The same lock object is applied and released on every site.
+        """
+        if self._lock is None:
+            self._lock = Lock(self.txId, self.varId, self.lockType or self.opType)
+        return self._lock
 
 class Transaction:
     """definition of a transaction: a list of operations
@@ -515,7 +928,23 @@ class Transaction:
         ops: a list of operations of this transaction
         startTime: the start time of the transaction
         accessedFailedSite: a list of sites that ever failed after the transaction accessed them.
+        priority: priority of the transaction, the lower one is aborted first in a deadlock.
+        mode: concurrency control of a RW transaction: '2PL' (locking), 'OCC' (optimistic)
+              or 'SI' (snapshot isolation)
+        readSet: variables read by an OCC transaction, validated at commit
+        writeSet: writes of an OCC (buffered until commit) or SI transaction (variable: value)
+        declared: lock type of every variable a conservative 2PL transaction declared at begin
+                  (variable: 'read' or 'write'), None - it locks incrementally
+        deferred: operations submitted while a declared transaction waits for its locks,
+                  None - it is running
+        buffered: whether a 2PL transaction keeps its writes in writeSet until commit (deferred updates)
+        ranges: key ranges a 2PL transaction locked, (first key, last key)
+        timeout: how long each of its ops may wait for a lock, None - the manager's lock timeout
     """
+    __slots__ = ('txId', 'txType', 'abort', 'ops', 'startTime', 'accessedFailedSite',
+                 'priority', 'mode', 'readSet', 'writeSet', 'declared', 'deferred',
+                 'buffered', 'ranges', 'timeout')
+
     def __init__(self, txId, txType = "RW"):
         self.txId = txId
         self.txType = txType
@@ -523,6 +952,15 @@ class Transaction:
         self.ops = list()
         self.startTime = datetime.now()
         self.accessedFailedSite = list()
+        self.priority = 0
+        self.mode = "2PL"
+        self.readSet = set()
+        self.writeSet = dict()
+        self.declared = None
+        self.deferred = None
+        self.buffered = False
+        self.ranges = list()
+        self.timeout = None
 
     def addOp(self, op):
         """Add operation to the transaction.
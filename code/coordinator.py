@@ -0,0 +1,356 @@
+"""coordinator.py runs several transaction managers over the same sites.
+Each manager owns the transactions whose id falls in its partition (txId % number of managers)
+and keeps its own waitlist and waits-for graph, so it finds the deadlocks among its own
+transactions. Deadlocks spanning managers are found by the coordinator every globalDetectEvery
+commands: it asks every manager for a report of its waits (lock holders at the sites and its
+waiting ops), merges the reports into one graph and aborts victims through their owners until
+no cycle is left.
+
+Every manager runs on a worker thread of its own and is only driven by messages: the coordinator
+sends it commands and report requests and reads its replies. By default every command is waited
+for, so outputs come in the order of the input; pipelined (see benchmark.py) sends commands
+without waiting and lets the managers run side by side until the next distributed detection,
+which waits for all of them. The managers share the sites, so a
+worker holds the shared latch while it runs a command: on CPython the workers overlap in
+waiting for their messages, not in running transactions.
+
+The coordinator has the same interface as TransactionManager, so the parser can drive either.
+
+The details of classes and methods are specified below every definition of them.
+"""
+from bisect import bisect_right
+from collections import ChainMap, Counter
+from datetime import datetime
+from functools import partial
+from queue import Queue
+import threading
+import weakref
+from graph import Graph
+from TransactionManager import TransactionManager, waitPercentiles
+from components import conflicts, debugMode
+import victims
+import snapshot
+import checkpoint
+
+
+class Worker:
+    """Worker runs the commands sent to one transaction manager on a thread of its own.
+    args:
+        manager: the transaction manager
+        latch: lock of the sites shared by all managers, held while a command runs
+        inbox: queue of (command, reply queue) messages, None stops the thread
+    """
+    def __init__(self, manager, latch):
+        self.manager = manager
+        self.latch = latch
+        self.inbox = Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            message = self.inbox.get()
+            if message is None:
+                return
+            command, reply = message
+            try:
+                with self.latch:
+                    reply.put((True, command()))
+            except Exception as e:
+                reply.put((False, e))
+
+    def send(self, command):
+        """Send a command without waiting for it.
+
+        INPUT:
+            command(function without arguments, run on the worker thread)
+        OUTPUT:
+            the queue its reply (succeeded, result or exception) is put on
+        """
+        reply = Queue(1)
+        self.inbox.put((command, reply))
+        return reply
+
+    def call(self, command):
+        """Send a command and wait for its result, exceptions are raised again here.
+        """
+        return result(self.send(command))
+
+    def stop(self):
+        self.inbox.put(None)
+
+
+def result(reply):
+    """Wait for the reply of a worker and return its result or raise its exception.
+    """
+    ok, value = reply.get()
+    if not ok:
+        raise value
+    return value
+
+
+def stopWorkers(workers):
+    for worker in workers:
+        worker.stop()
+
+
+class Coordinator:
+    """Coordinator routes operations to the manager owning their transaction.
+    args:
+        managers: list of transaction managers sharing sites, varSite and background queues
+        globalDetectEvery: run the distributed deadlock detection every globalDetectEvery commands
+                           (the managers' own detectEvery is passed to them with the other options)
+        commands: number of commands routed so far, the logical time of snapshots
+        commitTimes: (commands, time) after each command which committed transactions,
+                     since the lastest one at least historyTicks commands ago (see TransactionManager)
+        committed: commits of all managers when commitTimes was last updated
+        transactions: view of the transactions of all managers
+        workers: the worker thread of every manager
+        pipelined: False - wait for every command, True - only send it (see drain)
+        pending: replies of the commands sent while pipelined
+    """
+    def __init__(self, numManagers=2, globalDetectEvery=10, **options):
+        if numManagers < 1 or globalDetectEvery < 1:
+            raise ValueError("Number of managers and detection interval must be positive")
+        self.globalDetectEvery = globalDetectEvery
+        self.commands = 0
+        self.managers = [TransactionManager(**options) for _ in range(numManagers)]
+        first = self.managers[0]
+        for tm in self.managers[1:]:
+            tm.sites = first.sites
+            tm.varSite = first.varSite
+            tm.ring = first.ring
+            tm.migrations = first.migrations
+            tm.catchupQueue = first.catchupQueue
+        for tm in self.managers:
+            tm.peers = [peer for peer in self.managers if peer is not tm]
+        self.transactions = ChainMap(*[tm.transactions for tm in self.managers])
+        # the initial values count as committed before the first command
+        self.commitTimes = [(0, datetime.now())]
+        self.committed = 0
+        self.pipelined = False
+        self.startWorkers()
+
+    def startWorkers(self):
+        self.latch = threading.Lock()
+        self.workers = [Worker(tm, self.latch) for tm in self.managers]
+        self.pending = list()
+        # the threads only hold the workers, they stop once the coordinator is gone
+        weakref.finalize(self, stopWorkers, list(self.workers))
+
+    def __getstate__(self):
+        # a checkpoint keeps the managers, the threads are started again when it's loaded
+        state = dict(self.__dict__)
+        for name in ('latch', 'workers', 'pending'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.startWorkers()
+
+    def managerOf(self, txId):
+        """The manager owning a transaction id.
+        """
+        return self.managers[txId % len(self.managers)]
+
+    def send(self, manager, command):
+        """Send a command to the worker of a manager, and wait for it unless pipelined.
+
+        INPUT:
+            manager(one of the managers), command(function without arguments)
+        OUTPUT:
+            the result of the command, None when pipelined
+        """
+        worker = self.workers[self.managers.index(manager)]
+        if self.pipelined:
+            self.pending.append(worker.send(command))
+            return None
+        return worker.call(command)
+
+    def route(self, txId, method, *args):
+        """Send an op to the manager owning its transaction.
+        Like the parser, ops of transactions which already ended are dropped.
+
+        OUTPUT:
+            the result of the op, False if it was dropped, None when pipelined
+        """
+        manager = self.managerOf(txId)
+        def command():
+            if txId not in manager.transactions:
+                return False
+            return getattr(manager, method)(txId, *args)
+        return self.send(manager, command)
+
+    def drain(self):
+        """Wait for the commands sent while pipelined, the first exception of one is raised here.
+        """
+        pending, self.pending = self.pending, list()
+        for reply in pending:
+            result(reply)
+
+    def tick(self):
+        """Count a command and run the distributed deadlock detection when it's due.
+        Commits made by the previous command are logged first.
+        """
+        committed = sum(tm.stats['commit'] for tm in self.managers)
+        if committed != self.committed:
+            self.committed = committed
+            self.commitTimes.append((self.commands, datetime.now()))
+        self.commands += 1
+        historyTicks = self.managers[0].historyTicks
+        if historyTicks is not None:
+            # a manager keeps the commits of its last historyTicks commands, so all sites keep those
+            i = bisect_right(self.commitTimes, (self.commands - historyTicks, datetime.max))
+            if i > 1:
+                del self.commitTimes[:i - 1]
+        if self.commands % self.globalDetectEvery == 0:
+            self.detectDeadlock()
+
+    def waitsFor(self):
+        """Collect the waits-for edges of all managers from their reports (see TransactionManager.waitReport).
+        A waiting op waits for the other transactions holding a conflicting lock on its
+        variable at any site (or a range read or coarse lock keeping it from the variable), and for conflicting
+        ops of other transactions queued before it in any manager (operation ids give the global order).
+
+        OUTPUT:
+            list of (waiting txId, holding txId)
+        """
+        edges = list()
+        # only ops on the same variable can wait for each other
+        byVar = dict()
+        for worker in self.workers:
+            held, waiting = worker.call(worker.manager.waitReport)
+            edges.extend(held)
+            for op in waiting:
+                byVar.setdefault(op[2], list()).append(op)
+        for ops in byVar.values():
+            for opId, txId, _, lockType in ops:
+                for otherId, otherTxId, _, otherType in ops:
+                    if otherId < opId and otherTxId != txId and conflicts(lockType, otherType):
+                        edges.append((txId, otherTxId))
+        return edges
+
+    def detectDeadlock(self):
+        """Merge the waits-for edges into one graph, pick victims until no cycle is left
+        (see Graph.breakCycles) and abort each through the manager owning it.
+        """
+        # commands sent while pipelined finish first, so the reports and the victims agree
+        self.drain()
+        graph = Graph()
+        for txId in self.transactions:
+            graph.insertVertex(txId)
+        for waiter, holder in self.waitsFor():
+            if holder in self.transactions:
+                graph.addEdge(waiter, holder)
+        def choose(cycle):
+            txs = [self.transactions[v.vId] for v in cycle]
+            if debugMode:
+                print("Distributed deadlock detected: ", [tx.txId for tx in txs])
+            txId = victims.chooseVictim(txs, self.managers[0].victimPolicy).txId
+            return next(v for v in cycle if v.vId == txId)
+        for v in graph.breakCycles(choose):
+            victim = self.transactions[v.vId]
+            manager = self.managerOf(victim.txId)
+            self.send(manager, partial(manager.abort, victim))
+
+    def startTx(self, txType, txId, *args, **kwargs):
+        self.tick()
+        manager = self.managerOf(txId)
+        self.send(manager, partial(manager.startTx, txType, txId, *args, **kwargs))
+
+    def readOp(self, txId, varId, update=False):
+        self.tick()
+        self.route(txId, 'readOp', varId, update)
+
+    def writeOp(self, txId, varId, value):
+        self.tick()
+        self.route(txId, 'writeOp', varId, value)
+
+    def batchOp(self, txId, statements):
+        self.tick()
+        self.route(txId, 'batchOp', statements)
+
+    def rangeOp(self, txId, low, high):
+        self.tick()
+        self.route(txId, 'rangeOp', low, high)
+
+    def endTx(self, txId):
+        self.tick()
+        return self.route(txId, 'endTx')
+
+    def failOp(self, siteId):
+        self.tick()
+        # marks the transactions of every manager
+        self.send(self.managers[0], partial(self.managers[0].failOp, siteId))
+
+    def recoverOp(self, siteId):
+        self.tick()
+        # waitlists of the other managers are executed through their peers
+        self.send(self.managers[0], partial(self.managers[0].recoverOp, siteId))
+
+    def addSite(self, siteId):
+        self.tick()
+        self.send(self.managers[0], partial(self.managers[0].addSite, siteId))
+
+    def removeSite(self, siteId):
+        self.tick()
+        self.send(self.managers[0], partial(self.managers[0].removeSite, siteId))
+
+    def dumpOp(self, dumpsites=None):
+        self.tick()
+        self.send(self.managers[0], partial(self.managers[0].dumpOp, dumpsites))
+
+    def exportOp(self, path, time=None):
+        """Write the committed state of all sites after a number of commands (default all)
+        to a CSV or .npy file.
+        """
+        self.tick()
+        self.drain()
+        if time is not None and time < self.commitTimes[0][0]:
+            print("Commits before command {} are no longer kept, see --history_ticks.".format(self.commitTimes[0][0]))
+            return
+        cutoff = None if time is None else snapshot.cutoffTime(self.commitTimes, time)
+        columns = self.workers[0].call(partial(snapshot.collect, self.managers[0].sites, cutoff))
+        try:
+            snapshot.write(columns, path)
+        except ValueError as e:
+            print(e)
+            return
+        print("Exported {} variables to {}.".format(len(columns['site']), path))
+
+    def checkpointOp(self, path):
+        """Save the complete state of the coordinator and its managers to a file.
+        """
+        self.tick()
+        self.drain()
+        with self.latch:
+            checkpoint.save(self, path)
+        print("Checkpoint saved to {}.".format(path))
+
+    def summary(self):
+        """Throughput and abort rate of all managers together.
+        """
+        self.drain()
+        summaries = [tm.summary() for tm in self.managers]
+        total = dict(summaries[0])
+        total['managers'] = len(self.managers)
+        total['commits'] = sum(s['commits'] for s in summaries)
+        total['aborts'] = sum(s['aborts'] for s in summaries)
+        total['throughput'] = sum(s['throughput'] for s in summaries)
+        reasons = dict()
+        wasted = dict()
+        for s in summaries:
+            for key, val in s['abortsByReason'].items():
+                reasons[key] = reasons.get(key, 0) + val
+            for key, val in s['wasted'].items():
+                wasted[key] = wasted.get(key, 0) + val
+        total['abortsByReason'] = reasons
+        total['wasted'] = wasted
+        waits = dict()
+        for tm in self.managers:
+            for cls, classWaits in tm.lockWaits.items():
+                waits.setdefault(cls, Counter()).update(classWaits)
+        total['lockWait'] = {cls: waitPercentiles(classWaits) for cls, classWaits in sorted(waits.items())}
+        finished = total['commits'] + total['aborts']
+        total['abortRate'] = total['aborts'] / finished if finished else 0.0
+        return total
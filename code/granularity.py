@@ -0,0 +1,189 @@
+"""granularity.py keeps the coarse locks of a site for multi-granularity locking.
+Locks form a hierarchy: the site, its key ranges, and the variables in each range.
+Variable locks stay in Site.lock_table; the site and its ranges are locked in one of the modes
+    IS, IX: the transaction reads (IS) or writes (IX) some variables below
+    S, X: it reads (S) or writes (X) everything below
+    SIX: S plus IX, it reads everything below and writes some variables
+A transaction taking a variable lock takes the intention mode on its range and site first.
+Once it holds more than escalateAfter locks below one range (or locks in more than escalateAfter
+ranges of the site), they are escalated: one S or X lock replaces them.
+
+The details of classes and methods are specified below every definition of them.
+"""
+
+# keys in one range: integer keys by RANGE_WIDTH consecutive values, names by first character
+RANGE_WIDTH = 100
+SITE = ('site',)
+# intention mode a variable lock needs on the granules above it
+INTENTION = {'read': 'IS', 'update': 'IS', 'write': 'IX'}
+# pairs of modes two transactions can hold on the same granule
+COMPATIBLE = {('IS', 'IS'), ('IS', 'IX'), ('IS', 'S'), ('IS', 'SIX'),
+              ('IX', 'IS'), ('IX', 'IX'), ('S', 'IS'), ('S', 'S'), ('SIX', 'IS')}
+
+
+def rangeOf(key):
+    """The key range (granule below the site) a key belongs to.
+    """
+    if isinstance(key, int):
+        return ('range', 0, key // RANGE_WIDTH)
+    return ('range', 1, str(key)[:1])
+
+
+def combine(held, wanted):
+    """Weakest mode granting everything of two modes.
+
+    INPUT:
+        held(mode held, None - nothing), wanted(mode needed)
+    OUTPUT:
+        the combined mode
+    """
+    if held is None or held == wanted:
+        return wanted
+    pair = {held, wanted}
+    if 'X' in pair:
+        return 'X'
+    if pair == {'IS', 'IX'}:
+        return 'IX'
+    if pair == {'IS', 'S'}:
+        return 'S'
+    return 'SIX'
+
+
+class LockHierarchy:
+    """Modes held on the site and its key ranges.
+    args:
+        escalateAfter: locks of a transaction below one granule above which they are escalated,
+                       None - multi-granularity locking is off
+        modes: mode of every transaction holding one on a granule (granule: {txId: mode})
+        children: what a transaction locked below a granule, variables below a range
+                  and ranges below the site ((granule, txId): set)
+    """
+    __slots__ = ('escalateAfter', 'modes', 'children')
+
+    def __init__(self, escalateAfter=None):
+        self.escalateAfter = escalateAfter
+        self.modes = dict()
+        self.children = dict()
+
+    @property
+    def enabled(self):
+        return self.escalateAfter is not None
+
+    def mode(self, granule, txId):
+        """Mode a transaction holds on a granule, None - it holds none.
+        """
+        holders = self.modes.get(granule)
+        return holders.get(txId) if holders else None
+
+    def covers(self, key, txId, lockType):
+        """Whether a coarse lock of the transaction above a variable already grants a lock on it.
+        """
+        for granule in (SITE, rangeOf(key)):
+            mode = self.mode(granule, txId)
+            if mode == 'X' or (lockType == 'read' and mode in ('S', 'SIX')):
+                return True
+        return False
+
+    def blocking(self, key, txId, lockType):
+        """Other transactions whose modes on the site or the range of a variable conflict
+        with the intention mode a lock on it needs.
+
+        OUTPUT:
+            set of transaction ids
+        """
+        wanted = INTENTION[lockType]
+        holders = set()
+        for granule in (SITE, rangeOf(key)):
+            mine = combine(self.mode(granule, txId), wanted)
+            for other, mode in self.modes.get(granule, {}).items():
+                if other != txId and (mine, mode) not in COMPATIBLE:
+                    holders.add(other)
+        return holders
+
+    def coarseHolders(self, key):
+        """Transactions holding S, SIX or X above a variable.
+        """
+        holders = set()
+        for granule in (SITE, rangeOf(key)):
+            for txId, mode in self.modes.get(granule, {}).items():
+                if mode in ('S', 'SIX', 'X'):
+                    holders.add(txId)
+        return holders
+
+    def granted(self, txId, key, lockType):
+        """Take the intention modes of a variable lock just granted.
+
+        OUTPUT:
+            granules below which the transaction's locks are due for escalation, the range first
+        """
+        wanted = INTENTION[lockType]
+        granule = rangeOf(key)
+        for g in (SITE, granule):
+            holders = self.modes.setdefault(g, dict())
+            holders[txId] = combine(holders.get(txId), wanted)
+        variables = self.children.setdefault((granule, txId), set())
+        variables.add(key)
+        ranges = self.children.setdefault((SITE, txId), set())
+        ranges.add(granule)
+        due = list()
+        if len(variables) > self.escalateAfter:
+            due.append(granule)
+        if len(ranges) > self.escalateAfter:
+            due.append(SITE)
+        return due
+
+    def released(self, txId, key):
+        """A variable lock of the transaction was released before its end.
+        """
+        variables = self.children.get((rangeOf(key), txId))
+        if variables:
+            variables.discard(key)
+
+    def escalate(self, granule, txId, writes):
+        """Replace the locks of a transaction below a granule by a coarse lock, if no other
+        transaction holds a conflicting mode on it.
+
+        INPUT:
+            granule(SITE or a range), txId(transaction id)
+            writes(whether it holds write or update locks below the granule: X, otherwise S)
+        OUTPUT:
+            True - escalated, the caller drops its variable locks below the granule
+        """
+        target = combine(self.mode(granule, txId), 'X' if writes else 'S')
+        for other, mode in self.modes.get(granule, {}).items():
+            if other != txId and (target, mode) not in COMPATIBLE:
+                return False
+        self.modes[granule][txId] = target
+        if granule == SITE:
+            # the site lock covers its ranges
+            for g in self.children.pop((SITE, txId), ()):
+                self.children.pop((g, txId), None)
+                holders = self.modes.get(g)
+                if holders:
+                    holders.pop(txId, None)
+                    if not holders:
+                        del self.modes[g]
+        else:
+            self.children[(granule, txId)] = set()
+        return True
+
+    def release(self, txId):
+        """Release all modes of an ended transaction.
+
+        OUTPUT:
+            granules where it held a mode other than IS (only those can block a lock of others)
+        """
+        coarse = set()
+        # it holds modes on the site and on the ranges it locked below
+        granules = self.children.pop((SITE, txId), set())
+        granules.add(SITE)
+        for granule in granules:
+            self.children.pop((granule, txId), None)
+            holders = self.modes.get(granule)
+            if not holders or txId not in holders:
+                continue
+            if holders.pop(txId) != 'IS':
+                coarse.add(granule)
+            if not holders:
+                del self.modes[granule]
+        return coarse
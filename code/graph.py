@@ -15,6 +15,8 @@ class Vertex:
         visited: if it's visited in a dfs
         adj: set of its neighbours
     """
+    __slots__ = ('vId', 'visited', 'adj')
+
     def __init__(self, vId):
         self.vId = vId
         self.visited = 0 # flag used in cycle detection
@@ -54,10 +56,22 @@ class Graph:
         INPUT:
             vId(index of vertex to be inserted)
         """
-        v = Vertex(vId)
-        if v not in self.vertices:
-            self.vertices.append(v)
+        if self.getVertex(vId) is None:
+            self.vertices.append(Vertex(vId))
     
+    def __getstate__(self):
+        """Pickle the edges by vertex index, so a long chain of waits isn't pickled recursively.
+        """
+        return [(v.vId, [u.vId for u in v.adj]) for v in self.vertices]
+
+    def __setstate__(self, state):
+        self.vertices = [Vertex(vId) for vId, _ in state]
+        byId = dict()
+        for v in self.vertices:
+            byId.setdefault(v.vId, v)
+        for v, (_, adj) in zip(self.vertices, state):
+            v.adj = set(byId[uId] for uId in adj)
+
     def getVertex(self, vId):
         """Find a particular vertex in the graph
 
@@ -89,12 +103,16 @@ class Graph:
     def addEdge(self, vId, uId):
         """Add vertex uId to vertex vId's adjacent list
         Then there's an edge pointing from v to u
-        
+        u is inserted first if it's not in the graph yet (a transaction of another manager)
+
         INPUT:
             uId(index of the current lock holder), vId(index of the waiting tx)
         """
         v = self.getVertex(vId)
         u = self.getVertex(uId)
+        if u is None:
+            u = Vertex(uId)
+            self.vertices.append(u)
         v.addAdj(u)
 
     def deleteEdge(self, vId, uId):
@@ -144,6 +162,86 @@ class Graph:
                         cycle.append(w)
         stack.pop(-1)
 
+    def findCycles(self, removed=()):
+        """Find all deadlocks in one pass (Tarjan's strongly connected components).
+        Every component with more than one vertex, or a vertex waiting for itself,
+        contains at least one cycle. A component can hold several cycles which don't share
+        a vertex, so removing one vertex of each doesn't always break them (see breakCycles).
+
+        INPUT:
+            removed(vertices left out of the search, with their edges)
+        OUTPUT:
+            cycles(list of lists of vertices, one list per strongly connected component)
+        """
+        index = dict()   # vertex: dfs order
+        low = dict()     # vertex: lowest dfs order reachable
+        onStack = set()
+        stack = list()
+        cycles = list()
+        counter = 0
+        for root in self.vertices:
+            if root in index or root in removed:
+                continue
+            # iterative dfs, each frame is (vertex, iterator over its neighbours)
+            index[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            onStack.add(root)
+            work = [(root, iter(root.adj))]
+            while work:
+                v, neighbours = work[-1]
+                advanced = False
+                for u in neighbours:
+                    if u in removed:
+                        continue
+                    if u not in index:
+                        index[u] = low[u] = counter
+                        counter += 1
+                        stack.append(u)
+                        onStack.add(u)
+                        work.append((u, iter(u.adj)))
+                        advanced = True
+                        break
+                    elif u in onStack:
+                        low[v] = min(low[v], index[u])
+                if advanced:
+                    continue
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[v])
+                if low[v] == index[v]:
+                    component = list()
+                    while True:
+                        w = stack.pop()
+                        onStack.discard(w)
+                        component.append(w)
+                        if w is v:
+                            break
+                    if len(component) > 1 or v in v.adj:
+                        cycles.append(component)
+        return cycles
+
+    def breakCycles(self, choose):
+        """Pick victims until no cycle is left: one in every strongly connected component,
+        then the graph is searched again without them, until no component has a cycle.
+
+        INPUT:
+            choose(function of a component, a list of vertices, returning the vertex to remove)
+        OUTPUT:
+            victims(list of the vertices chosen, in the order they were chosen)
+        """
+        victims = list()
+        removed = set()
+        cycles = self.findCycles()
+        while cycles:
+            for cycle in cycles:
+                victim = choose(cycle)
+                victims.append(victim)
+                removed.add(victim)
+            cycles = self.findCycles(removed)
+        return victims
+
 
 # testing
 if __name__ == '__main__':
@@ -167,6 +265,7 @@ if __name__ == '__main__':
     graph.addEdge(6, 7)
     graph.addEdge(7, 5)
     print(graph.detectCycle())
+    print([[v.vId for v in cycle] for cycle in graph.findCycles()])
     graph.deleteVertex(4)
     print(graph.detectCycle())
     graph.deleteVertex(5)
@@ -0,0 +1,137 @@
+"""keyindex.py keeps the keys of a site in order, for range reads.
+A key is an integer (x1 is key 1) or a string. Integers come first in numeric order,
+then strings in lexical order, so keys of both kinds can be compared.
+
+The index stores the keys in sorted blocks: a sorted list of blocks, each a sorted list of
+at most BLOCK keys. Finding a key is two binary searches and inserting one shifts a
+single block, so it stays cheap with millions of keys.
+
+The details of classes and methods are specified below every definition of them.
+"""
+from bisect import bisect_left, bisect_right
+
+# largest number of keys in a block, a full block is split in two
+BLOCK = 512
+
+
+def keyOrder(key):
+    """Sort key of a variable key: integers before strings.
+
+    INPUT:
+        key(an integer or a string)
+    OUTPUT:
+        a tuple comparable with the one of any other key, the key is its last item
+    """
+    if isinstance(key, int):
+        return (0, key)
+    return (1, key)
+
+
+def keyName(key):
+    """How a key is printed: x1 for integer keys, the key itself otherwise.
+    """
+    if isinstance(key, int):
+        return "x{}".format(key)
+    return str(key)
+
+
+class KeyIndex:
+    """An ordered index of keys in sorted blocks.
+    args:
+        blocks: list of sorted lists of keyOrder(key)
+        firsts: smallest entry of every block, to find the block of an entry
+        size: number of keys
+    """
+    __slots__ = ('blocks', 'firsts', 'size')
+
+    def __init__(self, keys=()):
+        self.blocks = list()
+        self.firsts = list()
+        self.size = 0
+        for key in keys:
+            self.add(key)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for block in self.blocks:
+            for entry in block:
+                yield entry[1]
+
+    def locate(self, entry):
+        """Index of the block an entry belongs to.
+        """
+        i = bisect_right(self.firsts, entry) - 1
+        return i if i > 0 else 0
+
+    def add(self, key):
+        """Insert a key, nothing happens if it is in the index already.
+
+        INPUT:
+            key(an integer or a string)
+        """
+        entry = keyOrder(key)
+        if not self.blocks:
+            self.blocks.append([entry])
+            self.firsts.append(entry)
+            self.size = 1
+            return
+        i = self.locate(entry)
+        block = self.blocks[i]
+        pos = bisect_left(block, entry)
+        if pos < len(block) and block[pos] == entry:
+            return
+        block.insert(pos, entry)
+        self.firsts[i] = block[0]
+        self.size += 1
+        if len(block) > BLOCK:
+            half = len(block) // 2
+            self.blocks.insert(i + 1, block[half:])
+            self.firsts.insert(i + 1, block[half])
+            del block[half:]
+
+    def discard(self, key):
+        """Remove a key if it is in the index.
+
+        INPUT:
+            key(an integer or a string)
+        """
+        if not self.blocks:
+            return
+        entry = keyOrder(key)
+        i = self.locate(entry)
+        block = self.blocks[i]
+        pos = bisect_left(block, entry)
+        if pos == len(block) or block[pos] != entry:
+            return
+        del block[pos]
+        self.size -= 1
+        if block:
+            self.firsts[i] = block[0]
+        else:
+            del self.blocks[i]
+            del self.firsts[i]
+
+    def range(self, low, high):
+        """Keys between two keys, both included, in order.
+
+        INPUT:
+            low(first key of the range), high(last key of the range)
+        OUTPUT:
+            generator of keys
+        """
+        if not self.blocks:
+            return
+        start = keyOrder(low)
+        end = keyOrder(high)
+        i = self.locate(start)
+        pos = bisect_left(self.blocks[i], start)
+        while i < len(self.blocks):
+            block = self.blocks[i]
+            for j in range(pos, len(block)):
+                if block[j] > end:
+                    return
+                yield block[j][1]
+            i += 1
+            pos = 0
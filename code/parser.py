@@ -6,8 +6,13 @@ Contribution of authors:
 The details of functions are specified below every definition of them.
 """
 
+import ast
 import re
 import TransactionManager
+import coordinator
+import ConcurrentTransactionManager
+import victims
+import checkpoint
 from absl import flags, app
 import time
 
@@ -15,7 +20,52 @@ FLAGS = flags.FLAGS
 debugMode = TransactionManager.debugMode
 
 flags.DEFINE_string('filename', None, 'test file directory')
-flags.mark_flag_as_required('filename')
+flags.DEFINE_enum('policy', 'detection', TransactionManager.TransactionManager.POLICIES,
+                  'deadlock handling policy of the transaction manager')
+flags.DEFINE_enum('victim', 'youngest', victims.NAMES, 'how to choose the transaction to abort in a deadlock')
+flags.DEFINE_enum('mode', '2PL', TransactionManager.TransactionManager.MODES,
+                  'concurrency control of RW transactions started with begin()')
+flags.DEFINE_integer('detect_every', None, 'look for deadlocks every N blocked operations '
+                     '(default: on every one, or only every --detect_ticks ticks when that is set)')
+flags.DEFINE_integer('detect_ticks', None, 'also look for deadlocks every N logical ticks')
+flags.DEFINE_integer('catchup_batch', 0,
+                     'replicated variables of recovered sites caught up per command (0 - off)')
+flags.DEFINE_enum('replication', 'available-copies', TransactionManager.TransactionManager.REPLICATIONS,
+                  'how replicated variables are read and written')
+flags.DEFINE_integer('read_quorum', None, 'replicas read by a quorum read of a replicated variable')
+flags.DEFINE_integer('write_quorum', None, 'replicas written by a quorum write of a replicated variable')
+flags.DEFINE_enum('placement', 'fixed', TransactionManager.TransactionManager.PLACEMENTS,
+                  'how variables are assigned to sites')
+flags.DEFINE_integer('replication_factor', 3, 'sites storing each even indexed variable under ring placement')
+flags.DEFINE_integer('migration_batch', 1, 'variables moved per command after a site is added or removed')
+flags.DEFINE_boolean('deferred_updates', False,
+                     '2PL transactions buffer their writes and write the replicas at commit')
+flags.DEFINE_enum('scheduling', 'fifo', TransactionManager.TransactionManager.SCHEDULINGS,
+                  'order in which released locks are granted to waiting operations')
+flags.DEFINE_integer('aging_ticks', 10, 'under age scheduling, ticks of waiting worth one priority level')
+flags.DEFINE_integer('escalate_after', None,
+                     'lock key ranges and sites too, escalating the locks of a transaction in a range '
+                     '(or ranges of a site) to one lock above this many')
+flags.DEFINE_integer('max_active', None,
+                     'admission control: most RW transactions running at once, later begins wait (RO ones never do)')
+flags.DEFINE_boolean('adaptive_admission', False,
+                     'lower the admission cap below max_active while transactions abort or ops pile up in the waitlist')
+flags.DEFINE_integer('history_ticks', 1000,
+                     'ticks of commit history kept for export(), older commits are dropped once no transaction reads them')
+flags.DEFINE_integer('lock_timeout', None,
+                     'abort (or retry) an op which waited this long for a lock, in ticks or ms (see timeout_clock)')
+flags.DEFINE_enum('timeout_clock', 'ticks', TransactionManager.TransactionManager.TIMEOUT_CLOCKS,
+                  'measure lock timeouts in logical ticks or in milliseconds of wall time')
+flags.DEFINE_enum('timeout_action', 'abort', TransactionManager.TransactionManager.TIMEOUT_ACTIONS,
+                  'on a lock timeout, abort the transaction or retry the op after a backoff')
+flags.DEFINE_integer('managers', 1, 'number of transaction managers sharing the sites')
+flags.DEFINE_integer('global_detect_every', 10,
+                     'with several managers, look for deadlocks across them every N commands')
+flags.DEFINE_boolean('concurrent', False,
+                     'run every transaction on its own client thread on the thread-safe manager')
+flags.DEFINE_string('restore', None,
+                    'start from a checkpoint saved by checkpoint(), the options of the run it was taken in apply')
+flags.DEFINE_boolean('stats', False, 'print throughput and abort rate at the end of the run')
 
 def lines():
     """Print a line.
@@ -33,6 +83,19 @@ def extractNum(target):
     temp = re.findall(r'\d+', target)
     return list(map(int, temp))[0]
 
+def extractKey(target):
+    """extract a variable key from given string.
+    Input:
+        target: x followed by a number (x3), a number, or any other name
+    Output:
+        the key: an integer for x3 and numbers, the stripped string otherwise.
+    """
+    target = target.strip()
+    match = re.fullmatch(r'x?(\d+)', target)
+    if match:
+        return int(match.group(1))
+    return target
+
 def extractContent(line):
     """extract items in the parenthesis in a string.
     Input:
@@ -49,23 +112,94 @@ def extractContent(line):
     content = [i for i in content if i]
     return content
 
+def extractOptions(content):
+    """extract key=value options given after the positional items.
+    Input:
+        content: a list of strings in the parenthesis
+    Output:
+        a dict of option name and value (strings).
+    """
+    options = dict()
+    for item in content:
+        if '=' in item:
+            key, val = item.split('=', 1)
+            options[key.strip()] = val.strip()
+    return options
+
+def extractStatements(line):
+    """extract the transaction and the operations of a batch command.
+    Input:
+        line: a batch command such as batch(T1; R x1; W x2 5)
+    Output:
+        the transaction id and a list of ('R', variable id) or ('W', variable id, value).
+    """
+    regex = re.compile(r'[(](.*?)[)]', re.S)
+    content = re.findall(regex, line)[0]
+    items = [i.strip() for i in content.split(";") if i.strip()]
+    statements = list()
+    for item in items[1:]:
+        tokens = item.replace(",", " ").split()
+        if tokens[0] == 'W':
+            statements.append(('W', extractKey(tokens[1]), int(tokens[2])))
+        else:
+            statements.append(('R', extractKey(tokens[1])))
+    return extractNum(items[0]), statements
+
+def extractDeclared(options):
+    """extract the declared read and write sets of a begin command.
+    Input:
+        options: options of the command, r and w list variables separated by spaces
+    Output:
+        a dict of variable id and lock type ('read' or 'write'), None if nothing is declared.
+    """
+    declared = dict()
+    for var in options.get('r', '').split():
+        declared[extractKey(var)] = 'read'
+    for var in options.get('w', '').split():
+        declared[extractKey(var)] = 'write'
+    return declared or None
+
 def parse_line(line, tx_manager): 
     """Parse the give line and invoke transaction manager to execute.
     Parser is able to read the following lines:
         begin(T1)
+        begin(T1, priority=2): priority class of T1, the lower one is aborted first by the priority
+                               victim policy and served last by priority and age lock scheduling
+        begin(T1, r=x1 x3, w=x2): T1 reads x1 and x3 and writes x2, it takes all locks before running
+        begin(T1, timeout=5): an op of T1 waits at most 5 ticks (or ms) for a lock, see --lock_timeout
         beginRO(T1)
+        beginOCC(T1): RW transaction using optimistic concurrency control
+        beginSI(T1): RW transaction using snapshot isolation
         W(T1, x10, 3)
         R(T1, x3)
+        R(T1, user42): variables are x1..x20 at start, any other key is created when first accessed
+        RR(T1, x3, x8): read every key from x3 to x8 in key order (integer keys first, then names)
+        U(T1, x3): read x3 under an update lock, T1's later write of x3 upgrades it without waiting for other updaters
+        batch(T1; R x1; W x2 5; R x4): several operations of T1 submitted at once
         end(T1)
         fail(3): site 3 fails
         recover(3): site 3 recovers
+        addsite(11): add site 11 to the ring (ring placement)
+        removesite(3): take site 3 off the ring (ring placement)
         dump(): dump all sites
         dump(1, 3, 5): dump site 1, 3, and 5
+        export(state.csv): write the committed state of all sites to a CSV file (or .npy with NumPy)
+        export(state.csv, 12): the committed state after logical tick 12
+        checkpoint(run.ckpt): save the state of the transaction manager, see --restore
     """   
     if line.startswith('begin('):
         content = extractContent(line)
         transaction_id = extractNum(content[0])
-        tx_manager.startTx('RW', transaction_id)
+        options = extractOptions(content[1:])
+        kwargs = dict()
+        if 'priority' in options:
+            kwargs['priority'] = int(options['priority'])
+        declared = extractDeclared(options)
+        if declared:
+            kwargs['declared'] = declared
+        if 'timeout' in options:
+            kwargs['timeout'] = int(options['timeout'])
+        tx_manager.startTx('RW', transaction_id, **kwargs)
         time.sleep(.0001)
         
     elif line.startswith('beginRO('):
@@ -74,10 +208,32 @@ def parse_line(line, tx_manager):
         tx_manager.startTx('RO', transaction_id)
         time.sleep(.01)
         
+    elif line.startswith('beginOCC('):
+        content = extractContent(line)
+        transaction_id = extractNum(content[0])
+        options = extractOptions(content[1:])
+        kwargs = dict()
+        if 'timeout' in options:
+            # rejected by the transaction manager, OCC transactions don't wait for locks
+            kwargs['timeout'] = int(options['timeout'])
+        tx_manager.startTx('RW', transaction_id, int(options.get('priority', 0)), 'OCC', **kwargs)
+        time.sleep(.0001)
+
+    elif line.startswith('beginSI('):
+        content = extractContent(line)
+        transaction_id = extractNum(content[0])
+        options = extractOptions(content[1:])
+        kwargs = dict()
+        if 'timeout' in options:
+            # rejected by the transaction manager, SI transactions don't wait for locks
+            kwargs['timeout'] = int(options['timeout'])
+        tx_manager.startTx('RW', transaction_id, int(options.get('priority', 0)), 'SI', **kwargs)
+        time.sleep(.0001)
+
     elif line.startswith('W('):
         content = extractContent(line)
         transaction_id = extractNum(content[0])
-        variable_id = extractNum(content[1])
+        variable_id = extractKey(content[1])
         variable_val = int(content[2])
         if transaction_id in tx_manager.transactions:
             tx_manager.writeOp(transaction_id, variable_id, variable_val)
@@ -88,13 +244,40 @@ def parse_line(line, tx_manager):
     elif line.startswith('R('):
         content = extractContent(line)
         transaction_id = extractNum(content[0])
-        variable_id = extractNum(content[1])
+        variable_id = extractKey(content[1])
         if transaction_id in tx_manager.transactions:
             tx_manager.readOp(transaction_id, variable_id)
         else:
             if debugMode:
                 print('Error: ', line)
                 print('T',transaction_id, " do not exists yet.")
+    elif line.startswith('U('):
+        content = extractContent(line)
+        transaction_id = extractNum(content[0])
+        variable_id = extractKey(content[1])
+        if transaction_id in tx_manager.transactions:
+            tx_manager.readOp(transaction_id, variable_id, True)
+        else:
+            if debugMode:
+                print('Error: ', line)
+                print('T',transaction_id, " do not exists yet.")
+    elif line.startswith('RR('):
+        content = extractContent(line)
+        transaction_id = extractNum(content[0])
+        if transaction_id in tx_manager.transactions:
+            tx_manager.rangeOp(transaction_id, extractKey(content[1]), extractKey(content[2]))
+        else:
+            if debugMode:
+                print('Error: ', line)
+                print('T',transaction_id, " do not exists yet.")
+    elif line.startswith('batch('):
+        transaction_id, statements = extractStatements(line)
+        if transaction_id in tx_manager.transactions:
+            tx_manager.batchOp(transaction_id, statements)
+        else:
+            if debugMode:
+                print('Error: ', line)
+                print('T',transaction_id, " do not exists yet.")
     elif line.startswith('end('):
         content = extractContent(line)
         transaction_id = extractNum(content[0])
@@ -109,6 +292,12 @@ def parse_line(line, tx_manager):
         content = extractContent(line)
         siteId = int(content[0])
         tx_manager.failOp(siteId)
+    elif line.startswith('addsite('):
+        content = extractContent(line)
+        tx_manager.addSite(int(content[0]))
+    elif line.startswith('removesite('):
+        content = extractContent(line)
+        tx_manager.removeSite(int(content[0]))
     elif line.startswith('dump('):
         content = extractContent(line)
         if len(content) == 0:
@@ -119,13 +308,109 @@ def parse_line(line, tx_manager):
             for s in content:
                 sites.append(int(s))
             tx_manager.dumpOp(sites)
+    elif line.startswith('checkpoint('):
+        content = extractContent(line)
+        tx_manager.checkpointOp(content[0])
+    elif line.startswith('export('):
+        content = extractContent(line)
+        if len(content) > 1:
+            tx_manager.exportOp(content[0], int(content[1]))
+        else:
+            tx_manager.exportOp(content[0])
+
+# flags of TransactionManager and Coordinator options which ConcurrentTransactionManager doesn't take
+CONCURRENT_UNSUPPORTED = ['policy', 'mode', 'detect_every', 'detect_ticks', 'catchup_batch', 'replication',
+                          'read_quorum', 'write_quorum', 'placement', 'replication_factor', 'migration_batch',
+                          'deferred_updates', 'scheduling', 'aging_ticks', 'escalate_after', 'max_active',
+                          'adaptive_admission', 'history_ticks', 'lock_timeout', 'timeout_clock',
+                          'timeout_action', 'managers', 'global_detect_every']
 
-def parse_file(filename):
+def manager_options():
+    """Collect the transaction manager options given on the command line.
+    Output:
+        a dict of keyword arguments of TransactionManager.
+    Raises ValueError for flags which can't be combined, such as --concurrent with any other manager option
+    than --victim.
+    """
+    options = {'policy': FLAGS.policy,
+            'victimPolicy': FLAGS.victim,
+            'defaultMode': FLAGS.mode,
+            'detectEvery': FLAGS.detect_every,
+            'detectTicks': FLAGS.detect_ticks,
+            'catchupBatch': FLAGS.catchup_batch,
+            'replication': FLAGS.replication,
+            'placement': FLAGS.placement,
+            'replicationFactor': FLAGS.replication_factor,
+            'migrationBatch': FLAGS.migration_batch,
+            'deferredUpdates': FLAGS.deferred_updates,
+            'scheduling': FLAGS.scheduling,
+            'agingTicks': FLAGS.aging_ticks,
+            'escalateAfter': FLAGS.escalate_after,
+            'maxActive': FLAGS.max_active,
+            'adaptiveAdmission': FLAGS.adaptive_admission,
+            'historyTicks': FLAGS.history_ticks,
+            'lockTimeout': FLAGS.lock_timeout,
+            'timeoutClock': FLAGS.timeout_clock,
+            'timeoutAction': FLAGS.timeout_action}
+    if (FLAGS.read_quorum is None) != (FLAGS.write_quorum is None):
+        raise ValueError("--read_quorum and --write_quorum must be given together")
+    if FLAGS.read_quorum is not None:
+        options['quorums'] = {'replicated': (FLAGS.read_quorum, FLAGS.write_quorum)}
+    if FLAGS.concurrent:
+        # ConcurrentTransactionManager only takes the victim policy
+        ignored = [name for name in CONCURRENT_UNSUPPORTED if FLAGS[name].value != FLAGS[name].default]
+        if ignored:
+            raise ValueError("--concurrent can't be combined with " + ", ".join('--' + name for name in ignored))
+        return {'concurrent': True, 'victimPolicy': FLAGS.victim}
+    if FLAGS.managers > 1:
+        options['numManagers'] = FLAGS.managers
+        options['globalDetectEvery'] = FLAGS.global_detect_every
+    return options
+
+def scenarioOptions(filename):
+    """read the manager options a test file needs to run as intended, given on comment lines such as
+        // options: placement=ring migrationBatch=4
+    Input:
+        filename: the directory of test text file.
+    Output:
+        a dict of keyword arguments of TransactionManager, a value is read as a Python literal or else as a string.
+    """
+    options = dict()
+    with open(filename) as fp:
+        for line in fp:
+            match = re.match(r'\s*//\s*options:(.*)', line)
+            if not match:
+                continue
+            for item in match.group(1).split():
+                key, _, value = item.partition('=')
+                try:
+                    options[key] = ast.literal_eval(value)
+                except (ValueError, SyntaxError):
+                    options[key] = value
+    return options
+
+def parse_file(filename, options=None, restore=None):
     """read in given file and parse the whole file.
     Input:
         filename: the directory of test text file.
+        options: keyword arguments of TransactionManager, or of Coordinator when numManagers is given,
+                 or of ConcurrentTransactionManager when concurrent is given.
+                 The options given in the file itself (see scenarioOptions) override them.
+        restore: checkpoint to resume from instead of creating a transaction manager with options.
+    Output:
+        the transaction manager after the run.
     """
-    tx_manager = TransactionManager.TransactionManager()
+    options = dict(options or {})
+    options.update(scenarioOptions(filename))
+    if restore:
+        tx_manager = checkpoint.load(restore)
+    elif options.pop('concurrent', False):
+        tx_manager = ConcurrentTransactionManager.Sessions(
+            ConcurrentTransactionManager.ConcurrentTransactionManager(**options))
+    elif 'numManagers' in options:
+        tx_manager = coordinator.Coordinator(**options)
+    else:
+        tx_manager = TransactionManager.TransactionManager(**options)
     lines()
     print('Start: ', filename)
     lines()
@@ -137,14 +422,20 @@ def parse_file(filename):
     lines()
     print('Finished.')
     lines()
+    return tx_manager
 
 def main(args):
     if FLAGS.filename:
-        parse_file(FLAGS.filename)
+        tx_manager = parse_file(FLAGS.filename, manager_options(), FLAGS.restore)
+        if FLAGS.stats:
+            for key, val in tx_manager.summary().items():
+                print("{}: {}".format(key, val))
     else:
         exit()
 
 if __name__ == '__main__':
+    # runner.py imports this module to run many scenarios without a filename
+    flags.mark_flag_as_required('filename')
     app.run(main)
 
 
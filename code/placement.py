@@ -0,0 +1,75 @@
+"""placement.py decides which sites store each variable using consistent hashing.
+Every site is placed on a hash ring at several points (virtual nodes). A variable
+is stored on the first distinct sites found walking clockwise from its own hash,
+so adding or removing a site only moves the variables next to its points.
+
+The details of classes and methods are specified below every definition of them.
+"""
+from bisect import bisect_right, insort
+from hashlib import md5
+
+
+def ringHash(key):
+    """Position of a key on the ring, stable across processes.
+
+    INPUT:
+        key(a site point or a variable index)
+    OUTPUT:
+        an integer in [0, 2^64)
+    """
+    return int.from_bytes(md5(str(key).encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """A consistent hash ring of sites.
+    args:
+        vnodes: number of points of every site on the ring
+        points: sorted list of (position, siteId)
+        siteIds: set of sites on the ring
+    """
+    def __init__(self, siteIds=(), vnodes=64):
+        self.vnodes = vnodes
+        self.points = list()
+        self.siteIds = set()
+        for siteId in siteIds:
+            self.addSite(siteId)
+
+    def addSite(self, siteId):
+        """Put a site on the ring.
+
+        INPUT:
+            siteId(index of the site)
+        """
+        if siteId in self.siteIds:
+            return
+        self.siteIds.add(siteId)
+        for i in range(self.vnodes):
+            insort(self.points, (ringHash("site{}#{}".format(siteId, i)), siteId))
+
+    def removeSite(self, siteId):
+        """Take a site off the ring.
+
+        INPUT:
+            siteId(index of the site)
+        """
+        self.siteIds.discard(siteId)
+        self.points = [point for point in self.points if point[1] != siteId]
+
+    def owners(self, key, count=1):
+        """Find the sites which store a variable.
+
+        INPUT:
+            key(variable index), count(number of replicas)
+        OUTPUT:
+            list of distinct site indexes, the first one is the primary
+        """
+        count = min(count, len(self.siteIds))
+        sites = list()
+        start = bisect_right(self.points, (ringHash(key), float('inf')))
+        for i in range(len(self.points)):
+            siteId = self.points[(start + i) % len(self.points)][1]
+            if siteId not in sites:
+                sites.append(siteId)
+                if len(sites) == count:
+                    break
+        return sites
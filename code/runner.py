@@ -0,0 +1,146 @@
+"""runner.py runs many scenario files at once over a pool of processes.
+Each scenario gets its own transaction manager, built from the same options parser.py takes
+(--policy, --mode, --managers, ...) and the options the scenario file names itself. Its output goes
+to one file per scenario and is checked against the expected one (result/resultN.txt for
+test/testN.txt), and the commits, aborts and run time of every scenario are collected into one report.
+
+run:
+    python runner.py --scenarios=test --results=result --output_dir=out --report=report.csv
+    python runner.py --scenarios='test/test1*.txt' --workers=4 --policy=wound-wait
+
+The details of functions are specified below every definition of them.
+"""
+import contextlib
+import csv
+import glob
+import io
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from absl import flags, app
+
+import parser
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('scenarios', None, 'directory of scenario files (*.txt) or a glob of them')
+flags.DEFINE_integer('workers', None, 'processes running scenarios, default one per core')
+flags.DEFINE_string('output_dir', None, 'write the output of each scenario to <name>.out there')
+flags.DEFINE_string('report', None, 'write the report to this CSV file as well')
+flags.DEFINE_string('results', None, 'directory of expected outputs, resultN.txt for scenario testN.txt')
+
+REPORT = ('scenario', 'status', 'seconds', 'commits', 'aborts')
+
+
+def scenarioFiles(pattern):
+    """Scenario files named by a directory (its *.txt files) or a glob, in name order.
+    """
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.txt')
+    return sorted(glob.glob(pattern))
+
+
+def expectedOutput(filename, resultDir):
+    """Expected output of a scenario, None if it has no result file.
+    Result files may be UTF-16 (as saved by PowerShell) or UTF-8.
+
+    INPUT:
+        filename(the scenario), resultDir(directory of result files)
+    """
+    name = os.path.basename(filename).replace('test', 'result', 1)
+    path = os.path.join(resultDir, name)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        data = f.read()
+    return data.decode('utf-16' if data[:2] in (b'\xff\xfe', b'\xfe\xff') else 'utf-8')
+
+
+def sameOutput(output, expected):
+    """Compare two outputs line by line, apart from the line naming the scenario file,
+    line endings and trailing spaces.
+    """
+    def normalize(text):
+        return [line.rstrip() for line in text.splitlines() if not line.startswith('Start: ')]
+    return normalize(output) == normalize(expected)
+
+
+def runScenario(filename, options, restore=None):
+    """Run one scenario on a fresh transaction manager, capturing its output.
+
+    INPUT:
+        filename(the scenario), options(keyword arguments of the manager, see parser.manager_options)
+        restore(checkpoint every scenario starts from, None - a new manager)
+    OUTPUT:
+        (output, report row: filename, 'ok' or 'error', seconds, commits, aborts)
+    """
+    out = io.StringIO()
+    start = time.perf_counter()
+    commits = aborts = None
+    status = 'ok'
+    with contextlib.redirect_stdout(out):
+        try:
+            summary = parser.parse_file(filename, options, restore).summary()
+            commits, aborts = summary['commits'], summary['aborts']
+        except Exception:
+            status = 'error'
+            traceback.print_exc(file=out)
+    return out.getvalue(), (filename, status, time.perf_counter() - start, commits, aborts)
+
+
+def runAll(filenames, options, workers=None, outputDir=None, restore=None, resultDir=None):
+    """Run scenarios over a pool of processes.
+
+    INPUT:
+        filenames(list of scenarios), options(keyword arguments of the manager)
+        workers(number of processes, None - one per core), outputDir(where to write the outputs, None - nowhere)
+        restore(checkpoint every scenario starts from, see parser.py --restore)
+        resultDir(directory of expected outputs, None - don't check; a scenario whose output differs
+                is reported as 'mismatch')
+    OUTPUT:
+        report rows in the order of filenames
+    """
+    if outputDir:
+        os.makedirs(outputDir, exist_ok=True)
+    rows = list()
+    chunk = max(1, len(filenames) // (4 * (workers or os.cpu_count() or 1)))
+    with ProcessPoolExecutor(workers) as pool:
+        results = pool.map(runScenario, filenames, [options] * len(filenames), [restore] * len(filenames),
+                           chunksize=chunk)
+        for output, row in results:
+            if outputDir:
+                name = os.path.splitext(os.path.basename(row[0]))[0]
+                with open(os.path.join(outputDir, name + '.out'), 'w') as f:
+                    f.write(output)
+            if resultDir and row[1] == 'ok':
+                expected = expectedOutput(row[0], resultDir)
+                if expected is not None and not sameOutput(output, expected):
+                    row = (row[0], 'mismatch') + row[2:]
+            rows.append(row)
+    return rows
+
+
+def main(args):
+    filenames = scenarioFiles(FLAGS.scenarios or '')
+    if not filenames:
+        print("No scenario matches {}".format(FLAGS.scenarios))
+        return
+    start = time.perf_counter()
+    rows = runAll(filenames, parser.manager_options(), FLAGS.workers, FLAGS.output_dir, FLAGS.restore,
+                  FLAGS.results)
+    elapsed = time.perf_counter() - start
+    for filename, status, seconds, commits, aborts in rows:
+        print("{}: {} in {:.3f}s, commits: {}, aborts: {}".format(filename, status, seconds, commits, aborts))
+    failed = sum(row[1] != 'ok' for row in rows)
+    print("ran {} scenarios in {:.2f}s ({:.2f}s of scenario time), {} failed".format(
+        len(rows), elapsed, sum(row[2] for row in rows), failed))
+    if FLAGS.report:
+        with open(FLAGS.report, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(REPORT)
+            writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,101 @@
+"""snapshot.py exports the committed state of all sites at a logical time, column by column.
+A snapshot has four columns with one row per replica: site id, variable (x1 or the key),
+committed value and version. It is written to a CSV file, or to a .npy file holding a
+structured array when NumPy is installed, so states can be diffed and analyzed offline.
+
+Managers log the wall-clock time of the commits made at each logical tick; the snapshot at
+tick T holds every commit up to the last one logged at or before T. Keys without a committed
+value are left out, as in dump().
+
+The details of functions are specified below every definition of them.
+"""
+import csv
+from bisect import bisect_right
+from datetime import datetime
+from keyindex import keyName
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+COLUMNS = ('site', 'variable', 'value', 'version')
+
+
+def cutoffTime(commitTimes, tick):
+    """Wall-clock time of the last commit made at or before a logical tick.
+
+    INPUT:
+        commitTimes(list of (tick, time) in tick order), tick(the logical time)
+    OUTPUT:
+        a datetime, the epoch if nothing was committed by then
+    """
+    i = bisect_right(commitTimes, (tick, datetime.max))
+    return commitTimes[i - 1][1] if i else datetime.fromtimestamp(0)
+
+
+def committedAt(var, time=None):
+    """Value and version of the lastest commit of a replica at or before a time.
+    Commits are kept in time order with their version, so it walks back from the newest one.
+
+    INPUT:
+        var(a Variable), time(datetime, None - now)
+    OUTPUT:
+        (value, version), value is None if nothing was committed by then
+    """
+    commits = var.commited_value
+    if time is None:
+        return next(reversed(commits.values()))
+    for t in reversed(commits):
+        if t <= time:
+            return commits[t]
+    return None, 0
+
+
+def collect(sites, time=None):
+    """Committed state of the sites as columns, sites by id and keys in key order.
+
+    INPUT:
+        sites(site id: Site), time(datetime, None - now)
+    OUTPUT:
+        dict of column name: list
+    """
+    siteIds, keys, values, versions = list(), list(), list(), list()
+    for siteId in sorted(sites):
+        variables = sites[siteId].variable_list
+        for key in sites[siteId].index:
+            value, version = committedAt(variables[key], time)
+            if value is None:
+                continue
+            siteIds.append(siteId)
+            keys.append(keyName(key))
+            values.append(value)
+            versions.append(version)
+    return dict(zip(COLUMNS, (siteIds, keys, values, versions)))
+
+
+def toArray(columns):
+    """The columns as one NumPy structured array.
+    """
+    width = max(map(len, columns['variable']), default=1)
+    array = numpy.empty(len(columns['site']),
+                        dtype=[('site', 'i8'), ('variable', 'U{}'.format(width)), ('value', 'i8'), ('version', 'i8')])
+    for name in COLUMNS:
+        array[name] = columns[name]
+    return array
+
+
+def write(columns, path):
+    """Write the columns to a .npy file (a structured array) or a CSV file with a header.
+
+    INPUT:
+        columns(as returned by collect), path(file name, .npy for NumPy)
+    """
+    if path.endswith('.npy'):
+        if numpy is None:
+            raise ValueError("NumPy is needed to export {}, use a .csv file".format(path))
+        numpy.save(path, toArray(columns))
+        return
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        writer.writerows(zip(*(columns[name] for name in COLUMNS)))
@@ -0,0 +1,229 @@
+"""soak.py drives synthetic traffic through one transaction manager for a long time and
+checks that the memory it holds stops growing.
+The workload is generated chunk after chunk (see workload.py) until --duration seconds are up,
+with the workload, policy and failure flags of stress.py. Every --sample_every seconds it records:
+    the size of every engine structure (version history, lock tables, transactions and their ops,
+    the locks held by ops, waitlist, waits-for graph, lock-wait log, ...)
+    the live objects of every engine class (Operation, Transaction, Vertex, ...)
+    the memory traced by tracemalloc, broken down by the module that allocated it
+A series which keeps growing after the warm-up (the first --warmup share of the samples) fails the run.
+
+run:
+    python soak.py --duration=14400 --sample_every=60
+    python soak.py --duration=120 --fail_rate=0.001 --policy=wound-wait --report=soak.csv
+
+The details of functions are specified below every definition of them.
+"""
+import contextlib
+import csv
+import gc
+import os
+import time
+from itertools import count
+import tracemalloc
+from collections import Counter
+from absl import flags, app
+
+import TransactionManager
+import stress
+import workload
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('duration', 60, 'seconds of traffic to drive')
+flags.DEFINE_integer('sample_every', 5, 'seconds between two samples')
+flags.DEFINE_float('warmup', 0.25, 'share of the samples taken before the sizes are expected to settle')
+flags.DEFINE_float('tolerance', 0.1, 'growth after the warm-up, relative to the size then, that fails the run')
+flags.DEFINE_integer('chunk', 500, 'transactions generated at a time')
+flags.DEFINE_float('ro_ratio', 0.1, 'share of read-only transactions')
+flags.DEFINE_enum('mode', '2PL', TransactionManager.TransactionManager.MODES,
+                  'concurrency control of RW transactions')
+
+# engine classes whose live objects are counted
+CLASSES = ('Site', 'Variable', 'Lock', 'Operation', 'Transaction', 'Vertex')
+# modules driving the traffic, their memory isn't the engine's
+HARNESS = ('soak', 'stress', 'workload', 'benchmark', 'runner', 'parser')
+ENGINE = os.path.dirname(os.path.abspath(TransactionManager.__file__))
+# growth below these is noise: items of a structure or objects, and bytes
+MIN_ITEMS = 50
+MIN_BYTES = 64 * 1024
+
+
+def structures(tx_manager):
+    """Size of every structure of a transaction manager that grows with the traffic.
+
+    OUTPUT:
+        dict of structure name: number of items
+    """
+    sites = tx_manager.sites.values()
+    variables = [var for site in sites for var in site.variable_list.values()]
+    ops = [op for tx in tx_manager.transactions.values() for op in tx.ops]
+    return {
+        'history': sum(len(var.commited_value) for var in variables),
+        'lockTable': sum(len(locks) for site in sites for locks in site.lock_table.values()),
+        'upgradeQueue': sum(len(queue) for site in sites for queue in site.upgrade_queue.values()),
+        'rangeLocks': sum(len(site.range_locks) for site in sites),
+        'transactions': len(tx_manager.transactions),
+        'txSite': len(tx_manager.txSite),
+        'txOps': len(ops),
+        'opLocks': sum(len(op.locks) for op in ops),
+        'waitlist': len(tx_manager.waitlist),
+        'graphVertices': len(tx_manager.graph.vertices),
+        'graphEdges': sum(len(v.adj) for v in tx_manager.graph.vertices),
+        'lockWaits': sum(len(waits) for waits in tx_manager.lockWaits.values()),
+        'commitTimes': len(tx_manager.commitTimes),
+        'pendingStarts': len(tx_manager.pendingStarts),
+        'catchupQueue': len(tx_manager.catchupQueue),
+    }
+
+
+def liveObjects():
+    """Number of live objects of every engine class, see CLASSES.
+    """
+    counts = Counter(type(obj).__name__ for obj in gc.get_objects())
+    return {name: counts[name] for name in CLASSES}
+
+
+def retained(snapshot):
+    """Memory traced by tracemalloc, broken down by the engine module that allocated it.
+
+    INPUT:
+        snapshot(a tracemalloc snapshot)
+    OUTPUT:
+        dict of module: bytes
+    """
+    memory = Counter()
+    for stat in snapshot.statistics('filename'):
+        module = engineModule(stat.traceback[0].filename)
+        if module:
+            memory[module] += stat.size
+    return dict(memory)
+
+
+def engineModule(path):
+    """Name of the engine module of a source file, None if it is not one.
+    """
+    module = os.path.splitext(os.path.basename(path))[0]
+    if os.path.dirname(os.path.abspath(path)) != ENGINE or module in HARNESS:
+        return None
+    return module
+
+
+def growing(samples, warmup=0.25, tolerance=0.1):
+    """Series which keep growing after the warm-up.
+    The growth of a series is the slope of its least-squares line times the time it was
+    measured for; it fails when that is above the tolerance (relative to the size at the end
+    of the warm-up) and above the noise floor.
+
+    INPUT:
+        samples(list of (seconds, dict of series name: value)), warmup(share of samples to skip)
+        tolerance(relative growth allowed)
+    OUTPUT:
+        dict of series name: (size at the end of the warm-up, growth)
+    """
+    settled = samples[int(len(samples) * warmup):]
+    if len(settled) < 3:
+        return dict()
+    times = [t for t, _ in settled]
+    meanTime = sum(times) / len(times)
+    spread = sum((t - meanTime) ** 2 for t in times)
+    if spread == 0:
+        return dict()
+    result = dict()
+    for name in settled[0][1]:
+        values = [sizes.get(name, 0) for _, sizes in settled]
+        mean = sum(values) / len(values)
+        slope = sum((t - meanTime) * (v - mean) for t, v in zip(times, values)) / spread
+        growth = slope * (times[-1] - times[0])
+        floor = MIN_BYTES if name.startswith('memory:') else MIN_ITEMS
+        if growth > max(tolerance * values[0], floor):
+            result[name] = (values[0], growth)
+    return result
+
+
+def traffic(number, chunk, seed=0):
+    """One chunk of an endless workload, its transaction ids follow those of the chunk before.
+
+    INPUT:
+        number(index of the chunk), chunk(transactions per chunk), seed(random seed of the first chunk)
+    OUTPUT:
+        a list of commands
+    """
+    offset = number * chunk
+    commands = workload.generate(chunk, FLAGS.ops, FLAGS.concurrency, FLAGS.read_ratio, FLAGS.ro_ratio,
+                                 seed=seed + number)
+    commands = [(command[0], command[1] + offset) + command[2:] for command in commands]
+    if FLAGS.fail_rate:
+        commands = stress.injectFailures(commands, list(range(1, 11)), FLAGS.fail_rate, FLAGS.downtime,
+                                         seed=seed + number)
+    return commands
+
+
+def soak(options, duration, sampleEvery):
+    """Drive traffic through a transaction manager and sample its memory.
+
+    INPUT:
+        options(keyword arguments of TransactionManager), duration(seconds), sampleEvery(seconds)
+    OUTPUT:
+        (list of (seconds, dict of series name: value), last tracemalloc snapshot, commands replayed)
+    """
+    samples = list()
+    replayed = 0
+    tracemalloc.start()
+    start = time.perf_counter()
+    nextSample = 0
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        tx_manager = TransactionManager.TransactionManager(**options)
+        for number in count():
+            commands = traffic(number, FLAGS.chunk, FLAGS.seed)
+            workload.replay(tx_manager, commands)
+            replayed += len(commands)
+            # the chunk is not retained by the engine
+            del commands
+            elapsed = time.perf_counter() - start
+            if elapsed >= nextSample:
+                snapshot = tracemalloc.take_snapshot()
+                sizes = structures(tx_manager)
+                sizes.update(('objects:' + name, n) for name, n in liveObjects().items())
+                sizes.update(('memory:' + name, n) for name, n in retained(snapshot).items())
+                samples.append((elapsed, sizes))
+                nextSample = elapsed + sampleEvery
+            if elapsed >= duration:
+                break
+    tracemalloc.stop()
+    return samples, snapshot, replayed
+
+
+def main(args):
+    options = {'policy': FLAGS.policy, 'defaultMode': FLAGS.mode}
+    samples, snapshot, replayed = soak(options, FLAGS.duration, FLAGS.sample_every)
+    elapsed, last = samples[-1]
+    print("replayed {} commands in {:.0f}s, {} samples".format(replayed, elapsed, len(samples)))
+    print("retained memory by component:")
+    for name, size in sorted(last.items(), key=lambda item: -item[1]):
+        if name.startswith('memory:'):
+            print("    {:<24} {:>10.1f} KiB".format(name[len('memory:'):], size / 1024))
+    print("largest engine allocations:")
+    stats = [stat for stat in snapshot.statistics('lineno') if engineModule(stat.traceback[0].filename)]
+    for stat in stats[:5]:
+        print("    {}".format(stat))
+    print("structures and objects at the end:")
+    for name, size in last.items():
+        if not name.startswith('memory:'):
+            print("    {:<24} {:>10}".format(name, size))
+    if FLAGS.report:
+        names = sorted(set().union(*(sizes for _, sizes in samples)))
+        with open(FLAGS.report, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('seconds',) + tuple(names))
+            writer.writerows([t] + [sizes.get(name, 0) for name in names] for t, sizes in samples)
+    grown = growing(samples, FLAGS.warmup, FLAGS.tolerance)
+    for name, (size, growth) in sorted(grown.items()):
+        print("GROWING {}: {} after the warm-up, +{:.0f} since".format(name, size, growth))
+    if grown:
+        return 1
+    print("no structure grows after the warm-up")
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,234 @@
+"""stress.py replays a steady transactional workload while sites fail and recover.
+Failures are injected at random (--fail_rate, each one lasting --downtime commands) or at
+scheduled commands (--schedule), and the run is measured in windows of --window commands.
+It reports:
+    commits, aborts (those due to a failed site apart) and waitlist size of every window
+    the throughput dip of every failure against the windows with all sites up
+    the commands it took after the recovery to get back to 90% of that throughput
+    the transactions doomed by every failure and the aborts it caused beyond the usual rate
+
+run:
+    python stress.py --txs=20000 --fail_rate=0.001 --downtime=500
+    python stress.py --schedule=5000:3:1000,12000:7:2000 --window=250 --report=windows.csv
+
+The details of functions are specified below every definition of them.
+"""
+import contextlib
+import csv
+import os
+import random
+from absl import flags, app
+
+import TransactionManager
+import workload
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('txs', 20000, 'number of transactions to replay')
+flags.DEFINE_integer('ops', 4, 'operations per transaction')
+flags.DEFINE_integer('concurrency', 10, 'transactions open at the same time')
+flags.DEFINE_float('read_ratio', 0.7, 'share of reads in RW transactions')
+flags.DEFINE_enum('policy', 'detection', TransactionManager.TransactionManager.POLICIES,
+                  'deadlock handling policy of the transaction manager')
+flags.DEFINE_enum('replication', 'available-copies', TransactionManager.TransactionManager.REPLICATIONS,
+                  'replica control of the transaction manager')
+flags.DEFINE_integer('catchup_batch', 0, 'replicas caught up per command after a recovery, 0 - none')
+flags.DEFINE_float('fail_rate', 0.0005, 'chance of failing a random site before each command')
+flags.DEFINE_integer('downtime', 500, 'commands a randomly failed site stays down')
+flags.DEFINE_string('schedule', None, 'failures before fixed workload commands as index:site:downtime,...')
+flags.DEFINE_integer('window', 500, 'commands per measurement window')
+flags.DEFINE_string('report', None, 'write the windows to this CSV file as well')
+flags.DEFINE_integer('seed', 0, 'random seed of the workload and the failures')
+
+# share of the usual throughput a window needs to count as recovered
+RECOVERED = 0.9
+WINDOW = ('window', 'commits', 'aborts', 'failureAborts', 'meanWaitlist', 'maxWaitlist', 'sitesDown', 'staleReplicas')
+
+
+def parseSchedule(text):
+    """Read failures given as index:site:downtime,...
+
+    OUTPUT:
+        list of (command index, site id, downtime)
+    """
+    events = list()
+    for item in (text or '').split(','):
+        if item.strip():
+            at, siteId, downtime = (int(field) for field in item.split(':'))
+            events.append((at, siteId, downtime))
+    return events
+
+
+def injectFailures(commands, sites, rate=0.0, downtime=500, schedule=(), seed=0):
+    """Interleave fail and recover commands with a workload.
+    A site already down is not failed again, and sites still down at the end are recovered.
+
+    INPUT:
+        commands(workload from workload.generate), sites(list of site ids)
+        rate(chance of failing a random site before each command), downtime(commands it stays down)
+        schedule(list of (command index, site id, downtime)), seed(random seed)
+    OUTPUT:
+        a list of commands
+    """
+    rand = random.Random(seed)
+    scheduled = dict()
+    for at, siteId, length in schedule:
+        scheduled.setdefault(at, list()).append((siteId, length))
+    # site id: index of the workload command it recovers before
+    down = dict()
+    result = list()
+    for i, command in enumerate(commands):
+        for siteId in [siteId for siteId, at in down.items() if at <= i]:
+            result.append(('recover', siteId))
+            down.pop(siteId)
+        failures = list(scheduled.get(i, ()))
+        if rate and rand.random() < rate:
+            up = [siteId for siteId in sites if siteId not in down]
+            if up:
+                failures.append((rand.choice(up), downtime))
+        for siteId, length in failures:
+            if siteId not in down:
+                result.append(('fail', siteId))
+                down[siteId] = i + length
+        result.append(command)
+    for siteId in sorted(down, key=down.get):
+        result.append(('recover', siteId))
+    return result
+
+
+def staleReplicas(tx_manager):
+    """Replicas of replicated variables on up sites that can't be read until they are written again.
+    """
+    return sum(var.is_recovered and var.replicated
+               for site in tx_manager.sites.values() if site.status != 'fail'
+               for var in site.variable_list.values())
+
+
+def run(commands, options, window):
+    """Replay a workload with failures, measuring every window of commands.
+
+    INPUT:
+        commands(workload from injectFailures), options(keyword arguments of TransactionManager)
+        window(commands per window)
+    OUTPUT:
+        (list of window rows, see WINDOW, list of failures: dict of site, failed and recovered
+        command index and the transactions doomed when it failed)
+    """
+    tx_manager = TransactionManager.TransactionManager(**options)
+    windows = list()
+    failures = list()
+    # site id: its failure not yet recovered
+    down = dict()
+    current = dict(commits=0, aborts=0, failureAborts=0, waitlist=list())
+
+    def counts():
+        aborts = tx_manager.stats['abort']
+        return tx_manager.stats['commit'], sum(aborts.values()), aborts.get('site failure', 0)
+
+    last = list(counts())
+
+    def observe(i):
+        command = commands[i]
+        if command[0] == 'fail':
+            siteId = command[1]
+            doomed = sum(siteId in tx.accessedFailedSite for tx in tx_manager.transactions.values())
+            down[siteId] = {'site': siteId, 'failed': i, 'recovered': None, 'doomed': doomed}
+            failures.append(down[siteId])
+        elif command[0] == 'recover' and command[1] in down:
+            down.pop(command[1])['recovered'] = i
+        now = counts()
+        current['commits'] += now[0] - last[0]
+        current['aborts'] += now[1] - last[1]
+        current['failureAborts'] += now[2] - last[2]
+        last[:] = now
+        current['waitlist'].append(len(tx_manager.waitlist))
+        if (i + 1) % window == 0 or i + 1 == len(commands):
+            waits = current['waitlist']
+            windows.append((len(windows), current['commits'], current['aborts'], current['failureAborts'],
+                            sum(waits) / len(waits), max(waits),
+                            sum(site.status == 'fail' for site in tx_manager.sites.values()),
+                            staleReplicas(tx_manager)))
+            current.update(commits=0, aborts=0, failureAborts=0, waitlist=list())
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        workload.replay(tx_manager, commands, observe)
+    return windows, failures
+
+
+def analyze(windows, failures, window):
+    """Measure the effect of every failure against the windows with all sites up.
+
+    INPUT:
+        windows, failures(as returned by run), window(commands per window)
+    OUTPUT:
+        (baseline commits and aborts per window, list of dicts per failure: dip(share of the
+        baseline throughput lost in the worst window), recovery(commands from the recovery until
+        a window reaches 90% of the baseline throughput, None - never), excess(aborts beyond
+        the baseline rate until then), amplification(excess aborts per doomed transaction))
+    """
+    # windows touched by a failure
+    affected = set()
+    for failure in failures:
+        end = failure['recovered'] if failure['recovered'] is not None else len(windows) * window
+        affected.update(range(failure['failed'] // window, end // window + 1))
+    calm = [row for row in windows if row[0] not in affected] or windows
+    baseCommits = sum(row[1] for row in calm) / len(calm)
+    baseAborts = sum(row[2] for row in calm) / len(calm)
+    results = list()
+    for failure in failures:
+        first = failure['failed'] // window
+        recovered = failure['recovered']
+        back = None
+        if recovered is not None:
+            # the window holding the recovery is partly down, start with the next one
+            for row in windows[recovered // window + 1:]:
+                if row[1] >= RECOVERED * baseCommits:
+                    back = row[0]
+                    break
+        last = back if back is not None else len(windows) - 1
+        # a failure at the very end of the run may have no window of its own
+        episode = windows[first:last + 1] or windows[-1:]
+        worst = min(row[1] for row in episode)
+        excess = sum(row[2] for row in episode) - baseAborts * len(episode)
+        results.append(dict(failure,
+                            dip=1 - worst / baseCommits if baseCommits else 0.0,
+                            recovery=back * window - recovered if back is not None else None,
+                            excess=excess,
+                            amplification=excess / failure['doomed'] if failure['doomed'] else None))
+    return (baseCommits, baseAborts), results
+
+
+def main(args):
+    options = {'policy': FLAGS.policy, 'replication': FLAGS.replication, 'catchupBatch': FLAGS.catchup_batch}
+    commands = workload.generate(FLAGS.txs, FLAGS.ops, FLAGS.concurrency, FLAGS.read_ratio, seed=FLAGS.seed)
+    commands = injectFailures(commands, list(range(1, 11)), FLAGS.fail_rate, FLAGS.downtime,
+                              parseSchedule(FLAGS.schedule), FLAGS.seed)
+    windows, failures = run(commands, options, FLAGS.window)
+    (baseCommits, baseAborts), results = analyze(windows, failures, FLAGS.window)
+    print("{:>6} {:>7} {:>6} {:>8} {:>9} {:>8} {:>5} {:>5}".format(
+        'window', 'commits', 'aborts', 'failure', 'waitlist', 'max', 'down', 'stale'))
+    for row in windows:
+        print("{:>6} {:>7} {:>6} {:>8} {:>9.1f} {:>8} {:>5} {:>5}".format(*row))
+    print("baseline per window of {} commands: {:.1f} commits, {:.1f} aborts".format(
+        FLAGS.window, baseCommits, baseAborts))
+    for failure in results:
+        print("site {} down from command {} to {}: {} doomed, throughput dip {:.0%}, "
+              "recovered {}, {:.1f} extra aborts ({})".format(
+                  failure['site'], failure['failed'], failure['recovered'], failure['doomed'], failure['dip'],
+                  "after {} commands".format(failure['recovery']) if failure['recovery'] is not None else "never",
+                  failure['excess'],
+                  "{:.2f} per doomed transaction".format(failure['amplification'])
+                  if failure['amplification'] is not None else "none doomed"))
+    if results:
+        print("failures: {}, mean dip {:.0%}, mean extra aborts {:.1f}".format(
+            len(results), sum(f['dip'] for f in results) / len(results),
+            sum(f['excess'] for f in results) / len(results)))
+    if FLAGS.report:
+        with open(FLAGS.report, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(WINDOW)
+            writer.writerows(windows)
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,234 @@
+"""test_engine.py checks the policies and options of the transaction manager one at a time:
+deadlock prevention, optimistic and snapshot validation, update locks, lock escalation,
+checkpoints and snapshots, and admission control.
+
+run:
+    python -m unittest test_engine
+"""
+import contextlib
+import csv
+import io
+import os
+import tempfile
+import unittest
+
+import checkpoint
+import snapshot
+from TransactionManager import TransactionManager
+
+
+def quiet(tm, *commands):
+    """Run commands (method name, arguments...) on a transaction manager without printing.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name, *args in commands:
+            getattr(tm, name)(*args)
+    return tm
+
+
+def waiting(tm):
+    return [op.txId for op in tm.waitlist]
+
+
+def aborts(tm):
+    return tm.summary()['abortsByReason']
+
+
+class PreventionTest(unittest.TestCase):
+    # T1 is older than T2, both ask for a write lock on x2 held by the other
+    def conflict(self, policy, holder):
+        tm = TransactionManager(policy=policy)
+        other = 3 - holder
+        return quiet(tm, ('startTx', 'RW', 1), ('startTx', 'RW', 2),
+                     ('writeOp', holder, 2, 10), ('writeOp', other, 2, 20))
+
+    def test_wait_die(self):
+        tm = self.conflict('wait-die', holder=2)
+        # the older requester waits
+        self.assertEqual(waiting(tm), [1])
+        tm = self.conflict('wait-die', holder=1)
+        # the younger requester dies
+        self.assertNotIn(2, tm.transactions)
+        self.assertEqual(aborts(tm), {'wait-die': 1})
+
+    def test_wound_wait(self):
+        tm = self.conflict('wound-wait', holder=2)
+        # the older requester wounds the younger holder and takes the lock
+        self.assertNotIn(2, tm.transactions)
+        self.assertEqual(waiting(tm), [])
+        self.assertEqual(aborts(tm), {'wound-wait': 1})
+        tm = self.conflict('wound-wait', holder=1)
+        # the younger requester waits
+        self.assertEqual(waiting(tm), [2])
+
+    def test_no_wait(self):
+        for holder in (1, 2):
+            tm = self.conflict('no-wait', holder)
+            self.assertNotIn(3 - holder, tm.transactions)
+            self.assertIn(holder, tm.transactions)
+            self.assertEqual(aborts(tm), {'no-wait': 1})
+
+    def test_prevention_skips_the_graph(self):
+        tm = self.conflict('wait-die', holder=2)
+        self.assertEqual(tm.graph.findCycles(), [])
+        self.assertFalse(any(v.adj for v in tm.graph.vertices))
+
+
+class ValidationTest(unittest.TestCase):
+    def test_occ_aborts_on_a_stale_read(self):
+        tm = TransactionManager()
+        quiet(tm, ('startTx', 'RW', 1, 0, 'OCC'), ('startTx', 'RW', 2),
+              ('readOp', 1, 2), ('writeOp', 2, 2, 20), ('endTx', 2), ('endTx', 1))
+        self.assertEqual(tm.stats['commit'], 1)
+        self.assertEqual(sum(aborts(tm).values()), 1)
+
+    def test_occ_commits_without_conflict(self):
+        tm = TransactionManager()
+        quiet(tm, ('startTx', 'RW', 1, 0, 'OCC'), ('startTx', 'RW', 2),
+              ('readOp', 1, 2), ('writeOp', 1, 4, 14), ('writeOp', 2, 6, 16), ('endTx', 2), ('endTx', 1))
+        self.assertEqual(tm.stats['commit'], 2)
+        self.assertEqual(snapshot.committedAt(tm.sites[1].variable_list[4])[0], 14)
+
+    def test_si_first_committer_wins(self):
+        tm = TransactionManager()
+        quiet(tm, ('startTx', 'RW', 1, 0, 'SI'), ('startTx', 'RW', 2, 0, 'SI'),
+              ('writeOp', 1, 2, 12), ('endTx', 1), ('writeOp', 2, 2, 22), ('endTx', 2))
+        # T1 committed x2 after T2 began
+        self.assertEqual(aborts(tm), {'validation': 1})
+        self.assertEqual(snapshot.committedAt(tm.sites[1].variable_list[2])[0], 12)
+
+    def test_si_reads_its_snapshot(self):
+        tm = TransactionManager()
+        out = io.StringIO()
+        quiet(tm, ('startTx', 'RW', 1, 0, 'SI'), ('startTx', 'RW', 2),
+              ('writeOp', 2, 2, 22), ('endTx', 2))
+        with contextlib.redirect_stdout(out):
+            tm.readOp(1, 2)
+        self.assertIn('returns 20', out.getvalue())
+
+
+class UpdateLockTest(unittest.TestCase):
+    def test_update_lock_shares_with_readers_only(self):
+        tm = TransactionManager()
+        quiet(tm, ('startTx', 'RW', 1), ('startTx', 'RW', 2), ('startTx', 'RW', 3),
+              ('readOp', 1, 2, True), ('readOp', 2, 2), ('readOp', 3, 2, True))
+        # a reader shares the variable with the updater, a second updater waits
+        self.assertEqual(waiting(tm), [3])
+
+    def test_upgrade_waits_for_readers_and_blocks_new_ones(self):
+        tm = TransactionManager()
+        quiet(tm, ('startTx', 'RW', 1), ('startTx', 'RW', 2), ('startTx', 'RW', 3),
+              ('readOp', 1, 2, True), ('readOp', 2, 2), ('writeOp', 1, 2, 12), ('readOp', 3, 2))
+        self.assertEqual(waiting(tm), [1, 3])
+        quiet(tm, ('endTx', 2))
+        # the upgrade goes first, the new reader waits for T1
+        self.assertEqual(waiting(tm), [3])
+        quiet(tm, ('endTx', 1))
+        self.assertEqual(waiting(tm), [])
+        self.assertEqual(tm.stats['commit'], 2)
+
+
+class EscalationTest(unittest.TestCase):
+    def test_locks_in_a_range_escalate(self):
+        tm = TransactionManager(escalateAfter=2)
+        quiet(tm, ('startTx', 'RW', 1), ('startTx', 'RW', 2),
+              ('readOp', 1, 2), ('readOp', 1, 4), ('readOp', 1, 6), ('writeOp', 2, 8, 18))
+        # T1's shared lock on the range of x2..x6 keeps T2 from x8, which T1 never read
+        self.assertEqual(waiting(tm), [2])
+        quiet(tm, ('endTx', 1))
+        self.assertEqual(waiting(tm), [])
+        quiet(tm, ('endTx', 2))
+        self.assertEqual(tm.stats['commit'], 2)
+
+    def test_no_escalation_below_the_threshold(self):
+        tm = TransactionManager(escalateAfter=3)
+        quiet(tm, ('startTx', 'RW', 1), ('startTx', 'RW', 2),
+              ('readOp', 1, 2), ('readOp', 1, 4), ('readOp', 1, 6), ('writeOp', 2, 8, 18))
+        self.assertEqual(waiting(tm), [])
+
+
+class CheckpointTest(unittest.TestCase):
+    FIRST = [('startTx', 'RW', 1), ('startTx', 'RW', 2), ('writeOp', 1, 4, 14),
+             ('writeOp', 2, 2, 22), ('writeOp', 2, 4, 24)]
+    REST = [('endTx', 1), ('endTx', 2), ('startTx', 'RO', 3), ('readOp', 3, 4), ('endTx', 3)]
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def test_resume_matches_an_uninterrupted_run(self):
+        whole = quiet(TransactionManager(), *(self.FIRST + self.REST))
+        path = os.path.join(self.dir.name, 'run.ckpt')
+        checkpoint.save(quiet(TransactionManager(), *self.FIRST), path)
+        resumed = quiet(checkpoint.load(path), *self.REST)
+        self.assertEqual(snapshot.collect(resumed.sites), snapshot.collect(whole.sites))
+        self.assertEqual(resumed.stats['commit'], whole.stats['commit'])
+        self.assertEqual(waiting(resumed), [])
+
+    def test_rejects_other_files(self):
+        path = os.path.join(self.dir.name, 'not.ckpt')
+        with open(path, 'wb') as f:
+            f.write(b'hello\n')
+        with self.assertRaises(ValueError):
+            checkpoint.load(path)
+
+    def test_export_round_trip(self):
+        tm = quiet(TransactionManager(), *(self.FIRST + self.REST))
+        path = os.path.join(self.dir.name, 'state.csv')
+        quiet(tm, ('exportOp', path))
+        with open(path, newline='') as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows[0], list(snapshot.COLUMNS))
+        columns = snapshot.collect(tm.sites)
+        read = [[int(row[0]), row[1], int(row[2]), int(row[3])] for row in rows[1:]]
+        self.assertEqual(read, [list(row) for row in zip(*(columns[name] for name in snapshot.COLUMNS))])
+        self.assertIn([2, 'x4', 24], [row[:3] for row in read])
+
+    def test_export_as_of_a_tick(self):
+        tm = quiet(TransactionManager(), *(self.FIRST + self.REST))
+        path = os.path.join(self.dir.name, 'before.csv')
+        # x4 was first committed by T1 at tick 6, T2 overwrote it at tick 7
+        quiet(tm, ('exportOp', path, 6))
+        with open(path, newline='') as f:
+            values = {(int(row[0]), row[1]): int(row[2]) for row in list(csv.reader(f))[1:]}
+        self.assertEqual(values[(1, 'x4')], 14)
+        self.assertEqual(values[(1, 'x2')], 20)
+
+
+class AdmissionTest(unittest.TestCase):
+    def test_transactions_above_the_cap_wait(self):
+        tm = TransactionManager(maxActive=1)
+        quiet(tm, ('startTx', 'RW', 1), ('startTx', 'RW', 2), ('writeOp', 2, 2, 22), ('endTx', 2))
+        # T2's statements are kept until T1 ends
+        self.assertEqual(tm.running, {1})
+        self.assertEqual(tm.stats['commit'], 0)
+        quiet(tm, ('endTx', 1))
+        self.assertEqual(tm.stats['commit'], 2)
+        self.assertEqual(snapshot.committedAt(tm.sites[1].variable_list[2])[0], 22)
+        self.assertEqual(tm.running, set())
+
+    def test_start_time_is_the_admission(self):
+        tm = TransactionManager(maxActive=1)
+        quiet(tm, ('startTx', 'RW', 1), ('startTx', 'RW', 2), ('startTx', 'RW', 3))
+        begun = tm.transactions[2].startTime
+        later = tm.transactions[3].startTime
+        quiet(tm, ('endTx', 1))
+        self.assertGreater(tm.transactions[2].startTime, later)
+        self.assertGreater(tm.transactions[2].startTime, begun)
+        self.assertEqual(list(tm.transactions), [3, 2])
+
+    def test_read_only_transactions_skip_the_cap(self):
+        tm = TransactionManager(maxActive=1)
+        quiet(tm, ('startTx', 'RW', 1), ('startTx', 'RO', 2), ('readOp', 2, 2), ('endTx', 2))
+        self.assertEqual(tm.stats['commit'], 1)
+
+    def test_adaptive_cap_shrinks_on_aborts(self):
+        tm = TransactionManager(policy='no-wait', maxActive=8, adaptiveAdmission=True)
+        for i in range(1, 9, 2):
+            quiet(tm, ('startTx', 'RW', i), ('startTx', 'RW', i + 1),
+                  ('writeOp', i, 2, i), ('writeOp', i + 1, 2, i), ('endTx', i))
+        self.assertLess(tm.activeCap, 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
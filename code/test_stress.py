@@ -0,0 +1,48 @@
+"""test_stress.py runs the failure-injection harness of stress.py end to end.
+
+run:
+    python -m unittest test_stress
+"""
+import unittest
+
+import stress
+import workload
+
+
+class StressTest(unittest.TestCase):
+    def replay(self, schedule, window=100):
+        commands = workload.generate(300, 4, 10, seed=1)
+        commands = stress.injectFailures(commands, list(range(1, 11)), schedule=schedule)
+        windows, failures = stress.run(commands, {'policy': 'detection'}, window)
+        return commands, windows, failures
+
+    def test_windows_cover_every_command(self):
+        commands, windows, failures = self.replay([(200, 3, 300), (600, 5, 100)])
+        # commands of ended transactions are skipped by replay, they still count
+        self.assertEqual(len(windows), -(-len(commands) // 100))
+        self.assertEqual([row[0] for row in windows], list(range(len(windows))))
+        self.assertEqual([failure['site'] for failure in failures], [3, 5])
+        for failure in failures:
+            self.assertLess(failure['failed'] // 100, len(windows))
+            self.assertIsNotNone(failure['recovered'])
+
+    def test_analyze(self):
+        commands, windows, failures = self.replay([(200, 3, 300), (600, 5, 100)])
+        (baseCommits, baseAborts), results = stress.analyze(windows, failures, 100)
+        self.assertGreater(baseCommits, 0)
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertGreaterEqual(result['dip'], 0.0)
+            self.assertLessEqual(result['dip'], 1.0)
+
+    def test_failure_at_the_end(self):
+        # the site fails before the last workload command and recovers after it
+        length = len(workload.generate(300, 4, 10, seed=1))
+        commands, windows, failures = self.replay([(length - 1, 2, 500)])
+        (_, _), results = stress.analyze(windows, failures, 100)
+        self.assertEqual(len(results), 1)
+        self.assertIsNone(results[0]['recovery'])
+
+
+if __name__ == '__main__':
+    unittest.main()
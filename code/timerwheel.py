@@ -0,0 +1,103 @@
+"""timerwheel.py defines a hierarchical timer wheel, used for lock-wait timeouts.
+Time is an integer (logical ticks, or milliseconds of wall time). Level 0 has one slot per
+time unit, and each level above has slots as wide as the whole level below. A timer sits in the
+lowest level whose span covers its deadline; when the level below wraps around, the timers of the
+next slot up are moved down. Scheduling and cancelling a timer cost O(1), and advancing the wheel
+costs O(1) per time unit plus O(1) per timer moved or fired, however many timers are pending.
+
+The details of functions are specified below every definition of them.
+"""
+class TimerWheel:
+    """Timers of items, each firing once the wheel is advanced to its deadline.
+    args:
+        now: time the wheel was last advanced to
+        slots: slots per level
+        levels: every level is a list of slots, a slot is a dict (timer id: (deadline, item))
+        where: timer id: (level, slot) the timer is in, for cancelling it
+        nextTimer: id of the next timer
+    """
+    def __init__(self, now=0, slots=64, levels=4):
+        if slots < 2 or levels < 1:
+            raise ValueError("A timer wheel needs at least two slots and one level")
+        self.now = now
+        self.slots = slots
+        self.levels = [[dict() for _ in range(slots)] for _ in range(levels)]
+        self.where = dict()
+        self.nextTimer = 0
+
+    def __len__(self):
+        return len(self.where)
+
+    def schedule(self, deadline, item):
+        """Add a timer.
+
+        INPUT:
+            deadline(time it fires at, at the next advance if it has passed), item(what it fires)
+        OUTPUT:
+            the timer id
+        """
+        timer = self.nextTimer
+        self.nextTimer += 1
+        self.place(timer, max(deadline, self.now + 1), item)
+        return timer
+
+    def place(self, timer, deadline, item):
+        """Put a timer into the lowest level whose span covers its deadline,
+        the top level holds the ones further away until they come within its span.
+        """
+        level = 0
+        span = self.slots
+        while deadline - self.now >= span and level < len(self.levels) - 1:
+            level += 1
+            span *= self.slots
+        slot = deadline // (span // self.slots) % self.slots
+        self.levels[level][slot][timer] = (deadline, item)
+        self.where[timer] = (level, slot)
+
+    def cancel(self, timer):
+        """Remove a timer which hasn't fired.
+
+        INPUT:
+            timer(the timer id)
+        OUTPUT:
+            True - removed, False - it already fired or was cancelled
+        """
+        place = self.where.pop(timer, None)
+        if place is None:
+            return False
+        level, slot = place
+        del self.levels[level][slot][timer]
+        return True
+
+    def advance(self, now):
+        """Move the wheel forward to a time and collect the timers due by then.
+
+        INPUT:
+            now(the time)
+        OUTPUT:
+            items of the fired timers, earlier deadlines first
+        """
+        fired = list()
+        while self.now < now:
+            if not self.where:
+                # nothing to fire or move down, jump
+                self.now = now
+                break
+            self.now += 1
+            # move down the timers of the next slot of every level the one below wrapped around at
+            width = 1
+            for level in range(1, len(self.levels)):
+                width *= self.slots
+                if self.now % width:
+                    break
+                slot = self.levels[level][self.now // width % self.slots]
+                moving = list(slot.items())
+                slot.clear()
+                for timer, (deadline, item) in moving:
+                    self.place(timer, deadline, item)
+            slot = self.levels[0][self.now % self.slots]
+            # a timer beyond the span of the whole wheel waits for its turn in the slot
+            for timer in [timer for timer, (deadline, _) in slot.items() if deadline <= self.now]:
+                fired.append(slot.pop(timer)[1])
+                del self.where[timer]
+        return fired
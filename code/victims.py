@@ -0,0 +1,64 @@
+"""victims.py defines the policies used to choose which transaction to abort in a deadlock.
+Available policies are:
+    youngest: abort the transaction which started last
+    fewest-ops: abort the transaction which executed the fewest operations
+    fewest-locks: abort the transaction which holds the fewest locks
+    least-undo: abort the transaction with the least undo work (executed writes times replicas)
+    priority: abort the transaction with the lowest priority, the youngest among equals
+
+Every policy other than youngest breaks ties by aborting the youngest transaction.
+The details of functions are specified below every definition of them.
+"""
+
+def work(tx):
+    """Measure the work a transaction would discard if it aborted.
+
+    INPUT:
+        tx(the transaction)
+    OUTPUT:
+        dict of ops(executed operations), locks(locks held, one per variable per site)
+        and undo(executed writes times the replicas they were written to, none if they are buffered)
+    """
+    executed = 0
+    undo = 0
+    locks = set()
+    for op in tx.ops:
+        if op.exec:
+            executed += 1
+            if op.opType == 'write' and not tx.buffered:
+                undo += len(op.locks)
+        for siteId in op.locks:
+            locks.add((op.varId, siteId))
+    return {'ops': executed, 'locks': len(locks), 'undo': undo}
+
+def youngestFirst(tx):
+    """Tie breaker: smaller for younger transactions.
+    """
+    return -tx.startTime.timestamp()
+
+POLICIES = {
+    'fewest-ops': lambda tx: (work(tx)['ops'], youngestFirst(tx)),
+    'fewest-locks': lambda tx: (work(tx)['locks'], youngestFirst(tx)),
+    'least-undo': lambda tx: (work(tx)['undo'], youngestFirst(tx)),
+    'priority': lambda tx: (tx.priority, youngestFirst(tx)),
+}
+
+def chooseVictim(txs, policy='youngest'):
+    """Choose the transaction to abort among those in a deadlock.
+
+    INPUT:
+        txs(list of transactions in the cycle)
+        policy(name of the victim policy)
+    OUTPUT:
+        the transaction to abort
+    """
+    if policy == 'youngest':
+        # the first one started last, same as the original rule
+        youngest = txs[0]
+        for tx in txs:
+            if tx.startTime > youngest.startTime:
+                youngest = tx
+        return youngest
+    return min(txs, key=POLICIES[policy])
+
+NAMES = ('youngest',) + tuple(POLICIES)
@@ -0,0 +1,112 @@
+"""workload.py generates synthetic transactional workloads and replays them on a transaction manager.
+A workload is a list of commands, each a tuple of the command name and its arguments:
+    ('begin', txId)
+    ('beginRO', txId)
+    ('R', txId, varId)
+    ('W', txId, varId, value)
+    ('end', txId)
+    ('fail', siteId), ('recover', siteId): failures injected into a workload (see stress.py)
+Commands of a fixed number of concurrent transactions are interleaved at random,
+so lock conflicts and deadlocks happen as they would in a trace.
+
+The details of functions are specified below every definition of them.
+"""
+import random
+
+
+def generate(numTx, opsPerTx=4, concurrency=10, readRatio=0.7, roRatio=0.1, variables=None, seed=0):
+    """Generate a random workload.
+
+    INPUT:
+        numTx(number of transactions), opsPerTx(operations per transaction)
+        concurrency(number of transactions open at the same time)
+        readRatio(share of reads in RW transactions), roRatio(share of read-only transactions)
+        variables(list of variable indexes to access, default x1..x20), seed(random seed)
+    OUTPUT:
+        a list of commands
+    """
+    rand = random.Random(seed)
+    variables = list(variables or range(1, 21))
+    commands = list()
+    # txId: number of operations left
+    running = dict()
+    nextTx = 1
+    while running or nextTx <= numTx:
+        while len(running) < concurrency and nextTx <= numTx:
+            if rand.random() < roRatio:
+                commands.append(('beginRO', nextTx))
+                running[nextTx] = -opsPerTx
+            else:
+                commands.append(('begin', nextTx))
+                running[nextTx] = opsPerTx
+            nextTx += 1
+        txId = rand.choice(list(running))
+        left = running[txId]
+        if left == 0:
+            commands.append(('end', txId))
+            running.pop(txId)
+            continue
+        varId = rand.choice(variables)
+        if left < 0:
+            # read-only transaction
+            commands.append(('R', txId, varId))
+            running[txId] = left + 1
+        else:
+            if rand.random() < readRatio:
+                commands.append(('R', txId, varId))
+            else:
+                commands.append(('W', txId, varId, rand.randint(0, 999)))
+            running[txId] = left - 1
+    return commands
+
+
+def replay(tx_manager, commands, observe=None):
+    """Execute a workload on a transaction manager.
+    Like the parser, commands of transactions which already ended or aborted are skipped.
+
+    INPUT:
+        tx_manager(the transaction manager), commands(list of commands)
+        observe(called with the index of every command after it ran or was skipped, None - nothing)
+    """
+    for i, command in enumerate(commands):
+        name = command[0]
+        txId = command[1]
+        if name == 'fail':
+            tx_manager.failOp(command[1])
+        elif name == 'recover':
+            tx_manager.recoverOp(command[1])
+        elif name == 'begin':
+            tx_manager.startTx('RW', txId)
+        elif name == 'beginRO':
+            tx_manager.startTx('RO', txId)
+        elif txId in tx_manager.transactions:
+            if name == 'R':
+                tx_manager.readOp(txId, command[2])
+            elif name == 'W':
+                tx_manager.writeOp(txId, command[2], command[3])
+            elif name == 'end':
+                tx_manager.endTx(txId)
+        if observe is not None:
+            observe(i)
+
+
+def toText(commands):
+    """Write a workload in the command language read by parser.py.
+
+    INPUT:
+        commands(list of commands)
+    OUTPUT:
+        a list of lines
+    """
+    lines = list()
+    for command in commands:
+        name = command[0]
+        if name in ('begin', 'beginRO', 'end'):
+            lines.append("{}(T{})".format(name, command[1]))
+        elif name in ('fail', 'recover'):
+            lines.append("{}({})".format(name, command[1]))
+        elif name == 'R':
+            lines.append("R(T{}, x{})".format(command[1], command[2]))
+        else:
+            lines.append("W(T{}, x{}, {})".format(command[1], command[2], command[3]))
+    return lines